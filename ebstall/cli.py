@@ -17,16 +17,6 @@ import types
 
 from ebclient.registration import ENVIRONMENT_PRODUCTION
 
-from ebstall.registration import Registration, InfoLoader
-from ebstall.updater import Updater
-from ebstall.deployers.mysql import MySQL
-from ebstall.deployers.ejbca import Ejbca
-from ebstall.deployers.jboss import Jboss
-from ebstall.deployers.certbot import Certbot
-from ebstall.deployers.certificates import Certificates
-from ebstall.deployers.letsencrypt import LetsEncrypt
-from ebstall.deployers.softhsm import SoftHsmV1Config
-
 import errors
 import util
 from clibase import InstallerBase
@@ -35,6 +25,23 @@ from consts import *
 from core import Core
 
 
+# Registration, updater and deployers are imported on the first use, most commands need only few of them
+Registration = util.LazyImport('ebstall.registration', 'Registration')
+InfoLoader = util.LazyImport('ebstall.registration', 'InfoLoader')
+Updater = util.LazyImport('ebstall.updater', 'Updater')
+MySQL = util.LazyImport('ebstall.deployers.mysql', 'MySQL')
+Ejbca = util.LazyImport('ebstall.deployers.ejbca', 'Ejbca')
+Jboss = util.LazyImport('ebstall.deployers.jboss', 'Jboss')
+Certbot = util.LazyImport('ebstall.deployers.certbot', 'Certbot')
+Certificates = util.LazyImport('ebstall.deployers.certificates', 'Certificates')
+LetsEncrypt = util.LazyImport('ebstall.deployers.letsencrypt', 'LetsEncrypt')
+SoftHsmV1Config = util.LazyImport('ebstall.deployers.softhsm', 'SoftHsmV1Config')
+
+# Network clients import requests
+ec2meta = util.LazyImport('ebstall.ec2meta')
+httpclient = util.LazyImport('ebstall.httpclient')
+
+
 logger = logging.getLogger(__name__)
 coloredlogs.install(level=logging.ERROR)
 
@@ -44,6 +51,9 @@ class Installer(InstallerBase):
     EnigmaBridge AWS command line interface
     """
 
+    # Time limit for concurrent port reachability checks, seconds
+    PORT_TEST_DEADLINE = 60
+
     def __init__(self, *args, **kwargs):
         """
         Init core
@@ -57,6 +67,7 @@ class Installer(InstallerBase):
 
         # Init state
         self.reg_svc = None
+        self.info_loader = None
         self.soft_config = None
         self.jboss = None
         self.ejbca = None
@@ -123,9 +134,18 @@ class Installer(InstallerBase):
         if self.reg_svc is not None and self.reg_svc.info_loader is not None:
             return self.reg_svc.info_loader.ami_public_ip
 
-        info = InfoLoader(audit=self.audit, sysconfig=self.syscfg)
-        info.load()
-        return info.ami_public_ip
+        return self.get_info_loader().ami_public_ip
+
+    def get_info_loader(self):
+        """
+        System information loader, loaded once per run
+        :return: InfoLoader
+        """
+        if self.info_loader is None:
+            info = InfoLoader(audit=self.audit, sysconfig=self.syscfg)
+            info.load()
+            self.info_loader = info
+        return self.info_loader
 
     def get_db_type(self):
         """
@@ -781,24 +801,27 @@ class Installer(InstallerBase):
         port = self.ejbca.PORT_PUBLIC if public else self.ejbca.PORT
         return util.test_port_routable(host=host, port=port, with_server=with_server, audit=self.audit)
 
+    def init_test_ports_pre_install_list(self, *args, **kwargs):
+        """
+        Ports to test before installation starts.
+        This method can be extended.
+        :return: list of util.Port
+        """
+        return [util.Port(port=Ejbca.PORT, tcp=True, service='EJBCA'),
+                util.Port(port=Ejbca.PORT_PUBLIC, tcp=True, service='EJBCA')]
+
     def init_test_ports_pre_install_res(self, host=None, *args, **kwargs):
         """
         Tests ports routability before installation starts, returns failed port array.
-        This method can be extended.
+        All ports are tested concurrently.
         :return: list of failed ports
         """
         host = util.defval(host, self.cfg_get_raw_ip())
-        failed_ports = []
-
-        admin_ok = self.init_test_ejbca_ports_routable(host=host, with_server=True, public=False)
-        if not admin_ok:
-            failed_ports.append(util.Port(port=Ejbca.PORT, tcp=True, service='EJBCA'))
-
-        public_ok = self.init_test_ejbca_ports_routable(host=host, with_server=True, public=True)
-        if not public_ok:
-            failed_ports.append(util.Port(port=Ejbca.PORT_PUBLIC, tcp=True, service='EJBCA'))
+        ports = self.init_test_ports_pre_install_list()
 
-        return failed_ports
+        results = util.test_ports_routable(host=host, ports=ports, with_server=True,
+                                           deadline=self.PORT_TEST_DEADLINE, audit=self.audit)
+        return [port for port, is_ok in results.items() if not is_ok]
 
     def init_test_ports_pre_install(self):
         """
@@ -864,8 +887,13 @@ class Installer(InstallerBase):
         if self.last_is_vpc:
             return
 
-        ejbca_open = self.init_test_ejbca_ports_routable(public=False, with_server=with_server)
-        if not ejbca_open:
+        admin_port = util.Port(port=self.ejbca.PORT, tcp=True, service='EJBCA')
+        public_port = util.Port(port=self.ejbca.PORT_PUBLIC, tcp=True, service='EJBCA')
+        ports = [admin_port, public_port] if check_public else [admin_port]
+
+        results = util.test_ports_routable(host=self.cfg_get_raw_ip(), ports=ports, with_server=with_server,
+                                           deadline=self.PORT_TEST_DEADLINE, audit=self.audit)
+        if not results[admin_port]:
             self.cli_sleep(2)
             self.init_print_ejbca_unreachable_error()
             return
@@ -873,8 +901,7 @@ class Installer(InstallerBase):
         if not check_public:
             return
 
-        ejbca_public_open = self.init_test_ejbca_ports_routable(public=True, with_server=with_server)
-        if not ejbca_public_open:
+        if not results[public_port]:
             self.cli_sleep(2)
             self.init_print_ejbca_unreachable_public_error()
             return
@@ -1114,6 +1141,9 @@ class Installer(InstallerBase):
         """
         status_data = self.init_get_install_status()
 
+        # Connection reuse of the provisioning / IP detection traffic over the installation
+        self.audit.audit_evt('http-stats', duration=status_data['duration'], **httpclient.get_stats())
+
         # Install status won't fly if registration did not finish
         if self.config is None or self.config.email is None or self.config.apikey is None:
             logger.debug('Not sending install status, registration is not finished')
@@ -1436,9 +1466,39 @@ class Installer(InstallerBase):
         :param arg: 
         :return: 
         """
+        # Cron-driven updates reuse the installed packages inventory among runs
+        self.syscfg.inventory_snapshot = PKG_INVENTORY_SNAPSHOT
+        self.updater.specs_cache_path = UPDATE_SPECS_CACHE
+        if self.args.plan:
+            return self.return_code(self.update_plan_print())
+
         ret = self.update_main_try()
         return self.return_code(ret)
 
+    def update_plan_print(self):
+        """
+        Prints merged update transactions without executing them
+        :return: 
+        """
+        plan = self.updater.update(plan_only=True)
+        if plan.is_empty():
+            self.tprint('No update actions to perform')
+            return 0
+
+        self.tprint('Update plan: %s transaction(s) from %s rule(s)' % (len(plan), len(plan.rules)))
+        for idx, (params, cmds) in enumerate(self.updater.describe_plan(plan)):
+            pkgs = params['packages']
+            self.tprint('\nTransaction %d: %s' % (idx + 1, 'all packages' if pkgs is None else
+                                                   '%d package(s) restricted' % len(pkgs)))
+            if len(cmds) == 0:
+                self.tprint('  nothing to update, packages are up to date')
+            for cmd in cmds:
+                self.tprint('  %s' % cmd)
+
+        for rule_id in plan.unknown:
+            self.tprint('Skipped rule with unknown action: %s' % rule_id)
+        return 0
+
     def update_main_try(self):
         """
         Main update block, after init.
@@ -1625,16 +1685,15 @@ class Installer(InstallerBase):
             return self.return_code(1)
 
         self.audit.set_flush_enabled(True)
+        timer = util.PhaseTimer()
         try:
-            config = Core.read_configuration()
+            with timer.phase('config'):
+                config = Core.read_configuration()
             if config is None or not config.has_nonempty_config():
                 self.tprint('\nError! Enigma config file not found %s' % (Core.get_config_file_path()))
                 self.tprint(' Cannot continue. Have you run init already?\n')
                 return self.return_code(2)
 
-            eb_cfg = Core.get_default_eb_config()
-            reg_svc = Registration(email=config.email, eb_config=eb_cfg, config=config, debug=self.args.debug,
-                                   audit=self.audit, sysconfig=self.syscfg)
             domains = config.domains
             if domains is not None and isinstance(domains, types.ListType) and len(domains) > 0:
                 self.tprint('\nDomains currently registered: ')
@@ -1645,8 +1704,22 @@ class Installer(InstallerBase):
             if config.ejbca_hostname is not None:
                 self.tprint('Domain used for your PKI system: %s\n' % config.ejbca_hostname)
 
+            # Fast path - nothing changed since the last registration, no EB API call needed
+            if not self.args.force:
+                with timer.phase('fingerprint'):
+                    is_unchanged = self.onboot_fingerprint_matches(config)
+                if is_unchanged:
+                    self.tprint('IP address and DNS records did not change, domain registration is up to date')
+                    return self.return_code(0)
+
+            with timer.phase('load'):
+                eb_cfg = Core.get_default_eb_config()
+                reg_svc = Registration(email=config.email, eb_config=eb_cfg, config=config, debug=self.args.debug,
+                                       audit=self.audit, sysconfig=self.syscfg)
+
             # Identity load (keypair)
-            ret = reg_svc.load_identity()
+            with timer.phase('identity'):
+                ret = reg_svc.load_identity()
             if ret != 0:
                 self.tprint('\nError! Could not load identity (key-pair is missing)')
                 return self.return_code(3)
@@ -1667,7 +1740,8 @@ class Installer(InstallerBase):
             new_config = config
             while not domain_is_ok:
                 try:
-                    new_config = reg_svc.refresh_domain()
+                    with timer.phase('refresh'):
+                        new_config = reg_svc.refresh_domain()
 
                     if new_config.domains is not None and len(new_config.domains) > 0:
                         domain_is_ok = True
@@ -1707,7 +1781,8 @@ class Installer(InstallerBase):
                 self.tprint('\nThe PKI instance must be redeployed. This operations is not yet supported, please email '
                             'to support@enigmabridge.com')
 
-            Core.write_configuration(new_config)
+            with timer.phase('write'):
+                Core.write_configuration(new_config)
             return self.return_code(0)
 
         except Exception as ex:
@@ -1715,8 +1790,56 @@ class Installer(InstallerBase):
             self.audit.audit_exception(ex)
             self.tprint('Exception in the domain registration process, cannot continue.')
 
+        finally:
+            logger.debug('Onboot phases: %s' % json.dumps(timer.to_json()))
+            self.audit.audit_evt('onboot-timing', phases=timer.to_json())
+
         return self.return_code(1)
 
+    def onboot_fingerprint_matches(self, config):
+        """
+        Cheap local check whether the domain registration is still valid, nothing is sent to the EB API.
+        Primary interface address, public IP and DNS A record of the domain have to match the last registration.
+        :param config:
+        :return: True if the registration is up to date
+        """
+        if config.domains is None or len(config.domains) == 0:
+            return False
+
+        last_ip = config.last_ipv4_private if config.is_private_network else config.last_ipv4
+        if last_ip is None:
+            return False
+
+        local_ip = util.get_primary_ipv4()
+        if config.last_ipv4_private is not None and local_ip != config.last_ipv4_private:
+            logger.debug('Primary interface address changed: %s -> %s' % (config.last_ipv4_private, local_ip))
+            return False
+
+        if not config.is_private_network:
+            public_ip = self.onboot_public_ip()
+            if public_ip != config.last_ipv4:
+                logger.debug('Public IP changed: %s -> %s' % (config.last_ipv4, public_ip))
+                return False
+
+        dns_ips = util.resolve_ipv4(config.domains[0])
+        if last_ip not in dns_ips:
+            logger.debug('DNS record of %s does not match: %s, %s' % (config.domains[0], last_ip, dns_ips))
+            return False
+
+        self.audit.audit_evt('onboot-unchanged', ip=last_ip, local_ip=local_ip, domain=config.domains[0])
+        return True
+
+    def onboot_public_ip(self):
+        """
+        Public IP without contacting external services.
+        Instance metadata (link-local, cached for the process), then the public IP cache.
+        :return:
+        """
+        metadata = ec2meta.get_instance_metadata()
+        if metadata is not None and metadata.get(InfoLoader.AMI_KEY_PUBLIC_IP) is not None:
+            return metadata[InfoLoader.AMI_KEY_PUBLIC_IP]
+        return InfoLoader(audit=self.audit, sysconfig=self.syscfg).load_public_ip_cache()
+
     def do_change_hostname(self, line):
         """Changes hostname of the EJBCA installation"""
         self.tprint('This functionality is not yet implemented')
@@ -1828,9 +1951,7 @@ class Installer(InstallerBase):
 
     def le_check_port(self, ip=None, letsencrypt=None, critical=False, one_attempt=False):
         if ip is None:
-            info = InfoLoader(audit=self.audit, sysconfig=self.syscfg)
-            info.load()
-            ip = info.ami_public_ip
+            ip = self.get_info_loader().ami_public_ip
 
         self.last_le_port_open = False
         if letsencrypt is None:
@@ -2068,6 +2189,8 @@ class Installer(InstallerBase):
                             help='enables debug mode')
         parser.add_argument('--verbose', dest='verbose', action='store_const', const=True,
                             help='enables verbose mode')
+        parser.add_argument('--startup-profile', dest='startup_profile', action='store_const', const=True,
+                            help='reports import time of the modules loaded (ebstall-cli only)')
         parser.add_argument('--force', dest='force', action='store_const', const=True, default=False,
                             help='forces some action (e.g., certificate renewal)')
         parser.add_argument('--email', dest='email', default=None,
@@ -2109,6 +2232,9 @@ class Installer(InstallerBase):
         parser.add_argument('--no-os-update', dest='no_os_update', action='store_const', const=True, default=False,
                             help='Disable OS udpate during the installation')
 
+        parser.add_argument('--plan', dest='plan', action='store_const', const=True, default=False,
+                            help='Update only prints the merged update transactions, nothing is executed')
+
         parser.add_argument('--yes', dest='yes', action='store_const', const=True,
                             help='answers yes to the questions in the non-interactive mode, mainly for init')
 
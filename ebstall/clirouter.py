@@ -8,11 +8,7 @@ import types
 import traceback
 import logging
 import coloredlogs
-from core import Core
-from config import Config, EBSettings
-from cli import main as main_pki
-from clivpn import main as main_vpn
-from clivpn import VpnInstaller
+from startupprofile import ImportProfiler
 
 
 logger = logging.getLogger(__name__)
@@ -42,6 +38,7 @@ class CliRouter(object):
         Loads EB settings as a part of the init. If settings exist already, the backup is performed.
         :return:
         """
+        from core import Core
         try:
             self.eb_cfg = Core.get_default_eb_config()
             self.config = Core.read_configuration()
@@ -55,6 +52,7 @@ class CliRouter(object):
         Initializes argument parser object
         :return: parser
         """
+        from clivpn import VpnInstaller
         vpn_installer = VpnInstaller()
         parser = vpn_installer.init_argparse()
 
@@ -101,17 +99,30 @@ class CliRouter(object):
 
         if install_type == 'pki':
             logger.debug('Choosing PKI mode')
+            from cli import main as main_pki
             main_pki()
         elif install_type == 'vpn':
             logger.debug('Choosing VPN mode')
+            from clivpn import main as main_vpn
             main_vpn()
         else:
             raise ValueError('Unknown mode')
 
 
 def main():
-    app = CliRouter()
-    app.app_main()
+    # Installers are imported after the profiler is installed so their import time is measured
+    profiler = None
+    if '--startup-profile' in sys.argv:
+        profiler = ImportProfiler()
+        profiler.install()
+
+    try:
+        app = CliRouter()
+        app.app_main()
+    finally:
+        if profiler is not None:
+            profiler.uninstall()
+            profiler.report()
 
 
 if __name__ == '__main__':
@@ -7,21 +7,22 @@ import traceback
 
 import coloredlogs
 
-from ebstall.deployers import dnsmasq
-from ebstall.deployers import nginx
-from ebstall.deployers import openvpn
-from ebstall.deployers import php
-from ebstall.deployers import supervisord
-from ebstall.deployers import vpnauth
-from ebstall.deployers import pspace_web
-from ebstall.deployers import nextcloud
-from ebstall.deployers import ejabberd
-
 import errors
 import util
 from cli import Installer
 from core import Core
 
+# Deployers are imported on the first use
+dnsmasq = util.LazyImport('ebstall.deployers.dnsmasq')
+nginx = util.LazyImport('ebstall.deployers.nginx')
+openvpn = util.LazyImport('ebstall.deployers.openvpn')
+php = util.LazyImport('ebstall.deployers.php')
+supervisord = util.LazyImport('ebstall.deployers.supervisord')
+vpnauth = util.LazyImport('ebstall.deployers.vpnauth')
+pspace_web = util.LazyImport('ebstall.deployers.pspace_web')
+nextcloud = util.LazyImport('ebstall.deployers.nextcloud')
+ejabberd = util.LazyImport('ebstall.deployers.ejabberd')
+
 logger = logging.getLogger(__name__)
 coloredlogs.install(level=logging.ERROR)
 
@@ -134,15 +135,10 @@ class VpnInstaller(Installer):
         self.init_services()
         self.ejbca.update_installation()
 
-    def init_test_ports_pre_install_res(self, host=None, *args, **kwargs):
-        failed_ports = Installer.init_test_ports_pre_install_res(self, host, *args, **kwargs)
-
-        vpn_ok = util.test_port_routable(host=host, port=openvpn.OpenVpn.PORT_NUM, tcp=openvpn.OpenVpn.PORT_TCP,
-                                         with_server=True, audit=self.audit)
-        if not vpn_ok:
-            failed_ports.append(util.Port(port=openvpn.OpenVpn.PORT_NUM, tcp=openvpn.OpenVpn.PORT_TCP,
-                                          service='OpenVPN'))
-        return failed_ports
+    def init_test_ports_pre_install_list(self, *args, **kwargs):
+        ports = Installer.init_test_ports_pre_install_list(self, *args, **kwargs)
+        ports.append(util.Port(port=openvpn.OpenVpn.PORT_NUM, tcp=openvpn.OpenVpn.PORT_TCP, service='OpenVPN'))
+        return ports
 
     def init_print_intro(self):
         """
@@ -405,21 +401,27 @@ class VpnInstaller(Installer):
             return self.return_code(res)
 
         # VPN server - install, configure, enable, start
+        # Service restarts are merged, executed when a step needs the service or at the end
         self.tprint('\n\nInstalling & configuring VPN server')
-        self.init_vpn()
-        self.init_supervisord()
-        self.init_dnsmasq()
-        self.init_nginx()
-        self.init_vpnauth()
-        self.init_privatespace_web()
-
-        if self.is_cloud_enabled():
-            self.init_nextcloud()
-            self.init_ejabberd()
-
-        self.init_nginx_start()
-        self.init_vpn_start()
-        self.init_dnsmasq_restart()
+        with self.syscfg.deferred_svc():
+            self.init_vpn()
+            self.init_supervisord()
+            self.init_dnsmasq()
+            self.init_nginx()
+            self.init_vpnauth()
+            self.init_privatespace_web()
+
+            if self.is_cloud_enabled():
+                self.init_nextcloud()
+                self.init_ejabberd()
+
+            self.init_nginx_start()
+            self.init_vpn_start()
+            self.init_dnsmasq_restart()
+
+            ret = self.syscfg.flush_svc()
+            if ret != 0:
+                raise errors.SetupError('Error in starting services')
 
         self.tprint('')
         self.init_celebrate()
@@ -542,7 +544,7 @@ class VpnInstaller(Installer):
             logger.warning('EJBCA disabled, VPN wont be started')
             return
 
-        ret = self.ovpn.switch(restart=True)
+        ret = self.ovpn.restart_if_changed()
         if ret != 0:
             raise errors.SetupError('Cannot start openvpn server')
 
@@ -616,7 +618,7 @@ class VpnInstaller(Installer):
         Can start it after it is properly configured & PHP is installed
         :return: 
         """
-        ret = self.nginx.switch(restart=True)
+        ret = self.nginx.restart_if_changed()
         if ret != 0:
             raise errors.SetupError('Error in starting nginx daemon')
 
@@ -633,7 +635,7 @@ class VpnInstaller(Installer):
         if ret != 0:
             raise errors.SetupError('Error with setting php to start after boot')
 
-        ret = self.php.switch(restart=True)
+        ret = self.php.restart_if_changed()
         if ret != 0:
             raise errors.SetupError('Error in starting php daemon')
 
@@ -27,3 +27,6 @@ SETTINGS_FOLDERS = ['/etc/enigma', '/usr/local/etc/enigma', '/opt/enigmabridge/e
 
 PROVISIONING_SERVERS = ['privatespace-deploy.enigmabridge.com']
 
+PKG_INVENTORY_SNAPSHOT = '/var/cache/enigma/pkg-inventory.json'
+UPDATE_SPECS_CACHE = '/var/cache/enigma/update-specs.json'
+PUBLIC_IP_CACHE = '/var/cache/enigma/public-ip.json'
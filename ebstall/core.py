@@ -77,11 +77,17 @@ class Core(object):
         util.make_or_verify_dir(CONFIG_DIR, mode=0o755)
 
         conf_name = Core.get_config_file_path()
-        with os.fdopen(os.open(conf_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as config_file:
-            config_file.write('// \n')
-            config_file.write('// Config file generated: %s\n' % datetime.now().strftime("%Y-%m-%d %H:%M"))
-            config_file.write('// \n')
-            config_file.write(cfg.to_string() + "\n\n")
+        body = cfg.to_string() + "\n\n"
+
+        # Generated header contains the time, compare just the configuration body
+        if os.path.exists(conf_name):
+            with open(conf_name, 'r') as fh:
+                old_lines = fh.read().split('\n', 3)
+            if len(old_lines) == 4 and old_lines[3] == body:
+                return conf_name
+
+        header = '// \n// Config file generated: %s\n// \n' % datetime.now().strftime("%Y-%m-%d %H:%M")
+        util.write_if_changed(conf_name, header + body, chmod=0o600, backup=False)
         return conf_name
 
     @staticmethod
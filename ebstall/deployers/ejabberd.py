@@ -219,6 +219,7 @@ class Ejabberd(object):
 
         # Configuring via cmdline - we need it running
         self.switch(start=True)
+        self.sysconfig.flush_svc(self.get_svc_map())
 
         time.sleep(1)
         self._config_server()
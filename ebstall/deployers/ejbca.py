@@ -9,10 +9,10 @@ import sys
 import time
 from datetime import datetime
 
-import requests
 import types
 
 import ebstall.errors as errors
+import ebstall.httpclient as httpclient
 import ebstall.osutil as osutil
 import ebstall.util as util
 import letsencrypt
@@ -1125,9 +1125,12 @@ class Ejbca(object):
         :param filename:
         :return:
         """
-        r = requests.get(url, stream=True, timeout=15)
-        with open(filename, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
+        r = httpclient.get(url, stream=True)
+        try:
+            with open(filename, 'wb') as f:
+                shutil.copyfileobj(r.raw, f)
+        finally:
+            r.close()
 
         return filename
 
@@ -1189,7 +1192,7 @@ class Ejbca(object):
                 for attempt in range(attempts):
                     try:
                         self.audit.audit_evt('prov-ejbca', url=url)
-                        res = requests.get(url=url, timeout=15)
+                        res = httpclient.get(url=url)
                         res.raise_for_status()
                         js = res.json()
 
@@ -1235,16 +1238,18 @@ class Ejbca(object):
     # Actions
     #
 
-    def undeploy(self):
+    def undeploy(self, reload=True):
         """
         Undeploys EJBCA installation
+        :param reload: reload JBoss after undeploy, False if the caller restarts it anyway
         :return:
         """
         self.jboss_undeploy()
         self.jboss_undeploy_fs()
         self.jboss_remove_datasource()
         self.jboss_rollback_ejbca()
-        self.jboss_reload()
+        if reload:
+            self.jboss_reload()
 
     def undeploy_fast(self):
         """
@@ -1282,7 +1287,7 @@ class Ejbca(object):
         # 2. Undeploy original EJBCA, make JBoss clean
         if self.print_output:
             print("\n - Preparing environment for application server")
-        self.undeploy()
+        self.undeploy(reload=False)  # restart follows
 
         # Restart jboss - so we can delete database after removal
         if self.print_output:
@@ -1402,14 +1407,9 @@ class Ejbca(object):
         Allow port on the firewall
         :return:
         """
-        ret = self.sysconfig.allow_port(port=self.PORT, tcp=True)
-        if ret != 0:
-            return ret
-
-        ret = self.sysconfig.allow_port(port=self.PORT_PUBLIC, tcp=True)
-        if ret != 0:
-            return ret
-
+        with self.sysconfig.firewall_batch():
+            self.sysconfig.allow_port(port=self.PORT, tcp=True)
+            self.sysconfig.allow_port(port=self.PORT_PUBLIC, tcp=True)
         return 0
 
 
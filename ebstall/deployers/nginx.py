@@ -21,6 +21,61 @@ __author__ = 'dusanklinec'
 logger = logging.getLogger(__name__)
 
 
+class NginxParseCache(object):
+    """
+    Parsed and round-trip verified nginx configurations, keyed by the content hash.
+    Parsing is the expensive part, the same text is parsed and verified only once per process.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.parsed = collections.OrderedDict()  # hash -> parser output, plain lists
+        self.verified = set()  # hashes of texts surviving dump / load / dump
+
+    @staticmethod
+    def key(cfg_txt):
+        return util.sha1(cfg_txt, as_hex=True)
+
+    def loads(self, cfg_txt):
+        """
+        Parses the config text, returns a fresh UnspacedList on each call so callers can modify it
+        :param cfg_txt: 
+        :return: 
+        """
+        key = self.key(cfg_txt)
+        parsed = self.parsed.get(key)
+        if parsed is None:
+            parsed = nginxparser_eb.NginxParser(cfg_txt).as_list()
+            self._store(key, parsed)
+        return nginxparser_eb.UnspacedList(parsed)
+
+    def _store(self, key, parsed):
+        self.parsed[key] = parsed
+        while len(self.parsed) > self.max_entries:
+            self.parsed.popitem(last=False)
+
+    def verify(self, dumped):
+        """
+        Checks the dumped configuration survives load and dump again.
+        Verified texts are remembered, re-verification of the same text is a hash lookup.
+        :param dumped: 
+        :return: True if the round-trip is stable
+        """
+        key = self.key(dumped)
+        if key in self.verified:
+            return True
+
+        parsed2 = self.loads(dumped)
+        dumped2 = nginxparser_eb.dumps(parsed2)
+        if dumped.strip() != dumped2.strip():
+            return False
+
+        self.verified.add(key)
+        return True
+
+
+_PARSE_CACHE = NginxParseCache()
+
+
 class Nginx(object):
     """
     Nginx server
@@ -49,6 +104,9 @@ class Nginx(object):
         self.config_root = None
         self.config_dirty = False
 
+        # Configuration changed since the last restart
+        self.config_changed = False
+
         self.internal_addresses = []  # Addresses allowed to access private.space
         self.cert_dir = None  # certificate directory of LetsEncrypt
 
@@ -88,9 +146,10 @@ class Nginx(object):
         logger.debug('Parsing nginx config: %s' % cfg_path)
         with open(cfg_path, 'r') as fh:
             cfg_txt = fh.read()
-            cfg_raw = nginxparser_eb.loads(cfg_txt)
-            self.config_root = nginxparser_eb.build_model(cfg_raw)
-            self._config_parse_test(cfg_txt)
+
+        cfg_raw = _PARSE_CACHE.loads(cfg_txt)
+        self.config_root = nginxparser_eb.build_model(cfg_raw)
+        self._config_parse_test(cfg_txt)
 
     def _rebuild_cfg_model(self):
         """
@@ -105,6 +164,7 @@ class Nginx(object):
         """
         Tests if the config processor understood the configuration well
         by dumping, loading and dumping again. Dumps have to match.
+        Round-trip of the same text is verified only once, see NginxParseCache.
         :return: 
         """
 
@@ -112,11 +172,20 @@ class Nginx(object):
         if cfg_txt is not None and cfg_txt.strip() != dumped.strip():
             raise errors.EnvError('Nginx config file was not parsed properly')
 
-        parsed2 = nginxparser_eb.loads(dumped)
-        dumped2 = nginxparser_eb.dumps(parsed2)
-        if dumped.strip() != dumped2.strip():
+        if not _PARSE_CACHE.verify(dumped):
             raise errors.EnvError('Nginx config file was not parsed properly')
 
+    def _remove_from_model(self, element):
+        """
+        Removes the element from the raw config and from its parent model node in place.
+        Other model nodes stay valid, no model rebuild is needed.
+        :param element: 
+        :return: 
+        """
+        nginxparser_eb.remove_from_model(self.config_root, element, rebuild=False)
+        element.parent.value.remove(element)
+        self.config_dirty = True
+
     def load_html_root(self):
         """
         Loads path to the default root
@@ -164,7 +233,9 @@ class Nginx(object):
         # Try sites enabled
         if self.site_enabled is not None:
             cand_path = os.path.join(self.site_enabled, 'default')
-            util.safely_remove(cand_path)
+            if os.path.exists(cand_path):
+                util.safely_remove(cand_path)
+                self.config_changed = True
 
         # Inspect main config file, find for default servers
         servers = nginxparser_eb.find_in_model(self.config_root, ['http', 'server'])
@@ -178,7 +249,7 @@ class Nginx(object):
 
             # Remove from parent raw cfg.
             if is_default_server:
-                self.config_root = nginxparser_eb.remove_from_model(self.config_root, server)
+                self._remove_from_model(server)
 
         self.flush_config()
 
@@ -263,45 +334,45 @@ class Nginx(object):
             raise errors.SetupError('HTTP include dir is none')
 
         path = os.path.join(self.http_include, 'default.conf')
-        util.safely_remove(path)
-
         hostnames = self._get_default_server_hostnames(include_local=True, le_domains=True)
-        with util.safe_open(path, mode='w', chmod=0o644) as fh:
-            fh.write('server { \n')
-            fh.write('  listen 80 default_server;\n')
-            fh.write('  listen [::]:80 default_server;\n')
-            fh.write('  root %s;\n' % self.html_root)
-            fh.write('  server_name _ %s;\n\n' % (' '.join(hostnames)))
-
-            # Well known serving from the directory
-            fh.write('  location /.well-known {\n')
-            fh.write('    allow all;\n')
-            fh.write('  }\n\n')
-
-            # If we have https, do the redirect to https variant
-            if self._check_certificates():
-                fh.write('  location / {\n')
-                fh.write('    return 302 https://%s$request_uri;\n' % self.hostname)
-                fh.write('  }\n\n')
-
-            else:
-                # Root
-                fh.write('  location / {\n')
-                fh.write('    try_files $uri $uri/ =404;\n')
-                fh.write('    allow   127.0.0.1;\n')
-                for internal in self.internal_addresses:
-                    fh.write('    allow   %s;\n' % internal)
-
-                fh.write('    deny    all;\n')
-                fh.write('  }\n')
-
-                # PHP files
-                fh.write('  location ~ \.php$ {\n')
-                fh.write('    ' + ('\n    '.join(self._conf_php_file_handler())))
-                fh.write('\n')
-                fh.write('  }\n\n')
-
-            fh.write('}\n\n')
+        buf = []
+        buf.append('server { \n')
+        buf.append('  listen 80 default_server;\n')
+        buf.append('  listen [::]:80 default_server;\n')
+        buf.append('  root %s;\n' % self.html_root)
+        buf.append('  server_name _ %s;\n\n' % (' '.join(hostnames)))
+
+        # Well known serving from the directory
+        buf.append('  location /.well-known {\n')
+        buf.append('    allow all;\n')
+        buf.append('  }\n\n')
+
+        # If we have https, do the redirect to https variant
+        if self._check_certificates():
+            buf.append('  location / {\n')
+            buf.append('    return 302 https://%s$request_uri;\n' % self.hostname)
+            buf.append('  }\n\n')
+
+        else:
+            # Root
+            buf.append('  location / {\n')
+            buf.append('    try_files $uri $uri/ =404;\n')
+            buf.append('    allow   127.0.0.1;\n')
+            for internal in self.internal_addresses:
+                buf.append('    allow   %s;\n' % internal)
+
+            buf.append('    deny    all;\n')
+            buf.append('  }\n')
+
+            # PHP files
+            buf.append('  location ~ \.php$ {\n')
+            buf.append('    ' + ('\n    '.join(self._conf_php_file_handler())))
+            buf.append('\n')
+            buf.append('  }\n\n')
+
+        buf.append('}\n\n')
+
+        self.config_changed |= util.write_if_changed(path, ''.join(buf), chmod=0o644, backup=False)
 
     def _install_secure_default_server(self):
         """
@@ -313,54 +384,54 @@ class Nginx(object):
             return
 
         path = os.path.join(self.http_include, 'default-tls.conf')
-        util.safely_remove(path)
-
         hostnames = self._get_default_server_hostnames(include_local=False)
         cert_path, key_path = self._get_tls_paths()
-        with util.safe_open(path, mode='w', chmod=0o644) as fh:
-            fh.write('server { \n')
-            fh.write('  listen 443 ssl;\n')
-            fh.write('  listen [::]:443 ssl;\n')
-            fh.write('  root %s;\n' % self.html_root)
-            fh.write('  server_name _ %s;\n\n' % (' '.join(hostnames)))
-            fh.write('  ssl_certificate %s;\n' % cert_path)
-            fh.write('  ssl_certificate_key %s;\n\n' % key_path)
-
-            fh.write('  add_header X-Content-Type-Options nosniff;\n')
-            fh.write('  add_header X-Frame-Options "SAMEORIGIN";\n')
-            fh.write('  add_header X-XSS-Protection "1; mode=block";\n')
-            fh.write('  add_header X-Robots-Tag none;\n')
-            fh.write('  add_header X-Download-Options noopen;\n')
-            fh.write('  add_header X-Permitted-Cross-Domain-Policies none;\n\n')
-
-            # LetsEncrypt validation
-            fh.write('  location /.well-known {\n')
-            fh.write('      allow all;\n')
-            fh.write('   }\n\n')
-
-            # Root access only for internals
-            fh.write('  location / {\n')
-            fh.write('    try_files $uri $uri/ /index.php?$query_string;\n')
-            fh.write('    allow   127.0.0.1;\n')
-
-            for internal in self.internal_addresses:
-                fh.write('    allow   %s;\n' % internal)
-
-            fh.write('  }\n\n')
-
-            # PHP files
-            fh.write('  location ~ \.php$ {\n')
-            fh.write('    ' + ('\n    '.join(self._conf_php_file_handler())))
-            fh.write('\n')
-            fh.write('  }\n\n')
-
-            # Robots
-            fh.write('  location /robots.txt {\n')
-            fh.write('    allow all;\n')
-            fh.write('    log_not_found off;\n')
-            fh.write('    access_log off;\n')
-            fh.write('  }\n')
-            fh.write('}\n\n')
+        buf = []
+        buf.append('server { \n')
+        buf.append('  listen 443 ssl;\n')
+        buf.append('  listen [::]:443 ssl;\n')
+        buf.append('  root %s;\n' % self.html_root)
+        buf.append('  server_name _ %s;\n\n' % (' '.join(hostnames)))
+        buf.append('  ssl_certificate %s;\n' % cert_path)
+        buf.append('  ssl_certificate_key %s;\n\n' % key_path)
+
+        buf.append('  add_header X-Content-Type-Options nosniff;\n')
+        buf.append('  add_header X-Frame-Options "SAMEORIGIN";\n')
+        buf.append('  add_header X-XSS-Protection "1; mode=block";\n')
+        buf.append('  add_header X-Robots-Tag none;\n')
+        buf.append('  add_header X-Download-Options noopen;\n')
+        buf.append('  add_header X-Permitted-Cross-Domain-Policies none;\n\n')
+
+        # LetsEncrypt validation
+        buf.append('  location /.well-known {\n')
+        buf.append('      allow all;\n')
+        buf.append('   }\n\n')
+
+        # Root access only for internals
+        buf.append('  location / {\n')
+        buf.append('    try_files $uri $uri/ /index.php?$query_string;\n')
+        buf.append('    allow   127.0.0.1;\n')
+
+        for internal in self.internal_addresses:
+            buf.append('    allow   %s;\n' % internal)
+
+        buf.append('  }\n\n')
+
+        # PHP files
+        buf.append('  location ~ \.php$ {\n')
+        buf.append('    ' + ('\n    '.join(self._conf_php_file_handler())))
+        buf.append('\n')
+        buf.append('  }\n\n')
+
+        # Robots
+        buf.append('  location /robots.txt {\n')
+        buf.append('    allow all;\n')
+        buf.append('    log_not_found off;\n')
+        buf.append('    access_log off;\n')
+        buf.append('  }\n')
+        buf.append('}\n\n')
+
+        self.config_changed |= util.write_if_changed(path, ''.join(buf), chmod=0o644, backup=False)
 
     def add_php_index(self):
         """
@@ -389,27 +460,29 @@ class Nginx(object):
             raise errors.EnvError('Nginx HTTP include directory does not exist')
 
         php_path = os.path.join(self.http_include, 'php-fpm.conf')
-        util.safely_remove(php_path)
-        with util.safe_open(php_path, mode='w', chmod=0o755) as fh:
-            fh.write('# PHP upstream handler\n')
-            fh.write('upstream php-handler {\n')
-            fh.write('  server 127.0.0.1:9000;\n')
-            fh.write('  #server unix:/var/run/php5-fpm.sock;\n')
-            fh.write('}\n\n')
+        buf = []
+        buf.append('# PHP upstream handler\n')
+        buf.append('upstream php-handler {\n')
+        buf.append('  server 127.0.0.1:9000;\n')
+        buf.append('  #server unix:/var/run/php5-fpm.sock;\n')
+        buf.append('}\n\n')
+
+        self.config_changed |= util.write_if_changed(php_path, ''.join(buf), chmod=0o755, backup=False)
 
     def flush_config(self):
         """
         Flushed dirty nginx configuration to the file
-        :return: 
+        :return: True if the file content changed
         """
         if not self.config_dirty:
-            return
+            return False
 
         dump = nginxparser_eb.dumps(self.config_root.raw)
-        with open(self.get_config_file_path(), 'w') as fh:
-            fh.write(dump)
+        changed = util.write_if_changed(self.get_config_file_path(), dump, backup=False)
 
         self.config_dirty = False
+        self.config_changed |= changed
+        return changed
 
     def templatize_file(self, file_path, ignore_not_found=False):
         """
@@ -441,17 +514,18 @@ class Nginx(object):
         """
         Loads configuration, base init. 
         Loads variables needed by other modules, e.g., PHP (nginx user).
-        :return: 
+        :return: True if the configuration file was changed
         """
         self._load_nginx_config()
         self._load_config_vars()
         self._load_dirs()
-        self.flush_config()
+        return self.flush_config()
 
     def configure_server(self):
         """
         Perform base server configuration.
-        :return: True if file was changed
+        Configuration files are rewritten only if their content changes.
+        :return: True if any configuration file was changed since the last restart
         """
 
         self.load_html_root()
@@ -473,7 +547,7 @@ class Nginx(object):
             shutil.rmtree(self.html_root)
 
         util.make_or_verify_dir(self.html_root)
-        return 0
+        return self.config_changed
 
     #
     # Installation
@@ -516,4 +590,18 @@ class Nginx(object):
         """
         return self.sysconfig.switch_svc(self.get_svc_map(), start=start, stop=stop, restart=restart)
 
+    def restart_if_changed(self):
+        """
+        Restarts the service only if the configuration changed or the service is not running.
+        :return: 0 on success or no-op
+        """
+        if not self.config_changed and self.sysconfig.svc_is_running(self.get_svc_map()):
+            logger.debug('Nginx configuration unchanged, restart skipped')
+            return 0
+
+        ret = self.switch(restart=True)
+        if ret == 0:
+            self.config_changed = False
+        return ret
+
 
@@ -13,16 +13,19 @@ import types
 import ebstall.osutil as osutil
 import shutil
 import pkg_resources
+from ebstall.lineconfig import LineConfig, CONFIG_LINE_BLANK, CONFIG_LINE_COMMENT, CONFIG_LINE_CMD_COMMENT, \
+    CONFIG_LINE_CMD
 
 
 __author__ = 'dusanklinec'
 logger = logging.getLogger(__name__)
 
 
-CONFIG_LINE_BLANK = 0
-CONFIG_LINE_COMMENT = 1
-CONFIG_LINE_CMD_COMMENT = 2
-CONFIG_LINE_CMD = 3
+RE_CONFIG_COMMENT = re.compile(r'^\s*#.*')
+RE_CONFIG_CMD_COMMENT = re.compile(r'^\s*;.*')
+RE_CONFIG_CMD = re.compile(r'^\s*(;)?\s*([a-zA-Z0-9\-_]+)(\s+.+?)?(\s*(#|;).+)??$')
+RE_CONFIG_PAIR = re.compile(r'^\s*(;)?\s*<([a-zA-Z0-9\-_]+)>(\s+.+?)?</([a-zA-Z0-9\-_]+)>$', re.MULTILINE | re.DOTALL)
+RE_CONFIG_PAIR_OPEN = re.compile(r'^\s*(;)?\s*<([a-zA-Z0-9\-_]+)>(\s+.+?)?$')
 
 
 class ConfigLine(object):
@@ -78,15 +81,13 @@ class ConfigLine(object):
             cl.ltype = CONFIG_LINE_BLANK
             return cl
 
-        cmt_match = re.match(r'^\s*#.*', line)
+        cmt_match = RE_CONFIG_COMMENT.match(line)
         if cmt_match is not None:
             cl.ltype = CONFIG_LINE_COMMENT
             return cl
 
-        cmd_cmt_match = re.match(r'^\s*;.*', line)
-        cmd_match = re.match(r'^\s*(;)?\s*([a-zA-Z0-9\-_]+)(\s+.+?)?(\s*(#|;).+)??$', line)
-        cmd_pair = re.match(r'^\s*(;)?\s*<([a-zA-Z0-9\-_]+)>(\s+.+?)?</([a-zA-Z0-9\-_]+)>$', line, re.MULTILINE | re.DOTALL)
-
+        # Paired tag, e.g., <ca>...</ca>, possibly multi-line
+        cmd_pair = RE_CONFIG_PAIR.match(line) if '<' in line else None
         if cmd_pair:
             cl.ltype = CONFIG_LINE_CMD if cmd_pair.group(1) is None else CONFIG_LINE_CMD_COMMENT
             open_tag = cmd_pair.group(2)
@@ -100,6 +101,8 @@ class ConfigLine(object):
             cl.paired = True
             return cl
 
+        cmd_cmt_match = RE_CONFIG_CMD_COMMENT.match(line)
+        cmd_match = RE_CONFIG_CMD.match(line)
         if cmd_match is None and cmd_cmt_match is None:
             logger.debug('VPN unrecognized config line: %s' % line)
             cl.ltype = CONFIG_LINE_COMMENT
@@ -116,26 +119,18 @@ class ConfigLine(object):
         return cl
 
 
-class OpenVpnConfig(object):
+class OpenVpnConfig(LineConfig):
     """
     Parses OpenVPN configuration, allows to modify the configuration and save changes back to the file.
     """
 
     def __init__(self, config_path=None, static_config=None, audit=None, newline='\n', *args, **kwargs):
+        super(OpenVpnConfig, self).__init__()
         self.config_path = config_path
         self.static_config = static_config
-        self.config_data = None
-        self.config_modified = False
         self.audit = audit
         self.newline = newline
 
-    def load(self):
-        """
-        Loads the config file
-        :return:
-        """
-        self.config_data = self.load_config_file_lines()
-
     def load_config_file_lines(self):
         """
         Loads config file to a string
@@ -177,7 +172,7 @@ class OpenVpnConfig(object):
                 continue
 
             # Check for opening tag
-            pair_match = re.match(r'^\s*(;)?\s*<([a-zA-Z0-9\-_]+)>(\s+.+?)?$', cline)
+            pair_match = RE_CONFIG_PAIR_OPEN.match(cline) if '<' in cline else None
             if pair_match is not None:
                 if paired_tag is not None:
                     raise ValueError('Parse error, unclosed previously opened tag: %s' % paired_tag)
@@ -207,116 +202,14 @@ class OpenVpnConfig(object):
 
         return config
 
-    def set_config_value(self, cmd, values=None, remove=False, under_directive=None):
+    def new_line(self, cmd, params):
         """
-        Sets command to the specified value in the configuration file.
-        Loads file from the disk if server_config_data is None (file was not yet loaded).
-
-        Supports also multicommands - one command with more values.
-
-        Modifies self.config_data, self.config_modified
+        Creates a new active command line
         :param cmd:
-        :param values: single value or array of values for multi-commands (e.g., push).
-                       None & remove -> remove all commands. Otherwise just commands with the given values are removed.
-        :param remove: if True, configuration command is removed
-        :param under_directive: if specified, command is placed under specified directive, if exists
-        :return: True if file was modified
+        :param params:
+        :return:
         """
-        # If file is not loaded - load
-        if self.config_data is None:
-            self.config_data = self.load_config_file_lines()
-
-        # default position - end of the config file
-        last_cmd_idx = len(self.config_data) - 1
-        file_changed = False
-        single_directive = False  # no parameter given
-
-        if values is None:
-            single_directive = True
-            values = [None]
-
-        if not isinstance(values, types.ListType):
-            values = [values]
-
-        values_set = [False] * len(values)
-        for idx, cfg in enumerate(self.config_data):
-            if cfg.ltype not in [CONFIG_LINE_CMD, CONFIG_LINE_CMD_COMMENT]:
-                continue
-
-            if under_directive is not None and util.equals_any(cfg.cmd, under_directive):
-                last_cmd_idx = idx
-
-            if cfg.cmd != cmd:
-                continue
-
-            # Only commands of interest here
-            last_cmd_idx = idx
-            is_desired_value = cfg.params in values
-            is_desired_value |= remove and (util.is_empty(values) or single_directive)
-            is_desired_value |= not remove and (util.is_empty(values) or single_directive) and util.is_empty(cfg.params)
-            value_idx = values.index(cfg.params) if not remove and cfg.params in values else None
-
-            if is_desired_value:
-                if cfg.ltype == CONFIG_LINE_CMD and not remove:
-                    # Command is already set to the same value. File not modified.
-                    # Cannot quit yet, has to comment out other values
-                    if value_idx is not None:
-                        if not values_set[value_idx]:
-                            values_set[value_idx] = True
-                        else:
-                            cfg.ltype = CONFIG_LINE_CMD_COMMENT
-                            file_changed = True
-                    pass
-
-                elif cfg.ltype == CONFIG_LINE_CMD:
-                    # Remove command - comment out
-                    cfg.ltype = CONFIG_LINE_CMD_COMMENT
-                    file_changed = True
-
-                elif cfg.ltype == CONFIG_LINE_CMD_COMMENT and remove:
-                    # Remove && comment - leave as it is
-                    # Cannot quit yet, has to comment out other values
-                    pass
-
-                else:
-                    # CONFIG_LINE_CMD_COMMENT and not remove.
-                    # Just change the type to active value - switch from comment to command
-                    # Cannot quit yet, has to comment out other values
-                    do_change = True
-                    if value_idx is not None:
-                        if not values_set[value_idx]:
-                            values_set[value_idx] = True
-                        else:
-                            do_change = False
-
-                    if do_change:
-                        cfg.ltype = CONFIG_LINE_CMD
-                        file_changed = True
-
-            elif cfg.ltype == CONFIG_LINE_CMD and not remove:
-                # Same command, but different value - comment this out
-                # If remove is True, only desired values were removed.
-                cfg.ltype = CONFIG_LINE_CMD_COMMENT
-                file_changed = True
-
-        if remove:
-            self.config_modified |= file_changed
-            return file_changed
-
-        # Add those commands not set in the cycle above
-        ctr = 0
-        for idx, cval in enumerate(values):
-            if values_set[idx]:
-                continue
-
-            cl = ConfigLine(idx=None, raw=None, ltype=CONFIG_LINE_CMD, cmd=cmd, params=cval)
-            self.config_data.insert(last_cmd_idx + 1 + ctr, cl)
-
-            ctr += 1
-            file_changed = True
-
-        self.config_modified |= file_changed
-        return file_changed
+        return ConfigLine(idx=None, raw=None, ltype=CONFIG_LINE_CMD, cmd=cmd, params=params)
 
     def dump(self):
         """
@@ -338,14 +231,13 @@ class OpenVpnConfig(object):
         if not force and not self.config_modified:
             return False
 
-        fh, backup = util.safe_create_with_backup(self.config_path, mode='w', chmod=0o644, backup_suffix='.backup')
-        with fh:
-            for cl in self.config_data:
-                fh.write(cl.raw + self.newline)
+        content = ''.join([cl.raw + self.newline for cl in self.config_data])
+        changed = util.write_if_changed(self.config_path, content, chmod=0o644, backup_suffix='.backup')
+        if changed:
             self.audit.audit_file_write(self.config_path)
 
-        self.config_modified = False  # reset after flush
-        return True
+        self.reset_dirty()  # reset after flush
+        return changed
 
 
 class OpenVpn(object):
@@ -372,6 +264,9 @@ class OpenVpn(object):
         self.client_config_path = client_config_path
         self.client_config_path_windows = None
 
+        # Server configuration / key material changed since the last restart
+        self.config_changed = False
+
     #
     # Settings
     #
@@ -502,6 +397,7 @@ class OpenVpn(object):
             return 0
 
         cmd = 'sudo openssl dhparam -out \'%s\' %d' % (dh_file, size)
+        self.config_changed = True
         return self.sysconfig.exec_shell(cmd, write_dots=self.write_dost)
 
     def configure_crl(self, crl_path):
@@ -512,7 +408,7 @@ class OpenVpn(object):
         """
         self.init_server_config()
         self.server_config.set_config_value('crl-verify', crl_path, remove=crl_path is None, under_directive='key')
-        return self.server_config.update_config_file()
+        return self._update_server_config()
 
     def configure_server(self):
         """
@@ -521,38 +417,43 @@ class OpenVpn(object):
         """
         port, tcp = self.get_port()
         self.init_server_config()
-        self.server_config.set_config_value('port', '%s' % port)
-        self.server_config.set_config_value('proto', 'udp' if not tcp else 'tcp')
-        self.server_config.set_config_value('server', '%s %s' % (self.get_ip_net(), self.get_ip_mask()))
-
-        self.server_config.set_config_value('dh', 'dh2048.pem')
-        self.server_config.set_config_value('ca', 'ca.crt')
-        self.server_config.set_config_value('cert', 'server.crt')
-        self.server_config.set_config_value('key', 'server.key')
-
-        self.server_config.set_config_value('status', 'openvpn-status.log 10')
-        self.server_config.set_config_value('client-to-client')
-        self.server_config.set_config_value('persist-tun')  # needed to chroot the process
-        self.server_config.set_config_value('comp-lzo', remove=True)
-        self.server_config.set_config_value('keepalive', '2 20')
-        self.server_config.set_config_value('topology', 'subnet')
-        self.server_config.set_config_value('sndbuf', '0')
-        self.server_config.set_config_value('rcvbuf', '0')
+        remove = ['comp-lzo']
+
+        values = [
+            ('port', '%s' % port),
+            ('proto', 'udp' if not tcp else 'tcp'),
+            ('server', '%s %s' % (self.get_ip_net(), self.get_ip_mask())),
+
+            ('dh', 'dh2048.pem'),
+            ('ca', 'ca.crt'),
+            ('cert', 'server.crt'),
+            ('key', 'server.key'),
+
+            ('status', 'openvpn-status.log 10'),
+            ('client-to-client', None),
+            ('persist-tun', None),  # needed to chroot the process
+            ('keepalive', '2 20'),
+            ('topology', 'subnet'),
+            ('sndbuf', '0'),
+            ('rcvbuf', '0'),
+        ]
 
         # Protocol dependent
         if tcp:
-            self.server_config.set_config_value('replay-window', remove=True)
+            remove.append('replay-window')
         else:
-            self.server_config.set_config_value('replay-window', '2048')
+            values.append(('replay-window', '2048'))
 
-        self.server_config.set_config_value('cipher', 'AES-256-CBC')
-        self.server_config.set_config_value('auth', 'SHA256')
+        values += [
+            ('cipher', 'AES-256-CBC'),
+            ('auth', 'SHA256'),
 
-        # This can be enabled after certificates are generated with exact usage.
-        # self.server_config.set_config_value('remote-cert-tls', 'server')
+            # This can be enabled after certificates are generated with exact usage.
+            # ('remote-cert-tls', 'server'),
 
-        self.server_config.set_config_value('user', self.get_user())
-        self.server_config.set_config_value('group', self.get_group())
+            ('user', self.get_user()),
+            ('group', self.get_group()),
+        ]
 
         # Use internal DNS to prevent DNS leaks
         push_values = ['"dhcp-option DNS %s"' % self.get_ip_vpn_server(),
@@ -565,14 +466,15 @@ class OpenVpn(object):
                        # '"route 0.0.0.0 0.0.0.0"',
                        # '"route-metric 512"'
                        ]
-        self.server_config.set_config_value('push', push_values)
+        values.append(('push', push_values))
+        self.server_config.set_many(values, remove=remove)
 
         # Store VPN config to config
         self.config.vpn_server_addr = self.get_ip_vpn_server()
         self.config.vpn_net_addr = self.get_ip_net()
         self.config.vpn_net_size = self.get_ip_net_size()
 
-        return self.server_config.update_config_file()
+        return self._update_server_config()
 
     def configure_server_scripts(self, connect=None, disconnect=None, up=None, down=None):
         """
@@ -586,14 +488,26 @@ class OpenVpn(object):
         script_names = ['client-connect', 'client-disconnect', 'up', 'down']
         script_values = [connect, disconnect, up, down]
 
+        values = []
+        remove = []
         for idx, script_value in enumerate(script_values):
             script_name = script_names[idx]
             if script_value is None:
-                self.server_config.set_config_value(script_name, remove=True)
+                remove.append(script_name)
             else:
-                self.server_config.set_config_value(script_name, '"%s"' % script_value)
+                values.append((script_name, '"%s"' % script_value))
 
-        return self.server_config.update_config_file()
+        self.server_config.set_many(values, remove=remove)
+        return self._update_server_config()
+
+    def _update_server_config(self):
+        """
+        Flushes the server configuration, tracks whether the running server needs a restart
+        :return: True if file was changed
+        """
+        changed = self.server_config.update_config_file()
+        self.config_changed |= changed
+        return changed
 
     def _configure_client_win(self):
         """
@@ -652,6 +566,7 @@ class OpenVpn(object):
         Stores CA, Cert, Key to the storage and fixes permissions
         :return:
         """
+        self.config_changed = True
         shutil.copy(ca, self.get_config_dir_subfile('ca.crt'))
         shutil.copy(cert, self.get_config_dir_subfile('server.crt'))
 
@@ -713,6 +628,21 @@ class OpenVpn(object):
         """
         return self.sysconfig.switch_svc(self.get_svc_map(), start=start, stop=stop, restart=restart)
 
+    def restart_if_changed(self):
+        """
+        Restarts the server only if the configuration changed or the server is not running.
+        No-op reconfiguration keeps the running server untouched.
+        :return: 0 on success or no-op
+        """
+        if not self.config_changed and self.sysconfig.svc_is_running(self.get_svc_map()):
+            logger.debug('OpenVPN configuration unchanged, restart skipped')
+            return 0
+
+        ret = self.switch(restart=True)
+        if ret == 0:
+            self.config_changed = False
+        return ret
+
     def setup_os(self):
         """
         Configures OS
@@ -724,13 +654,10 @@ class OpenVpn(object):
         if ret != 0:
             return ret
 
-        # Set the masquerade
-        ret = self.sysconfig.masquerade(self.get_ip_net(), self.get_ip_net_size())
-        if ret != 0:
-            return ret
-
-        # Allow port on the firewall
+        # Set the masquerade, allow port on the firewall - applied at once
         port, tcp = self.get_port()
-        ret = self.sysconfig.allow_port(port=port, tcp=tcp)
-        return ret
+        with self.sysconfig.firewall_batch():
+            self.sysconfig.masquerade(self.get_ip_net(), self.get_ip_net_size())
+            self.sysconfig.allow_port(port=port, tcp=tcp)
+        return 0
 
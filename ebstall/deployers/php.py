@@ -13,95 +13,152 @@ import types
 import ebstall.osutil as osutil
 import shutil
 import pkg_resources
+from ebstall.lineconfig import LineConfig, CONFIG_LINE_BLANK, CONFIG_LINE_COMMENT, CONFIG_LINE_CMD_COMMENT, \
+    CONFIG_LINE_CMD
 
 
 __author__ = 'dusanklinec'
 logger = logging.getLogger(__name__)
 
 
-class IniParser(object):
+RE_INI_LINE = re.compile(r'^\s*(;)?\s*([^\s=;#\[][^=]*?)\s*=\s*(.*?)\s*$')
+
+
+class IniLine(object):
+    """
+    One INI file line. Unmodified lines keep the original text.
+    """
+    def __init__(self, raw=None, ltype=None, cmd=None, params=None):
+        self._raw = raw
+        self.ltype = ltype
+        self.cmd = cmd
+        self.params = params
+
+    def __repr__(self):
+        return 'IniLine(ltype=%r, cmd=%r, params=%r, raw=%r)' % (self.ltype, self.cmd, self.params, self._raw)
+
+    @property
+    def raw(self):
+        """
+        Original line or the line built from the key and the value if modified
+        :return: 
+        """
+        if self._raw is not None:
+            return self._raw
+        res = '%s = %s' % (self.cmd, self.params)
+        return res if self.ltype == CONFIG_LINE_CMD else ';' + res
+
+    @raw.setter
+    def raw(self, val):
+        self._raw = val
+
+    @classmethod
+    def build(cls, line):
+        cl = cls(raw=line)
+        if len(line.strip()) == 0:
+            cl.ltype = CONFIG_LINE_BLANK
+            return cl
+
+        match = RE_INI_LINE.match(line)
+        if match is None:
+            cl.ltype = CONFIG_LINE_COMMENT
+            return cl
+
+        cl.ltype = CONFIG_LINE_CMD if match.group(1) is None else CONFIG_LINE_CMD_COMMENT
+        cl.cmd = match.group(2)
+        cl.params = match.group(3)
+        return cl
+
+
+class IniParser(LineConfig):
     """
     Very simple INI file parser
     """
     def __init__(self, file_name=None, file_data=None):
-        self.data = None
+        super(IniParser, self).__init__()
         self.file_name = file_name
         self.file_data = file_data
-        self.dirty = False
 
-    def load(self):
+    @property
+    def data(self):
+        """
+        Config file lines
+        :return: 
+        """
+        if self.config_data is None:
+            self.load()
+        return [x.raw for x in self.config_data]
+
+    @property
+    def dirty(self):
+        return self.config_modified
+
+    def load_config_file_lines(self):
+        """
+        Loads config file lines
+        :return: 
+        """
         if self.file_data is not None:
             if isinstance(self.file_data, types.ListType):
-                self.data = self.file_data
+                lines = self.file_data
             else:
-                self.data = self.file_data.split('\n')
-            return
+                lines = self.file_data.split('\n')
+            return [IniLine.build(x) for x in lines]
 
         if self.file_name is not None:
             with open(self.file_name, 'r') as fh:
-                self.data = [x.strip() for x in fh]
-            return
+                return [IniLine.build(x.strip()) for x in fh]
 
         raise ValueError('No data to process')
 
+    def new_line(self, cmd, params):
+        return IniLine(ltype=CONFIG_LINE_CMD, cmd=cmd, params=params)
+
+    def mark_dirty(self, cfg):
+        cfg.raw = None  # rebuild the modified line
+        super(IniParser, self).mark_dirty(cfg)
+
     def set_value(self, key, value, remove=False):
         """
-        Sets the config value
+        Sets the config value.
+        The first active key is changed, otherwise the key is added after the commented out one / to the end.
         :param key: 
         :param value: 
-        :param remove: 
+        :param remove: comments out the key
         :return: 
         """
-        if self.data is None:
-            self.load()
-
-        new_cfg = '%s = %s' % (key, value)
-        last_idx = len(self.data) - 1
-
-        for idx, line in enumerate(self.data):
-            if re.match(r'^;\s*%s' % re.escape(key), line):
-                last_idx = idx
-
-            elif re.match(r'^\s*%s' % re.escape(key), line):
-                self.data[idx] = new_cfg
-                self.dirty = True
-                return
-
-        self.data.insert(last_idx+1, new_cfg)
-        self.dirty = True
+        value = '%s' % value
+        lines = self.get_lines(key)
+        active = [x for x in lines if x.ltype == CONFIG_LINE_CMD]
 
-    def get_value(self, key):
-        """
-        Returns config value for the given key
-        :param key: 
-        :return: 
-        """
-        if self.data is None:
-            self.load()
+        if remove:
+            for cfg in active:
+                self.set_line_type(cfg, CONFIG_LINE_CMD_COMMENT)
+            return
 
-        for idx, line in enumerate(self.data):
-            if re.match(r'^\s*%s' % re.escape(key), line):
-                parts = line.split('=', 1)
-                if len(parts) == 1:
-                    return None
+        if len(active) > 0:
+            if active[0].params != value:
+                active[0].params = value
+                self.mark_dirty(active[0])
+            return
 
-                return parts[1].strip()
-        return None
+        pos = None if len(lines) == 0 else self._get_index()[key][-1] + 1
+        self.insert_line(pos, self.new_line(key, value))
 
     def flush(self):
         """
         If dirty & using file, flushes changes to the file
-        :return: 
+        :return: True if the file content changed
         """
-        if not self.dirty:
-            return
+        if not self.config_modified:
+            return False
 
         if self.file_name is None:
-            return None
+            return False
 
-        with open(self.file_name, 'w') as fh:
-            fh.write('\n'.join(self.data))
-        self.dirty = False
+        changed = util.write_if_changed(self.file_name, '\n'.join(self.data), backup=False)
+        self.reset_dirty()
+        return changed
 
 
 class Php(object):
@@ -117,6 +174,9 @@ class Php(object):
         self.audit = audit
         self.user = 'nginx'
 
+        # Configuration changed since the last restart
+        self.config_changed = False
+
     #
     # Installation
     #
@@ -166,13 +226,13 @@ class Php(object):
         # Change CGI path info
         main_ini = IniParser(file_name=self.CONFIG_FILE)
         main_ini.set_value('cgi.fix_pathinfo', '1')
-        main_ini.flush()
+        self.config_changed |= main_ini.flush()
 
         # Change user for nginx
         www_ini = IniParser(file_name=self.CONFIG_FPM_WWW)
         www_ini.set_value('user', self.user)
         www_ini.set_value('group', self.user)
-        www_ini.flush()
+        self.config_changed |= www_ini.flush()
 
         # Get directory for sessions, create & setup if non-existing
         spath = www_ini.get_value('session.save_path')
@@ -225,3 +285,17 @@ class Php(object):
         """
         return self.sysconfig.switch_svc(self.get_svc_map(), start=start, stop=stop, restart=restart)
 
+    def restart_if_changed(self):
+        """
+        Restarts the service only if the configuration changed or the service is not running.
+        :return: 0 on success or no-op
+        """
+        if not self.config_changed and self.sysconfig.svc_is_running(self.get_svc_map()):
+            logger.debug('PHP configuration unchanged, restart skipped')
+            return 0
+
+        ret = self.switch(restart=True)
+        if ret == 0:
+            self.config_changed = False
+        return ret
+
@@ -162,12 +162,20 @@ class Supervisord(object):
     # API
     #
 
+    def ctl_barrier(self):
+        """
+        supervisorctl needs the daemon running, executes its deferred start / restart
+        :return:
+        """
+        return self.sysconfig.flush_svc(self.get_svc_map())
+
     def ctl_refresh(self):
         """
         supervisorctl reread
         supervisorctl update
         :return:
         """
+        self.ctl_barrier()
         ret = self.sysconfig.exec_shell('sudo %s supervisorctl reread' % self.sysconfig.epiper_path())
         if ret != 0:
             raise errors.SetupError('Could not exec supervisorctl reread')
@@ -180,6 +188,7 @@ class Supervisord(object):
         """
         :return:
         """
+        self.ctl_barrier()
         ret = self.sysconfig.exec_shell('sudo %s supervisorctl add %s'
                                         % (self.sysconfig.epiper_path(), util.escape_shell(cmd)))
         if ret != 0:
@@ -189,6 +198,7 @@ class Supervisord(object):
         """
         :return:
         """
+        self.ctl_barrier()
         ret = self.sysconfig.exec_shell('sudo %s supervisorctl start %s'
                                         % (self.sysconfig.epiper_path(), util.escape_shell(cmd)))
         if ret != 0:
@@ -198,6 +208,7 @@ class Supervisord(object):
         """
         :return:
         """
+        self.ctl_barrier()
         ret = self.sysconfig.exec_shell('sudo %s supervisorctl stop %s'
                                         % (self.sysconfig.epiper_path(), util.escape_shell(cmd)))
         if ret != 0:
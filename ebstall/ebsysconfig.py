@@ -20,9 +20,13 @@ import psutil
 import math
 import consts
 import osutil
+import iptables
 from audit import AuditManager
 import logging
 import traceback
+import json
+import collections
+import contextlib
 import pkg_resources
 
 from ebstall import errors
@@ -37,6 +41,22 @@ FIREWALL_FIREWALLD = 'firewalld'
 FIREWALL_UFW = 'ufw'
 FIREWALLS = [FIREWALL_FIREWALLD, FIREWALL_UFW, FIREWALL_IPTABLES]
 
+INVENTORY_RPM = 'rpm'
+INVENTORY_YUM = 'yum'
+INVENTORY_DPKG = 'dpkg'
+INVENTORY_BACKENDS = [INVENTORY_RPM, INVENTORY_YUM, INVENTORY_DPKG]
+
+# Safety net - yum silent for this long without the transaction table answered is terminated
+YUM_IDLE_TIMEOUT = 60.0
+
+SVC_START = 'start'
+SVC_STOP = 'stop'
+SVC_RESTART = 'restart'
+SVC_RELOAD = 'reload'
+
+# systemd unit states are cached for this long, our own service changes invalidate the cache
+SVC_STATE_TTL = 10.0
+
 
 class YumUpdateStatus(object):
     """
@@ -48,6 +68,8 @@ class YumUpdateStatus(object):
         self.feeder = None
         self.p = None
         self.watcher = None
+        self.parser = osutil.YumTranscriptParser()
+        self.answer = None
 
     def reset(self):
         self.acc = []
@@ -55,6 +77,8 @@ class YumUpdateStatus(object):
         self.feeder = None
         self.p = None
         self.watcher = None
+        self.parser = osutil.YumTranscriptParser()
+        self.answer = None
 
     def append(self, x):
         self.acc.append(x)
@@ -72,6 +96,30 @@ class YumUpdateStatus(object):
         return ''.join(self.acc)
 
 
+class FirewallBatch(object):
+    """
+    Firewall changes collected in the SysConfig.firewall_batch() block.
+    The delta against the current firewall state is applied at once when the block ends.
+    """
+    def __init__(self):
+        self.ports = []  # (port, tcp)
+        self.masquerades = []  # (net, net_size)
+
+    def add_port(self, port, tcp=True):
+        if (port, tcp) not in self.ports:
+            self.ports.append((port, tcp))
+
+    def add_masquerade(self, net, net_size):
+        if (net, net_size) not in self.masquerades:
+            self.masquerades.append((net, net_size))
+
+    def get_ports(self, tcp=True):
+        return [port for port, cur_tcp in self.ports if cur_tcp == tcp]
+
+    def is_empty(self):
+        return len(self.ports) == 0 and len(self.masquerades) == 0
+
+
 class SysConfig(object):
     """Basic system configuration object"""
     SYSCONFIG_BACKUP = '/root/ebstall.backup'
@@ -80,10 +128,6 @@ class SysConfig(object):
     REGEX_IPTABLES_MASQUERADE = re.compile(r'.*?(?:^|\b|\s)-j\s+MASQUERADE(?:$|\b|\s).*')
     REGEX_IPTABLES_SRC = r'.*?(?:^|\b|\s)-s\s+%s(?:$|\b|\s).*'
     REGEX_IPTABLES_OUTPUT_DEV = re.compile(r'.*?(?:^|\b|\s)-o\s+([a-zA-Z0-9_]+)(?:$|\b|\s).*')
-    REGEX_IPTABLES_INPUT = re.compile(r'.*?(?:^|\b|\s)-A\s+INPUT(?:$|\b|\s).*')
-    REGEX_IPTABLES_PROTO = r'.*?(?:^|\b|\s)-p\s+%s(?:$|\b|\s).*'
-    REGEX_IPTABLES_PORT = r'.*?(?:^|\b|\s)--dport\s+%d(?:$|\b|\s).*'
-    REGEX_IPTABLES_ACCEPT = re.compile(r'.*?(?:^|\b|\s)-j\s+ACCEPT(?:$|\b|\s).*')
 
     def __init__(self, print_output=False, audit=None, *args, **kwargs):
         self.print_output = print_output
@@ -103,6 +147,25 @@ class SysConfig(object):
         # Not to repeat the same enable action
         self.firewall_enabled = {}
 
+        # Installed packages inventory cache, keyed on the package database state.
+        # If inventory_snapshot is set, the inventory is persisted there among runs.
+        self.inventory_snapshot = None
+        self.inventory_backend = None
+        self._inventory = None
+        self._inventory_fingerprint = None
+
+        # Deferred service actions, service -> action, in the order of the first request.
+        # Collected inside deferred_svc() block, flushed at barriers.
+        self.svc_defer = 0
+        self.svc_queue = collections.OrderedDict()
+
+        # systemd unit -> (query time, LoadState, ActiveState, SubState)
+        self.svc_state_ttl = SVC_STATE_TTL
+        self._svc_state_cache = {}
+
+        # Open firewall_batch() transaction
+        self._fw_batch = None
+
     #
     # Execution
     #
@@ -477,32 +540,94 @@ class SysConfig(object):
 
     def _get_systemd_svc_state(self, svc):
         """
-        Runs systemctl and obtains service state
+        Obtains systemd service state, from the state cache or systemctl
         :param svc:
         :return: (loadState, activeState)
         """
-        cmd = 'sudo systemctl show ' + svc
+        load_state, active_state, sub_state = self.get_systemd_svc_states([svc])[svc]
+        return load_state, active_state
+
+    def get_systemd_svc_states(self, svcs):
+        """
+        Returns states of the systemd units. Units not in the state cache are queried
+        by one systemctl show call.
+        :param svcs: list of unit names
+        :return: unit -> (loadState, activeState, subState)
+        """
+        cur_time = time.time()
+        res = {}
+        to_query = []
+        for svc in svcs:
+            cached = self._svc_state_cache.get(svc)
+            if cached is not None and cur_time - cached[0] <= self.svc_state_ttl:
+                res[svc] = cached[1:]
+            elif svc not in to_query:
+                to_query.append(svc)
+
+        if len(to_query) == 0:
+            return res
+
+        states = self._query_systemd_svc_states(to_query)
+        for svc in to_query:
+            state = states.get(svc, (None, None, None))
+            res[svc] = state
+            if state[0] is not None:
+                self._svc_state_cache[svc] = (cur_time, ) + tuple(state)
+        return res
+
+    def _query_systemd_svc_states(self, svcs):
+        """
+        Runs systemctl show -p LoadState,ActiveState,SubState for all units at once.
+        Properties of units are separated by an empty line, in the order of the arguments.
+        :param svcs:
+        :return: unit -> (loadState, activeState, subState)
+        """
+        cmd = 'sudo systemctl show -p LoadState,ActiveState,SubState %s' \
+              % ' '.join([util.escape_shell(x) for x in svcs])
         ret, stdout, stderr = self.cli_cmd_sync(cmd, shell=True)
 
         if ret != 0:
             logger.debug('Error executing systemctl show command, code: %d' % ret)
-            return None, None
-
-        load_state = None
-        active_state = None
+            return {}
+
+        if isinstance(stdout, types.ListType):
+            stdout = ''.join(stdout)
+
+        blocks = []
+        cur = {}
+        for line in [x.strip() for x in stdout.split('\n')]:
+            if len(line) == 0:
+                if len(cur) > 0:
+                    blocks.append(cur)
+                cur = {}
+                continue
 
-        lines = [x.strip() for x in stdout.split('\n')]
-        for line in lines:
-            parts = line.split('=', 2)
+            parts = line.split('=', 1)
             if len(parts) < 2:
                 continue
+            key, val = [x.strip().lower() for x in parts]
+            cur[key] = val
 
-            cmd, val = [x.strip().lower() for x in parts]
-            if cmd == 'loadstate':
-                load_state = val
-            if cmd == 'activestate':
-                active_state = val
-        return load_state, active_state
+        if len(cur) > 0:
+            blocks.append(cur)
+
+        if len(blocks) != len(svcs):
+            logger.debug('Unexpected systemctl show output, units: %d, blocks: %d' % (len(svcs), len(blocks)))
+            return {}
+
+        return dict((svc, (blk.get('loadstate'), blk.get('activestate'), blk.get('substate')))
+                    for svc, blk in zip(svcs, blocks))
+
+    def invalidate_svc_state(self, svc=None):
+        """
+        Drops cached unit state
+        :param svc: unit name, None for all units
+        :return:
+        """
+        if svc is None:
+            self._svc_state_cache.clear()
+        else:
+            self._svc_state_cache.pop(svc, None)
 
     def enable_svc(self, svcmap, enable=True):
         """
@@ -523,34 +648,79 @@ class SysConfig(object):
         else:
             raise OSError('Cannot enable service in this OS')
 
+        self.invalidate_svc_state(svc)
         return self.exec_shell(cmd_exec)
 
-    def switch_svc(self, svcmap, start=None, stop=None, restart=None):
+    def switch_svc(self, svcmap, start=None, stop=None, restart=None, reload=None, defer=None):
         """
-        Changes service state - starts, stops or restarts the service
+        Changes service state - starts, stops, restarts or reloads the service.
+        Inside deferred_svc() block start / restart / reload is queued and merged with other
+        queued actions of the service, executed at the next barrier. Stop is executed right away.
+
         :param svcmap: service name definition. string or service map init system -> service name.
         :param start:
         :param stop:
         :param restart:
+        :param reload:
+        :param defer: queue the action, None for the deferred_svc() block setting
         :return:
         """
         check = 0
         check += 1 if start is not None else 0
         check += 1 if stop is not None else 0
         check += 1 if restart is not None else 0
+        check += 1 if reload is not None else 0
         if check != 1:
-            raise ValueError('Exactly one of start, stop, restart has to be set to True')
+            raise ValueError('Exactly one of start, stop, restart, reload has to be set to True')
 
         start_system = self.get_start_system()
         svc = self._get_svc_desc(svcmap, start_system)
-        cmd_exec = None
 
-        change_state = 'start'
+        change_state = SVC_START
         if stop:
-            change_state = 'stop'
+            change_state = SVC_STOP
         elif restart:
-            change_state = 'restart'
+            change_state = SVC_RESTART
+        elif reload:
+            change_state = SVC_RELOAD
+
+        if defer is None:
+            defer = self.svc_defer > 0
 
+        queued = self.svc_queue.get(svc)
+        if queued is not None:
+            change_state = SVC_STOP if change_state == SVC_STOP else self._merge_svc_action(queued, change_state)
+
+        if defer and change_state != SVC_STOP:
+            logger.debug('Service %s %s deferred' % (svc, change_state))
+            self.svc_queue[svc] = change_state  # keeps the position of the first request
+            return 0
+
+        if queued is not None:
+            logger.debug('Service %s queued %s replaced by %s' % (svc, queued, change_state))
+            del self.svc_queue[svc]
+        return self._switch_svc(svc, change_state)
+
+    @staticmethod
+    def _merge_svc_action(action1, action2):
+        """
+        Merges two actions requested on the same service, restart subsumes start and reload.
+        :param action1:
+        :param action2:
+        :return:
+        """
+        if action1 == action2:
+            return action1
+        return SVC_RESTART
+
+    def _switch_svc(self, svc, change_state):
+        """
+        Executes the service state change
+        :param svc: service name
+        :param change_state:
+        :return:
+        """
+        start_system = self.get_start_system()
         if start_system == osutil.START_INITD:
             cmd_exec = 'sudo /etc/init.d/%s %s' % (svc, change_state)
         elif start_system == osutil.START_SYSTEMD:
@@ -558,8 +728,50 @@ class SysConfig(object):
         else:
             raise OSError('Cannot enable service in this OS')
 
+        self.invalidate_svc_state(svc)
         return self.exec_shell(cmd_exec)
 
+    def flush_svc(self, svcmap=None):
+        """
+        Barrier - executes queued service actions.
+        :param svcmap: flush only this service, None for all queued services
+        :return: 0 on success, the first non-zero return code otherwise
+        """
+        if svcmap is None:
+            services = list(self.svc_queue.keys())
+        else:
+            services = [self._get_svc_desc(svcmap, self.get_start_system())]
+
+        ret = 0
+        for svc in services:
+            action = self.svc_queue.pop(svc, None)
+            if action is None:
+                continue
+
+            cur_ret = self._switch_svc(svc, action)
+            if cur_ret != 0:
+                logger.error('Service %s %s failed with code: %s' % (svc, action, cur_ret))
+                ret = cur_ret if ret == 0 else ret
+        return ret
+
+    @contextlib.contextmanager
+    def deferred_svc(self):
+        """
+        Service actions requested in the block are queued and merged,
+        flushed at the end of the outermost block.
+
+        with syscfg.deferred_svc():
+            ...
+        :return:
+        """
+        self.svc_defer += 1
+        try:
+            yield self
+        finally:
+            self.svc_defer -= 1
+            if self.svc_defer == 0:
+                self.flush_svc()
+
     def svc_status(self, svcmap):
         """
         Returns True if the service is running.
@@ -567,26 +779,42 @@ class SysConfig(object):
         :param svcmap: service name definition. string or service map init system -> service name.
         :return: (found, running)
         """
+        return self.svc_status_many([svcmap])[0]
+
+    def svc_status_many(self, svcmaps):
+        """
+        Status of more services, systemd units are queried at once.
+        :param svcmaps: list of service name definitions
+        :return: list of (found, running)
+        """
         start_system = self.get_start_system()
-        svc = self._get_svc_desc(svcmap, start_system)
+        svcs = [self._get_svc_desc(x, start_system) for x in svcmaps]
+
+        # Caller needs the actual state, execute the pending actions first
+        for svc in svcs:
+            self.flush_svc(svc)
 
         if start_system == osutil.START_INITD:
-            initd_path = os.path.join('/etc/init.d/', svc)
-            if not os.path.exists(initd_path):
-                return False, False
+            res = []
+            for svc in svcs:
+                initd_path = os.path.join('/etc/init.d/', svc)
+                if not os.path.exists(initd_path):
+                    res.append((False, False))
+                    continue
 
-            cmd_exec = 'sudo %s status' % initd_path
-            ret = self.exec_shell(cmd_exec, shell=True)
-            return True, ret == 0
+                cmd_exec = 'sudo %s status' % initd_path
+                ret = self.exec_shell(cmd_exec, shell=True)
+                res.append((True, ret == 0))
+            return res
 
         elif start_system == osutil.START_SYSTEMD:
-            load_state, active_state = self._get_systemd_svc_state(svc)
-            loaded = load_state == 'loaded'
-            if not loaded:
-                return False, False
-
-            active = active_state == 'active'
-            return True, active
+            states = self.get_systemd_svc_states(svcs)
+            res = []
+            for svc in svcs:
+                load_state, active_state, sub_state = states[svc]
+                loaded = load_state == 'loaded'
+                res.append((loaded, loaded and active_state == 'active'))
+            return res
 
         else:
             raise OSError('Cannot enable service in this OS')
@@ -637,6 +865,7 @@ class SysConfig(object):
         self.audit.audit_file_write(svc_path)
 
         # Set service to start after boot
+        self.invalidate_svc_state()
         ret = self.exec_shell('sudo systemctl daemon-reload')
         if ret != 0:
             raise errors.SetupError('Error: Could not reload systemctl, code: %s\n' % ret)
@@ -756,21 +985,158 @@ class SysConfig(object):
 
     def get_installed_packages(self):
         """
-        Returns list of installed packages
+        Returns list of installed packages.
+        The inventory is cached until the package database changes (mtime, size).
         :return: 
         """
+        fingerprint = self.get_inventory_fingerprint()
+        if fingerprint is not None and fingerprint == self._inventory_fingerprint:
+            logger.debug('Installed packages inventory cache hit')
+            return list(self._inventory)
+
+        packages = None
+        if fingerprint is not None:
+            packages = self._load_inventory_snapshot(fingerprint)
+
+        if packages is None:
+            packages = self._list_installed_packages()
+            if fingerprint is not None:
+                self._save_inventory_snapshot(fingerprint, packages)
+
+        if fingerprint is not None:
+            self._inventory = packages
+            self._inventory_fingerprint = fingerprint
+        return list(packages)
+
+    def get_inventory_fingerprint(self):
+        """
+        Returns fingerprint of the package database state, None if cannot be determined
+        :return: 
+        """
+        return osutil.get_package_db_fingerprint(self.get_packager())
+
+    def invalidate_installed_packages(self):
+        """
+        Drops the cached installed packages inventory
+        :return: 
+        """
+        self._inventory = None
+        self._inventory_fingerprint = None
+
+    def _load_inventory_snapshot(self, fingerprint):
+        """
+        Loads installed packages from the on-disk snapshot if it matches the package database fingerprint
+        :param fingerprint: 
+        :return: list of packages or None if the snapshot is disabled / missing / stale
+        """
+        if self.inventory_snapshot is None or not os.path.exists(self.inventory_snapshot):
+            return None
+
+        try:
+            with open(self.inventory_snapshot, 'r') as fh:
+                js = json.load(fh)
+            if js.get('fingerprint') != fingerprint:
+                logger.debug('Installed packages snapshot is stale')
+                return None
+
+            return [osutil.PackageInfo.from_json(x) for x in js['packages']]
+
+        except Exception as e:
+            logger.debug('Could not load installed packages snapshot: %s' % e)
+            return None
+
+    def _save_inventory_snapshot(self, fingerprint, packages):
+        """
+        Stores installed packages to the on-disk snapshot, if enabled
+        :param fingerprint: 
+        :param packages: 
+        :return: 
+        """
+        if self.inventory_snapshot is None:
+            return
+
+        js = collections.OrderedDict()
+        js['fingerprint'] = fingerprint
+        js['packages'] = [x.to_json() for x in packages]
+
+        try:
+            util.make_or_verify_dir(os.path.dirname(self.inventory_snapshot), mode=0o755)
+            util.write_if_changed(self.inventory_snapshot, json.dumps(js), chmod=0o644, backup=False)
+
+        except Exception as e:
+            logger.debug('Could not store installed packages snapshot: %s' % e)
+
+    def _list_installed_packages(self):
+        """
+        Lists installed packages using the inventory backends.
+        Backends are tried in order, the first successful one is used.
+        :return: 
+        """
+        backends = self._get_inventory_backends()
+        last_exc = None
+        for backend in backends:
+            try:
+                packages = getattr(self, '_inventory_%s' % backend)()
+                logger.debug('Installed packages listed by %s backend: %s' % (backend, len(packages)))
+                return packages
+
+            except Exception as e:
+                logger.debug('Inventory backend %s failed: %s' % (backend, e))
+                self.audit.audit_exception(e, process='pkg-inventory', backend=backend)
+                last_exc = e
+
+        if last_exc is not None:
+            raise last_exc
+        raise OSError('Unknown packager, could not get list of packages')
+
+    def _get_inventory_backends(self):
+        """
+        Returns installed packages inventory backends to try for the current OS
+        :return: list of backend names
+        """
+        if self.inventory_backend is not None:
+            return [self.inventory_backend]
+
         pkg = self.get_packager()
         if pkg == osutil.PKG_YUM:
-            ret, out, err = self.cli_cmd_sync('sudo yum list installed', shell=True)
-            if ret != 0:
-                raise errors.SetupError('Could not list all versions')
+            return [INVENTORY_RPM, INVENTORY_YUM]
+        elif pkg == osutil.PKG_APT:
+            return [INVENTORY_DPKG]
+        return []
 
-            return osutil.get_yum_packages(out)
+    def _inventory_rpm(self):
+        """
+        Lists installed packages with a single rpm query
+        :return: 
+        """
+        cmd = 'rpm -qa --queryformat %s' % util.escape_shell(osutil.RPM_QUERYFORMAT)
+        p = self.exec_shell_open(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        sout, serr = p.communicate()
 
-        elif pkg == osutil.PKG_APT:
-            raise OSError('Not implemented yet')
-        else:
-            raise OSError('Unknown packager, could not get list of packages')
+        self.audit.audit_exec(cmd, retcode=p.returncode, stderr=serr)
+        if p.returncode != 0:
+            raise errors.SetupError('Could not list installed packages')
+
+        return osutil.get_rpm_packages(sout)
+
+    def _inventory_yum(self):
+        """
+        Lists installed packages with yum list installed
+        :return: 
+        """
+        ret, out, err = self.cli_cmd_sync('sudo yum list installed', shell=True)
+        if ret != 0:
+            raise errors.SetupError('Could not list all versions')
+
+        return osutil.get_yum_packages(out)
+
+    def _inventory_dpkg(self):
+        """
+        Reads installed packages directly from the dpkg status database
+        :return: 
+        """
+        self.audit.audit_file_read(osutil.DPKG_STATUS_FILE)
+        return osutil.get_dpkg_packages(osutil.DPKG_STATUS_FILE)
 
     def _package_to_yum_update(self, pkg):
         """
@@ -822,10 +1188,12 @@ class SysConfig(object):
 
         return cli_switches
 
-    def update_packages(self, packages=None, packages_var=None, security=None, bugfix=None,
-                        skip_broken=None, excludes=None, enable_repos=None, disable_repos=None):
+    def plan_update_packages(self, packages=None, packages_var=None, security=None, bugfix=None,
+                             skip_broken=None, excludes=None, enable_repos=None, disable_repos=None):
         """
-        Updates system with the yum update
+        Resolves yum commands the update_packages() would run, without running them.
+        If particular packages are given, those already installed in the same or higher version are filtered out
+        and the commands are yum update-to chunks, maximally 200 packages on one line.
         :param packages: 
         :param packages_var: 
         :param security: 
@@ -834,7 +1202,7 @@ class SysConfig(object):
         :param excludes: 
         :param enable_repos: 
         :param disable_repos: 
-        :return: 
+        :return: (commands, packages) where packages is PackageSet of allowed packages or None for general update
         """
         cli_switches = self._yum_update_cli_build(security=security, bugfix=bugfix, skip_broken=skip_broken,
                                                   excludes=excludes, enable_repos=enable_repos,
@@ -847,7 +1215,7 @@ class SysConfig(object):
 
         if packages is None:
             packages = []
-        if not isinstance(packages, types.ListType):
+        if not isinstance(packages, (types.ListType, osutil.PackageSet)):
             packages = [packages]
 
         # Sanitization
@@ -858,30 +1226,82 @@ class SysConfig(object):
             cmd = 'sudo yum update %s' % (' '.join(cli_switches))
             cmd += ' '
             cmd += ' '.join(packages_var_sanit)
-
-            ret, out, err = self.cli_cmd_sync(cmd, shell=True)
-            return ret
+            return [cmd], None
 
         # Packages specified - control the update so only given packages are updated.
         # Filtering step - load currently installed packages, remove those from targets if versions are higher / same
-        installed_packages = self.get_installed_packages()
+        packages = osutil.PackageSet.coerce(packages)
+        installed_packages = osutil.PackageSet(self.get_installed_packages())
         logger.debug('Installed packages count: %s, package to update/check: %s'
                      % (len(installed_packages), len(packages)))
 
-        packages_to_update = osutil.package_diff(packages, installed_packages, only_in_b=True)
+        packages_to_update = packages.diff(installed_packages, only_in_other=True)
         logger.debug('Packages to update: %s' % len(packages_to_update))
-        if len(packages_to_update) == 0:
-            return 0
 
         # packages_var may contain wildcard characters and do not present mandatory / maximal version packages.
         packages_sanit = ['%s' % util.escape_shell(self._package_to_yum_update(x)) for x in packages_to_update]
+
+        # iterate over packages sanit, maximally 200 packages on one line
+        chunk_size = 200
+        cmds = []
+        for idx in range(0, len(packages_sanit), chunk_size):
+            cmd = 'sudo yum update-to %s' % (' '.join(cli_switches))
+            cmd += ' '
+            cmd += ' '.join(packages_sanit[idx:idx + chunk_size])
+            cmds.append(cmd)
+
+        return cmds, packages
+
+    def update_packages(self, packages=None, packages_var=None, security=None, bugfix=None,
+                        skip_broken=None, excludes=None, enable_repos=None, disable_repos=None):
+        """
+        Updates system with the yum update
+        :param packages: 
+        :param packages_var: 
+        :param security: 
+        :param bugfix: 
+        :param skip_broken: 
+        :param excludes: 
+        :param enable_repos: 
+        :param disable_repos: 
+        :return: 0 on success, non-zero if any yum transaction failed or was declined
+        """
+        cmds, packages = self.plan_update_packages(packages=packages, packages_var=packages_var,
+                                                   security=security, bugfix=bugfix, skip_broken=skip_broken,
+                                                   excludes=excludes, enable_repos=enable_repos,
+                                                   disable_repos=disable_repos)
+
+        # General update, no package restrictions.
+        if packages is None:
+            ret, out, err = self.cli_cmd_sync(cmds[0], shell=True)
+            self.invalidate_installed_packages()
+            return ret
+
+        if len(cmds) == 0:
+            return 0
+
         update_status = YumUpdateStatus()
 
-        # handle the yum question
+        # Transaction table parsed - decide on the yum question right away
+        def answer_question():
+            conflicts, new_pkgs = packages.check_restrictions(update_status.parser.packages)
+            if len(conflicts) > 0:
+                logger.warning('Conflicting packages found: %s' % conflicts)
+                update_status.answer = 'n'
+
+            else:
+                if len(new_pkgs) > 0:
+                    logger.info('New packages, not mentioned in policy: %s' % new_pkgs)
+                logger.debug('Update passing, accepting.')
+                update_status.answer = 'y'
+
+            update_status.stop()
+            update_status.feeder.feed('%s\n' % update_status.answer)
+
+        # Safety net - no transaction table / unexpected question, terminate
         def timer_task():
             logger.info('Timer task...')
-            out = update_status.out()
-            logger.debug('Out: %s' % out)
+            logger.debug('Out: %s' % update_status.out())
 
             # Is already terminated?
             try:
@@ -894,37 +1314,21 @@ class SysConfig(object):
                 logger.error('Exception in finished detection %s' % e)
                 return
 
-            # Check for the question block
-            eqlines_cnt = len([x for x in out.split('\n') if '=======' in x])
-            if eqlines_cnt >= 3:
-                logger.debug('QUESTION')
-                update_pkgs = osutil.get_yum_packages_update(out)
-                conflicts, new_pkgs = osutil.check_package_restrictions(update_pkgs, packages)
-
-                if len(conflicts) > 0:
-                    logger.warning('Conflicting packages found: %s' % conflicts)
-                    update_status.feeder.feed('n\n')
-                    return
-
-                if len(new_pkgs) > 0:
-                    logger.info('New packages, not mentioned in policy: %s' % new_pkgs)
+            if update_status.answer is not None:
+                return
 
-                logger.debug('Update passing, accepting.')
-                update_status.feeder.feed('y\n')
+            logger.info('Yum question did not detected, terminate')
+            try:
+                update_status.feeder.feed('n\n')
+            except Exception as e:
+                logger.error('Exception in sending n: %s' % e)
+                logger.debug(traceback.format_exc())
 
-            else:
-                logger.info('Yum question did not detected, terminate')
-                try:
-                    update_status.feeder.feed('n\n')
-                except Exception as e:
-                    logger.error('Exception in sending n: %s' % e)
-                    logger.debug(traceback.format_exc())
-
-                time.sleep(2)
-                try:
-                    update_status.p.terminate()
-                except Exception as e:
-                    logger.error('Exception in terminating: %s' % e)
+            time.sleep(2)
+            try:
+                update_status.p.terminate()
+            except Exception as e:
+                logger.error('Exception in terminating: %s' % e)
 
         # noinspection PyUnusedLocal
         def yum_answer(out, feeder, p=None, *args, **kwargs):
@@ -934,28 +1338,46 @@ class SysConfig(object):
             update_status.p = p
             update_status.signal()
 
-        # iterate over packages sanit, maximally 200 packages on one line
-        chunk_size = 200
-        while True:
-            packages_sanit_chunk = packages_sanit[:chunk_size]
-            packages_sanit = packages_sanit[chunk_size:]
-            if len(packages_sanit_chunk) == 0:
-                break
+            if update_status.answer is not None:
+                return
 
+            update_status.parser.feed(out)
+            if update_status.parser.table_done:
+                logger.debug('QUESTION')
+                answer_question()
+
+            elif update_status.parser.is_prompt():
+                logger.info('Yum question without the transaction table, declining')
+                update_status.answer = 'n'
+                update_status.stop()
+                feeder.feed('n\n')
+
+        # noinspection PyUnusedLocal
+        def yum_err(err, feeder, p=None, *args, **kwargs):
+            update_status.append(err)
+            update_status.last_time = time.time()
+            update_status.signal()
+
+        res = 0
+        for cmd in cmds:
             update_status.reset()
-            update_status.watcher = Watcher(timer_task, 10.0)
+            update_status.watcher = Watcher(timer_task, YUM_IDLE_TIMEOUT)
             update_status.watcher.start(paused=True)
 
-            cmd = 'sudo yum update-to %s' % (' '.join(cli_switches))
-            cmd += ' '
-            cmd += ' '.join(packages_sanit_chunk)
-
             logger.debug('Going to update chunk: %s' % cmd)
-            ret, out, err = self.cli_cmd_sync(cmd, shell=True, on_out=yum_answer, on_err=yum_answer)
+            try:
+                ret, out, err = self.cli_cmd_sync(cmd, shell=True, on_out=yum_answer, on_err=yum_err)
+            finally:
+                update_status.stop()
 
-            logger.debug('Updated with result: %s' % ret)
+            logger.debug('Updated with result: %s, answer: %s' % (ret, update_status.answer))
 
-        return 0
+            # Failed or declined chunk fails the whole update, remaining chunks are still tried
+            if res == 0 and (ret != 0 or update_status.answer == 'n'):
+                res = ret if ret != 0 else 1
+
+        self.invalidate_installed_packages()
+        return res
 
     #
     # Networking / Firewall
@@ -1027,8 +1449,8 @@ class SysConfig(object):
         else:
             firewalls = [FIREWALL_FIREWALLD, FIREWALL_UFW, FIREWALL_IPTABLES]
 
-        for fw in firewalls:
-            loaded, active = self.svc_status(fw)
+        for fw, status in zip(firewalls, self.svc_status_many(firewalls)):
+            loaded, active = status
             if not loaded:
                 continue
             results.append((fw, active))
@@ -1178,24 +1600,61 @@ class SysConfig(object):
 
         return fw_name
 
-    def masquerade(self, net, net_size):
+    @contextlib.contextmanager
+    def firewall_batch(self):
         """
-        Add firewall masquerade rule - NATing
-        :param net:
-        :param net_size:
-        :return:
+        Firewall transaction. allow_port() and masquerade() calls in the block are collected,
+        the delta against one firewall state snapshot is applied at the end of the block with a single
+        iptables-restore / firewall-cmd / ufw reload. Nothing is applied if the block raises.
+
+        with syscfg.firewall_batch():
+            syscfg.allow_port(443)
+            syscfg.masquerade('10.8.0.0', 24)
+        :return: FirewallBatch
         """
-        fw_name = self._resolve_firewalls()
+        if self._fw_batch is not None:
+            yield self._fw_batch  # nested block joins the outer transaction
+            return
+
+        batch = FirewallBatch()
+        self._fw_batch = batch
+        try:
+            yield batch
+        finally:
+            self._fw_batch = None
+        self.firewall_commit(batch)
 
+    def firewall_commit(self, batch):
+        """
+        Applies the firewall changes. Throws OSError if the change cannot be applied.
+        :param batch: FirewallBatch
+        :return: 0
+        """
+        if batch.is_empty():
+            return 0
+
+        fw_name = self._resolve_firewalls()
         if fw_name == FIREWALL_UFW:
-            return self._masquerade_ufw(net=net, net_size=net_size)
+            return self._commit_ufw(batch)
         elif fw_name == FIREWALL_FIREWALLD:
-            return self._masquerade_firewalld(net=net, net_size=net_size)
+            return self._commit_firewalld(batch)
         elif fw_name == FIREWALL_IPTABLES:
-            return self._masquerade_iptables(net=net, net_size=net_size)
+            return self._commit_iptables(batch)
         else:
             raise EnvironmentError('Unknown firewall %s' % fw_name)
 
+    def masquerade(self, net, net_size):
+        """
+        Add firewall masquerade rule - NATing.
+        Inside firewall_batch() the rule is applied at the end of the block.
+        :param net:
+        :param net_size:
+        :return:
+        """
+        with self.firewall_batch() as batch:
+            batch.add_masquerade(net, net_size)
+        return 0
+
     def _ufw_accept_forward(self):
         """
         Changes UFW configuration so it accepts forwarding
@@ -1397,210 +1856,159 @@ class SysConfig(object):
             raise OSError('Cannot save new iptables rules')
         return 0
 
-    def _masquerade_ufw(self, net, net_size):
+    def _iptables_find_masquerade(self, model, net_desc, default_dev):
         """
-        Adds masquerade rules to the UFW (Universal firewall)
-        :param net:
-        :param net_size:
+        Finds masquerade rule for the network in the iptables model
+        :param model: IptablesModel
+        :param net_desc:
+        :param default_dev:
+        :return: rule or None
+        """
+        rules = model.find(table='nat', chain='POSTROUTING', target='MASQUERADE', src=net_desc)
+        for rule in rules:
+            if rule.out_iface is None or rule.out_iface == default_dev:
+                return rule
+        return None
+
+    def _iptables_find_allow(self, model, port, proto):
+        """
+        Finds port allow rule in the iptables model
+        :param model: IptablesModel
+        :param port:
+        :param proto:
+        :return: rule or None
+        """
+        rules = model.find(table='filter', chain='INPUT', target='ACCEPT', proto=proto, dport=port)
+        return rules[0] if len(rules) > 0 else None
+
+    def _commit_ufw(self, batch):
+        """
+        Applies firewall changes to the UFW (Universal firewall).
+        Ports are allowed with multi-port rules, masquerade changes before rules, reloaded once.
+        :param batch:
         :return:
         """
+        for tcp in [True, False]:
+            ports = batch.get_ports(tcp)
+
+            # UFW accepts at most 15 ports in one rule
+            for idx in range(0, len(ports), 15):
+                chunk = ports[idx:idx + 15]
+                port_desc = '%s/%s' % (','.join(['%d' % x for x in chunk]), 'tcp' if tcp else 'udp')
+                ret = self.exec_shell('sudo ufw allow %s' % port_desc, shell=True)
+                if ret != 0:
+                    raise OSError('Cannot add ufw allow rule')
+
+                for port in chunk:
+                    self.audit.audit_evt('firewall-modified', rule='allow-port', port=port, tcp=tcp,
+                                         firewall=FIREWALL_UFW)
+
+        if len(batch.masquerades) == 0:
+            return 0
+
         default_dev = self._try_get_default_dev()
 
         # Set policy to accept forwarding
         self._ufw_accept_forward()
 
         # Update before rules - add a masquerade rule to the table
-        self._ufw_masquerade_before_rules(net, net_size, default_dev)
+        for net, net_size in batch.masquerades:
+            self._ufw_masquerade_before_rules(net, net_size, default_dev)
 
         # Reload rules
         self._ufw_reload()
-        self.audit.audit_evt('firewall-modified', rule='add-masquerade', firewall=FIREWALL_UFW)
+        for net, net_size in batch.masquerades:
+            self.audit.audit_evt('firewall-modified', rule='add-masquerade', firewall=FIREWALL_UFW)
         return 0
 
-    def _masquerade_iptables(self, net, net_size):
+    def _commit_firewalld(self, batch):
         """
-        Adds masquerade rules to the iptables - permanent.
-        :param net:
-        :param net_size:
+        Applies firewall changes to the firewalld, one firewall-cmd call per zone
+        :param batch:
         :return:
         """
-
-        default_dev = self._try_get_default_dev()
-        iptables_rules = self._iptables_get_rules()
-
-        is_there = None
-        net_desc = '%s/%d' % (net, net_size)
-        is_nat = False
-        for rule in iptables_rules:
-            if len(rule) == 0:
-                continue
-            if re.match(r'^\s*#.*', rule):
-                continue
-            if rule.startswith(':'):
-                continue
-
-            rlow = rule.lower()
-            if rlow == 'commit':
-                continue
-
-            m_sec = re.match(r'^\*(.+?)$', rule)
-            if m_sec is not None:
-                is_nat = util.strip(m_sec.group(1)) == 'nat'
-
-            if not is_nat:
-                continue
-
-            m_routing = re.match(self.REGEX_IPTABLES_POSTROUTING, rule)
-            m_mask = re.match(self.REGEX_IPTABLES_MASQUERADE, rule)
-            m_src = re.match(self.REGEX_IPTABLES_SRC % re.escape(net_desc), rule)
-            m_out = re.match(self.REGEX_IPTABLES_OUTPUT_DEV, rule)
-
-            if m_routing is None or m_mask is None or m_src is None:
-                continue
-
-            if m_out is None or m_out.group(1) == default_dev:
-                is_there = rule
-
-        if is_there is None:
-            dev_part = '' if default_dev is None else ' -o %s' % default_dev
-            new_rule = '-A POSTROUTING -s %s%s -j MASQUERADE' % (net_desc, dev_part)
-
-            ret = self.exec_shell('sudo iptables -t nat %s' % new_rule, shell=True)
+        if len(batch.ports) > 0:
+            port_args = ' '.join(['--add-port=%d/%s' % (port, 'tcp' if tcp else 'udp') for port, tcp in batch.ports])
+            ret = self.exec_shell('sudo firewall-cmd --permanent --zone=public %s' % port_args, shell=True)
             if ret != 0:
-                raise OSError('Cannot add a new rule to iptables: %s' % new_rule)
+                raise OSError('Cannot add firewalld allow rule')
 
-            self._iptables_save()
-            self.audit.audit_evt('firewall-modified', rule=new_rule, firewall=FIREWALL_IPTABLES)
-            logger.debug('Rule added to iptables %s' % new_rule)
+            for port, tcp in batch.ports:
+                self.audit.audit_evt('firewall-modified', rule='allow-port', port=port, tcp=tcp,
+                                     firewall=FIREWALL_FIREWALLD)
 
-        else:
-            logger.debug('Rule already there: %s' % is_there)
+        if len(batch.masquerades) > 0:
+            cmd = 'sudo firewall-cmd --permanent --zone=external --add-masquerade'
+            ret = self.exec_shell(cmd, shell=True)
+            if ret != 0:
+                raise OSError('Cannot add firewalld masquerade')
 
+            self.audit.audit_evt('firewall-modified', rule='add-masquerade', firewall=FIREWALL_FIREWALLD)
         return 0
 
-    def _masquerade_firewalld(self, net, net_size):
+    def _commit_iptables(self, batch):
         """
-        Adds masquerade rules to the firewalld
-        :param net:
-        :param net_size:
+        Applies firewall changes to the iptables - permanent.
+        Missing rules are computed against one iptables-save snapshot, added by one iptables-restore --noflush.
+        :param batch:
         :return:
         """
-        cmd = 'sudo firewall-cmd --permanent --zone=external --add-masquerade'
-        ret = self.exec_shell(cmd, shell=True)
-        if ret == 0:
-            self.audit.audit_evt('firewall-modified', rule='--add-masquerade', firewall=FIREWALL_FIREWALLD)
-
-        self.audit.audit_evt('firewall-modified', rule='add-masquerade', firewall=FIREWALL_FIREWALLD)
-        return ret
+        default_dev = self._try_get_default_dev() if len(batch.masquerades) > 0 else None
+        model = iptables.IptablesModel.parse(self._iptables_get_rules())
 
-    def allow_port(self, port, tcp=True, reload=True):
-        """
-        Allows given port to the public
-        :param port:
-        :param tcp:
-        :return:
-        """
-        fw_name = self._resolve_firewalls()
+        # New rules are added to the model too, duplicates in the batch are found as existing
+        new_rules = []
+        for port, tcp in batch.ports:
+            proto = 'tcp' if tcp else 'udp'
+            is_there = self._iptables_find_allow(model, port, proto)
+            if is_there is not None:
+                logger.debug('Rule already there: %s' % is_there.raw)
+                continue
 
-        if fw_name == FIREWALL_UFW:
-            return self._allow_ufw(port=port, tcp=tcp, reload=reload)
-        elif fw_name == FIREWALL_FIREWALLD:
-            return self._allow_firewalld(port=port, tcp=tcp, reload=reload)
-        elif fw_name == FIREWALL_IPTABLES:
-            return self._allow_iptables(port=port, tcp=tcp, reload=reload)
-        else:
-            raise EnvironmentError('Unknown firewall %s' % fw_name)
+            new_rule = '-A INPUT -m state --state NEW -m tcp -p tcp --dport %s -j ACCEPT' % port
+            if not tcp:
+                new_rule = '-A INPUT -m udp -p udp --dport %s -j ACCEPT' % port
+            new_rules.append(model.add_rule('filter', new_rule))
 
-    def _allow_ufw(self, port, tcp=True, reload=True):
-        """
-        Adds port allow rule to the UFW
-        :param port:
-        :param tcp:
-        :param reload:
-        :return:
-        """
-        port_desc = '%d/%s' % (port, 'tcp' if tcp else 'udp')
+        for net, net_size in batch.masquerades:
+            net_desc = '%s/%d' % (net, net_size)
+            is_there = self._iptables_find_masquerade(model, net_desc, default_dev)
+            if is_there is not None:
+                logger.debug('Rule already there: %s' % is_there.raw)
+                continue
 
-        ret = self.exec_shell('sudo ufw allow %s' % port_desc, shell=True)
-        if ret != 0:
-            raise OSError('Cannot add ufw allow rule')
+            dev_part = '' if default_dev is None else ' -o %s' % default_dev
+            new_rule = '-A POSTROUTING -s %s%s -j MASQUERADE' % (net_desc, dev_part)
+            new_rules.append(model.add_rule('nat', new_rule))
 
-        self.audit.audit_evt('firewall-modified', rule='allow-port', port=port, tcp=tcp, firewall=FIREWALL_UFW)
-        return 0
+        if len(new_rules) == 0:
+            return 0
 
-    def _allow_firewalld(self, port, tcp=True, reload=True):
-        """
-        Adds port allow rule to the firewalld
-        :param port:
-        :param tcp:
-        :param reload:
-        :return:
-        """
-        port_desc = '%d/%s' % (port, 'tcp' if tcp else 'udp')
-        ret = self.exec_shell('sudo firewall-cmd --permanent --zone=public --add-port=%s' % port_desc, shell=True)
+        restore = iptables.restore_input(new_rules)
+        ret = self.exec_shell_subprocess('sudo iptables-restore --noflush', shell=True, stdin_string=restore)
         if ret != 0:
-            raise OSError('Cannot add ufw allow rule')
+            raise OSError('Cannot add new rules to iptables: %s' % restore)
 
-        self.audit.audit_evt('firewall-modified', rule='allow-port', port=port, tcp=tcp, firewall=FIREWALL_FIREWALLD)
+        self._iptables_save()
+        for rule in new_rules:
+            self.audit.audit_evt('firewall-modified', rule=rule.raw, firewall=FIREWALL_IPTABLES)
+            logger.debug('Rule added to iptables %s' % rule.raw)
+
+        for port, tcp in batch.ports:
+            self.audit.audit_evt('firewall-modified', rule='allow-port', port=port, tcp=tcp, firewall=FIREWALL_IPTABLES)
         return 0
 
-    def _allow_iptables(self, port, tcp=True, reload=True):
+    def allow_port(self, port, tcp=True, reload=True):
         """
-        Adds port allow rule to the iptables
+        Allows given port to the public.
+        Inside firewall_batch() the rule is applied at the end of the block.
         :param port:
         :param tcp:
-        :param reload:
+        :param reload: kept for compatibility, the change is applied when the batch ends
         :return:
         """
-        rules = self._iptables_get_rules()
-        proto = 'tcp' if tcp else 'udp'
-        ' -A INPUT -m state --state NEW -m tcp -p tcp --dport 25 -j ACCEPT'
-
-        is_there = None
-        is_filter = False
-        for rule in rules:
-            if len(rule) == 0:
-                continue
-            if re.match(r'^\s*#.*', rule):
-                continue
-            if rule.startswith(':'):
-                continue
-            if rule.lower() == 'commit':
-                continue
-
-            m_sec = re.match(r'^\*(.+?)$', rule)
-            if m_sec is not None:
-                is_filter = util.strip(m_sec.group(1)) == 'filter'
-            if not is_filter:
-                continue
-
-            m_input = re.match(self.REGEX_IPTABLES_INPUT, rule)
-            m_proto = re.match(self.REGEX_IPTABLES_PROTO % proto, rule, re.IGNORECASE)
-            m_port = re.match(self.REGEX_IPTABLES_PORT % port, rule)
-            m_accept = re.match(self.REGEX_IPTABLES_ACCEPT, rule)
-
-            if m_input is None or m_proto is None or m_port is None or m_accept is None:
-                continue
-            is_there = True
-            break
-
-        if is_there is None:
-            new_rule = '-A INPUT -m state --state NEW -m tcp -p tcp --dport %s -j ACCEPT' % port
-            if not tcp:
-                new_rule = '-A INPUT -m udp -p udp --dport %s -j ACCEPT' % port
-
-            ret = self.exec_shell('sudo iptables %s' % new_rule, shell=True)
-            if ret != 0:
-                raise OSError('Cannot add a new rule to iptables: %s' % new_rule)
-
-            self._iptables_save()
-            self.audit.audit_evt('firewall-modified', rule=new_rule, firewall=FIREWALL_IPTABLES)
-            self.audit.audit_evt('firewall-modified', rule='allow-port', port=port, tcp=tcp, firewall=FIREWALL_IPTABLES)
-            logger.debug('Rule added to iptables %s' % new_rule)
-
-        else:
-            logger.debug('Rule already there: %s' % is_there)
-
+        with self.firewall_batch() as batch:
+            batch.add_port(port, tcp)
         return 0
 
 
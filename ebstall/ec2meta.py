@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import collections
+import logging
+import threading
+
+import httpclient
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+IMDS_URL = 'http://169.254.169.254'
+TOKEN_TTL = 21600
+
+# Instance metadata is link-local, answers fast or not at all
+IMDS_TIMEOUT = (1, 2)
+
+# Key as reported by the ec2-metadata script -> meta-data path
+METADATA_KEYS = collections.OrderedDict([
+    ('ami-id', 'ami-id'),
+    ('instance-id', 'instance-id'),
+    ('instance-type', 'instance-type'),
+    ('placement', 'placement/availability-zone'),
+    ('public-ipv4', 'public-ipv4'),
+    ('public-hostname', 'public-hostname'),
+    ('local-ipv4', 'local-ipv4'),
+])
+
+
+class Ec2Metadata(object):
+    """
+    EC2 instance metadata service client, IMDSv2.
+    Session token is obtained once, keys are fetched concurrently over keep-alive connections.
+    Falls back to IMDSv1 requests without the token if the token endpoint is not available.
+    """
+    def __init__(self, base_url=IMDS_URL, timeout=IMDS_TIMEOUT, keys=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.keys = keys if keys is not None else METADATA_KEYS
+        self.token = None
+        self.session = httpclient.new_session(timeout=timeout, retries=0, pool_hosts=1,
+                                              pool_maxsize=max(1, len(self.keys)))
+
+        # Link-local service, never through a proxy
+        self.session.trust_env = False
+
+    def get_token(self):
+        """
+        Obtains the IMDSv2 session token
+        :return: token or None if IMDSv2 is not supported
+        """
+        res = self.session.put('%s/latest/api/token' % self.base_url,
+                               headers={'X-aws-ec2-metadata-token-ttl-seconds': str(TOKEN_TTL)})
+        if res.status_code in (403, 404, 405):
+            logger.debug('IMDSv2 token not available: %s' % res.status_code)
+            return None
+
+        res.raise_for_status()
+        return res.text.strip()
+
+    def get(self, path):
+        """
+        Fetches one meta-data value
+        :param path:
+        :return: value or None if not defined for the instance
+        """
+        headers = {}
+        if self.token is not None:
+            headers['X-aws-ec2-metadata-token'] = self.token
+
+        res = self.session.get('%s/latest/meta-data/%s' % (self.base_url, path), headers=headers)
+        if res.status_code == 404:
+            return None
+
+        res.raise_for_status()
+        return res.text.strip()
+
+    def fetch(self):
+        """
+        Fetches all the keys concurrently.
+        Raises an exception if the metadata service is not reachable or a key could not be fetched.
+        :return: OrderedDict key -> value, None for values not defined for the instance
+        """
+        self.token = self.get_token()
+
+        results = collections.OrderedDict((x, None) for x in self.keys)
+        failures = []
+
+        def worker(key, path):
+            try:
+                results[key] = self.get(path)
+            except Exception as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=worker, args=(key, path), name='imds-%s' % key)
+                   for key, path in self.keys.items()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(failures) > 0:
+            raise failures[0]
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def get_instance_metadata(base_url=IMDS_URL, timeout=IMDS_TIMEOUT, refresh=False):
+    """
+    Instance metadata, fetched once per process.
+    The failure is cached as well so hosts without the metadata service pay the timeout only once.
+    :param base_url:
+    :param timeout:
+    :param refresh: if True, the metadata service is queried again
+    :return: OrderedDict key -> value or None if the metadata service is not available
+    """
+    with _CACHE_LOCK:
+        if refresh or base_url not in _CACHE:
+            _CACHE[base_url] = _fetch(base_url, timeout)
+
+        results = _CACHE[base_url]
+        return collections.OrderedDict(results) if results is not None else None
+
+
+def _fetch(base_url, timeout):
+    client = Ec2Metadata(base_url=base_url, timeout=timeout)
+    try:
+        return client.fetch()
+    except Exception as e:
+        logger.debug('Instance metadata service not available: %s' % e)
+        return None
+    finally:
+        client.close()
+
+
+def reset_cache():
+    with _CACHE_LOCK:
+        _CACHE.clear()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import collections
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+# (connect, read) timeout used when the caller does not specify one
+DEFAULT_TIMEOUT = (10, 15)
+
+# Retries of failed connects and 502/503/504 responses, sleeps backoff * 2^(n-1) between retries
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+
+# Number of hosts with a connection pool, keep-alive connections per host
+POOL_HOSTS = 8
+POOL_MAXSIZE = 4
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTP adapter with the default timeout, keeps connection pools it used so the number of
+    new connections (TCP / TLS handshakes) and requests per host can be reported.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, *args, **kwargs):
+        self.timeout = timeout
+        self._pools = collections.OrderedDict()
+        self._pools_lock = threading.Lock()
+        super(PooledAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            pool = self.get_connection(request.url, kwargs.get('proxies'))
+            with self._pools_lock:
+                self._pools[id(pool)] = pool
+        except Exception as e:
+            logger.debug('Could not track the connection pool: %s' % e)
+
+        return super(PooledAdapter, self).send(request, **kwargs)
+
+    def get_stats(self):
+        """
+        Connections and requests per host
+        :return: host -> {'connections', 'requests'}
+        """
+        res = collections.OrderedDict()
+        with self._pools_lock:
+            pools = list(self._pools.values())
+
+        for pool in pools:
+            host = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+            stat = res.setdefault(host, {'connections': 0, 'requests': 0})
+            stat['connections'] += pool.num_connections
+            stat['requests'] += pool.num_requests
+        return res
+
+
+def new_session(timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                pool_hosts=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE):
+    """
+    Creates a new session with keep-alive connection pools, retries with backoff and the default timeout
+    :param timeout: default (connect, read) timeout
+    :param retries: number of retries of failed connects / 502, 503, 504 responses
+    :param backoff: backoff factor
+    :param pool_hosts: number of hosts with connection pool
+    :param pool_maxsize: maximum number of kept connections per host
+    :return: requests.Session
+    """
+    retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+                  status_forcelist=(502, 503, 504), raise_on_status=False)
+
+    session = requests.Session()
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, PooledAdapter(timeout=timeout, max_retries=retry,
+                                            pool_connections=pool_hosts, pool_maxsize=pool_maxsize))
+    return session
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Process-wide shared session
+    :return: requests.Session
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = new_session()
+        return _SESSION
+
+
+def reset_session():
+    """
+    Closes the shared session, a new one is created on the next use
+    :return:
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = None
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_session().post(url, **kwargs)
+
+
+def get_stats(session=None):
+    """
+    Connection statistics of the session, shared session by default
+    :param session:
+    :return: {'connections': total, 'requests': total, 'hosts': host -> {'connections', 'requests'}}
+    """
+    if session is None:
+        with _SESSION_LOCK:
+            session = _SESSION
+
+    hosts = collections.OrderedDict()
+    adapters = session.adapters.values() if session is not None else []
+    for adapter in adapters:
+        if isinstance(adapter, PooledAdapter):
+            hosts.update(adapter.get_stats())
+
+    return {
+        'connections': sum(x['connections'] for x in hosts.values()),
+        'requests': sum(x['requests'] for x in hosts.values()),
+        'hosts': hosts
+    }
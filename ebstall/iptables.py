@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import collections
+import logging
+import shlex
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+# Long option -> short option, so the same match written differently is indexed the same way
+OPTION_ALIASES = {
+    '--append': '-A',
+    '--source': '-s',
+    '--src': '-s',
+    '--destination': '-d',
+    '--dst': '-d',
+    '--protocol': '-p',
+    '--jump': '-j',
+    '--goto': '-g',
+    '--in-interface': '-i',
+    '--out-interface': '-o',
+    '--match': '-m',
+    '--destination-port': '--dport',
+    '--source-port': '--sport',
+}
+
+
+class IptablesRule(object):
+    """
+    One iptables rule, -A CHAIN with parsed options.
+    Options are (option, value, negated) triples in the order of the rule.
+    """
+    def __init__(self, table=None, chain=None, options=None, raw=None):
+        self.table = table
+        self.chain = chain
+        self.options = options if options is not None else []
+        self.raw = raw
+
+    def get(self, option, default=None):
+        """
+        Value of the first not negated option
+        :param option:
+        :param default:
+        :return:
+        """
+        for opt, val, neg in self.options:
+            if opt == option and not neg:
+                return val
+        return default
+
+    @property
+    def target(self):
+        return self.get('-j')
+
+    @property
+    def src(self):
+        return self.get('-s')
+
+    @property
+    def proto(self):
+        proto = self.get('-p')
+        return proto.lower() if proto is not None else None
+
+    @property
+    def dport(self):
+        return self.get('--dport')
+
+    @property
+    def out_iface(self):
+        return self.get('-o')
+
+    def key(self):
+        """
+        Rule identity for diffs. Match modules are implied by their options,
+        iptables-save adds them on its own, so they are not part of the key.
+        :return:
+        """
+        opts = sorted([x for x in self.options if x[0] != '-m'])
+        return self.table, self.chain, tuple(opts)
+
+    def __repr__(self):
+        return 'IptablesRule(table=%r, chain=%r, raw=%r)' % (self.table, self.chain, self.raw)
+
+
+class IptablesChain(object):
+    """
+    Chain with policy & counters from the iptables-save header, rules in order
+    """
+    def __init__(self, name=None, policy=None, counters=None):
+        self.name = name
+        self.policy = policy
+        self.counters = counters
+        self.rules = []
+
+    def header(self):
+        line = ':%s %s' % (self.name, self.policy if self.policy is not None else '-')
+        if self.counters is not None:
+            line += ' %s' % self.counters
+        return line
+
+
+class IptablesTable(object):
+    """
+    iptables table, chains in order
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.chains = collections.OrderedDict()
+
+    def get_chain(self, name):
+        """
+        Returns the chain, creates a new one if not defined
+        :param name:
+        :return:
+        """
+        if name not in self.chains:
+            self.chains[name] = IptablesChain(name=name)
+        return self.chains[name]
+
+
+def parse_rule(line, table=None):
+    """
+    Parses one -A rule line
+    :param line:
+    :param table:
+    :return: IptablesRule
+    """
+    # shlex only for quoted values (comments), much slower than split
+    tokens = shlex.split(line) if '"' in line or "'" in line else line.split()
+    if len(tokens) < 2 or OPTION_ALIASES.get(tokens[0], tokens[0]) != '-A':
+        raise ValueError('Not an append rule: %s' % line)
+
+    rule = IptablesRule(table=table, chain=tokens[1], raw=line.strip())
+    opt = None
+    values = []
+    negated = False
+    next_negated = False
+
+    for token in tokens[2:] + [None]:
+        is_opt = token is None or token == '!' or (token.startswith('-') and not token[1:2].isdigit())
+        if not is_opt:
+            values.append(token)
+            continue
+
+        if opt is not None:
+            rule.options.append((opt, ' '.join(values) if len(values) > 0 else None, negated))
+            opt, values = None, []
+
+        if token == '!':
+            next_negated = True
+        elif token is not None:
+            opt = OPTION_ALIASES.get(token, token)
+            negated, next_negated = next_negated, False
+    return rule
+
+
+class IptablesModel(object):
+    """
+    Structured iptables-save model: table -> chain -> rules.
+    Rules are indexed by target, source net, protocol and destination port, existence checks
+    are dictionary lookups instead of regex scans over all rules.
+    """
+    INDEXED = ('target', 'src', 'proto', 'dport')
+
+    def __init__(self):
+        self.tables = collections.OrderedDict()
+        self._keys = set()
+        self._index = dict((x, collections.defaultdict(list)) for x in self.INDEXED)
+
+    @classmethod
+    def parse(cls, lines):
+        """
+        Parses iptables-save output
+        :param lines: string or list of lines
+        :return: IptablesModel
+        """
+        if not isinstance(lines, (list, tuple)):
+            lines = lines.split('\n')
+
+        model = cls()
+        table = None
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            if line.startswith('*'):
+                table = model.get_table(line[1:].strip())
+                continue
+
+            if line.upper() == 'COMMIT':
+                table = None
+                continue
+
+            if table is None:
+                logger.debug('iptables line outside of a table: %s' % line)
+                continue
+
+            if line.startswith(':'):
+                parts = line[1:].split(None, 2)
+                chain = table.get_chain(parts[0])
+                chain.policy = parts[1] if len(parts) > 1 else None
+                chain.counters = parts[2] if len(parts) > 2 else None
+                continue
+
+            try:
+                model._add(parse_rule(line, table=table.name))
+            except ValueError as e:
+                logger.debug('Unrecognized iptables line: %s' % e)
+        return model
+
+    def get_table(self, name):
+        if name not in self.tables:
+            self.tables[name] = IptablesTable(name=name)
+        return self.tables[name]
+
+    def rules(self):
+        """
+        All rules in the table / chain order
+        :return:
+        """
+        res = []
+        for table in self.tables.values():
+            for chain in table.chains.values():
+                res += chain.rules
+        return res
+
+    def _add(self, rule):
+        self.get_table(rule.table).get_chain(rule.chain).rules.append(rule)
+        self._keys.add(rule.key())
+        for attr in self.INDEXED:
+            val = getattr(rule, attr)
+            if val is not None:
+                self._index[attr][val].append(rule)
+        return rule
+
+    def add_rule(self, table, line):
+        """
+        Appends a new rule to the model
+        :param table:
+        :param line: -A CHAIN ... rule
+        :return: IptablesRule
+        """
+        return self._add(parse_rule(line, table=table))
+
+    def has_rule(self, rule):
+        return rule.key() in self._keys
+
+    def find(self, table=None, chain=None, **criteria):
+        """
+        Finds rules matching all the criteria.
+        Candidates come from the smallest index bucket of the given indexed criteria.
+        :param table:
+        :param chain:
+        :param criteria: target, src, proto, dport, out_iface
+        :return: list of rules
+        """
+        criteria = dict((k, v) for k, v in criteria.items() if v is not None)
+        if 'dport' in criteria:
+            criteria['dport'] = str(criteria['dport'])
+        if 'proto' in criteria:
+            criteria['proto'] = criteria['proto'].lower()
+
+        buckets = [self._index[k].get(v, []) for k, v in criteria.items() if k in self.INDEXED]
+        if len(buckets) > 0:
+            candidates = min(buckets, key=len)
+        else:
+            candidates = self.rules()
+
+        res = []
+        for rule in candidates:
+            if table is not None and rule.table != table:
+                continue
+            if chain is not None and rule.chain != chain:
+                continue
+            if all(getattr(rule, k) == v for k, v in criteria.items()):
+                res.append(rule)
+        return res
+
+    def diff(self, other):
+        """
+        Rules of the other model missing here and rules from here missing in the other model
+        :param other:
+        :return: (added, removed) rule lists
+        """
+        added = [x for x in other.rules() if x.key() not in self._keys]
+        removed = [x for x in self.rules() if x.key() not in other._keys]
+        return added, removed
+
+    def dumps(self):
+        """
+        Emits the whole model in the iptables-save format
+        :return:
+        """
+        lines = []
+        for table in self.tables.values():
+            lines.append('*%s' % table.name)
+            lines += [chain.header() for chain in table.chains.values()]
+            for chain in table.chains.values():
+                lines += [rule.raw for rule in chain.rules]
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+
+def restore_input(rules):
+    """
+    iptables-restore --noflush input appending the given rules, grouped by table
+    :param rules: list of IptablesRule
+    :return:
+    """
+    tables = collections.OrderedDict()
+    for rule in rules:
+        tables.setdefault(rule.table, []).append(rule.raw)
+
+    lines = []
+    for table, raws in tables.items():
+        lines += ['*%s' % table] + raws + ['COMMIT']
+    return '\n'.join(lines) + '\n' if len(lines) > 0 else ''
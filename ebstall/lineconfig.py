@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import abc
+import bisect
+import collections
+import logging
+import types
+
+import six
+
+import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+CONFIG_LINE_BLANK = 0
+CONFIG_LINE_COMMENT = 1
+CONFIG_LINE_CMD_COMMENT = 2
+CONFIG_LINE_CMD = 3
+
+CONFIG_CMD_TYPES = (CONFIG_LINE_CMD, CONFIG_LINE_CMD_COMMENT)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class LineConfig(object):
+    """
+    Line oriented configuration file engine.
+    Parsed lines are kept in config_data together with the command -> line positions index,
+    so lookups and edits touch only lines of the given command. Modified lines are tracked as dirty.
+
+    Front-ends implement load_config_file_lines() and new_line(), lines have ltype, cmd, params and raw.
+    """
+
+    def __init__(self):
+        self.config_data = None
+        self.config_modified = False
+
+        # command -> ascending positions in config_data
+        self._index = None
+        self._index_size = None
+
+        # id(line) -> line modified / added since the load or the last flush
+        self._dirty = collections.OrderedDict()
+
+    def load(self):
+        """
+        Loads the config file
+        :return:
+        """
+        self.config_data = self.load_config_file_lines()
+        self._build_index()
+        self._dirty.clear()
+
+    @abc.abstractmethod
+    def load_config_file_lines(self):
+        """
+        Loads config file lines
+        :return: array of config lines
+        """
+
+    @abc.abstractmethod
+    def new_line(self, cmd, params):
+        """
+        Creates a new active command line
+        :param cmd:
+        :param params:
+        :return:
+        """
+
+    #
+    # Index
+    #
+
+    def _build_index(self):
+        """
+        Builds command -> positions index of the config_data
+        :return:
+        """
+        index = collections.defaultdict(list)
+        for idx, cfg in enumerate(self.config_data):
+            if cfg.ltype in CONFIG_CMD_TYPES:
+                index[cfg.cmd].append(idx)
+
+        self._index = index
+        self._index_size = len(self.config_data)
+
+    def _get_index(self):
+        """
+        Returns command index, loads the config file / rebuilds the index if needed
+        :return:
+        """
+        if self.config_data is None:
+            self.config_data = self.load_config_file_lines()
+            self._index = None
+
+        # config_data modified directly
+        if self._index is None or self._index_size != len(self.config_data):
+            self._build_index()
+        return self._index
+
+    def get_lines(self, cmd):
+        """
+        Returns all lines with the given command, active and commented out
+        :param cmd:
+        :return:
+        """
+        index = self._get_index()
+        return [self.config_data[x] for x in index.get(cmd, [])]
+
+    def get_value(self, cmd, default=None):
+        """
+        Returns value of the first active command
+        :param cmd:
+        :param default:
+        :return:
+        """
+        for cfg in self.get_lines(cmd):
+            if cfg.ltype == CONFIG_LINE_CMD:
+                return cfg.params
+        return default
+
+    #
+    # Dirty tracking
+    #
+
+    def mark_dirty(self, cfg):
+        """
+        Marks the line as modified
+        :param cfg:
+        :return:
+        """
+        self._dirty[id(cfg)] = cfg
+        self.config_modified = True
+
+    def set_line_type(self, cfg, ltype):
+        """
+        Changes the line type (comment out / activate), marks the line dirty
+        :param cfg:
+        :param ltype:
+        :return:
+        """
+        cfg.ltype = ltype
+        self.mark_dirty(cfg)
+
+    def get_dirty_lines(self):
+        """
+        Lines modified / added since the load or the last flush
+        :return:
+        """
+        return list(self._dirty.values())
+
+    def reset_dirty(self):
+        """
+        Resets the change tracking, after the changes were flushed
+        :return:
+        """
+        self._dirty.clear()
+        self.config_modified = False
+
+    #
+    # Edits
+    #
+
+    def set_config_value(self, cmd, values=None, remove=False, under_directive=None):
+        """
+        Sets command to the specified value in the configuration file.
+        Loads file from the disk if server_config_data is None (file was not yet loaded).
+
+        Supports also multicommands - one command with more values.
+
+        Modifies self.config_data, self.config_modified
+        :param cmd:
+        :param values: single value or array of values for multi-commands (e.g., push).
+                       None & remove -> remove all commands. Otherwise just commands with the given values are removed.
+        :param remove: if True, configuration command is removed
+        :param under_directive: if specified, command is placed under specified directive, if exists
+        :return: True if file was modified
+        """
+        file_changed, insert_idx, new_lines = self._set_config_value(cmd, values=values, remove=remove,
+                                                                     under_directive=under_directive)
+        if len(new_lines) > 0:
+            self._insert_lines([(insert_idx, new_lines)])
+        return file_changed
+
+    def set_many(self, values, remove=None):
+        """
+        Sets more commands at once, new lines are inserted in one pass over the configuration.
+        Equivalent to set_config_value() call for each command, each command should be present only once.
+
+        :param values: dict / list of pairs command -> values, values as in set_config_value()
+        :param remove: list of commands to remove
+        :return: True if file was modified
+        """
+        pairs = values.items() if isinstance(values, dict) else values
+        items = [(cmd, cvals, False) for cmd, cvals in pairs]
+        items += [(cmd, None, True) for cmd in util.defval(remove, [])]
+
+        file_changed = False
+        inserts = []
+        for cmd, cvals, cremove in items:
+            cur_changed, insert_idx, new_lines = self._set_config_value(cmd, values=cvals, remove=cremove)
+            file_changed |= cur_changed
+            if len(new_lines) > 0:
+                inserts.append((insert_idx, new_lines))
+
+        if len(inserts) > 0:
+            self._insert_lines(inserts)
+        return file_changed
+
+    def _set_config_value(self, cmd, values=None, remove=False, under_directive=None):
+        """
+        Modifies existing lines of the command, does not insert new lines so the index stays valid.
+        :param cmd:
+        :param values:
+        :param remove:
+        :param under_directive:
+        :return: (file_changed, insert position or None for the end of the file, new lines to insert)
+        """
+        index = self._get_index()
+
+        # default position - end of the config file
+        last_cmd_idx = None
+        file_changed = False
+        single_directive = False  # no parameter given
+
+        if values is None:
+            single_directive = True
+            values = [None]
+
+        if not isinstance(values, types.ListType):
+            values = [values]
+
+        # New values are placed after the last occurrence of the command / under_directive
+        anchors = [cmd]
+        if under_directive is not None:
+            anchors += under_directive if isinstance(under_directive, types.ListType) else [under_directive]
+        positions = [index[x][-1] for x in anchors if len(index.get(x, [])) > 0]
+        if len(positions) > 0:
+            last_cmd_idx = max(positions)
+
+        cmd_positions = index.get(cmd, [])
+        values_set = [False] * len(values)
+        values_idx = dict((x, idx) for idx, x in reversed(list(enumerate(values))))
+        any_value = util.is_empty(values) or single_directive
+        for idx in cmd_positions:
+            # Only commands of interest here
+            cfg = self.config_data[idx]
+            value_idx = values_idx.get(cfg.params)
+            is_desired_value = value_idx is not None
+            is_desired_value |= remove and any_value
+            is_desired_value |= not remove and any_value and util.is_empty(cfg.params)
+            if remove:
+                value_idx = None
+
+            if is_desired_value:
+                if cfg.ltype == CONFIG_LINE_CMD and not remove:
+                    # Command is already set to the same value. File not modified.
+                    # Cannot quit yet, has to comment out other values
+                    if value_idx is not None:
+                        if not values_set[value_idx]:
+                            values_set[value_idx] = True
+                        else:
+                            self.set_line_type(cfg, CONFIG_LINE_CMD_COMMENT)
+                            file_changed = True
+                    pass
+
+                elif cfg.ltype == CONFIG_LINE_CMD:
+                    # Remove command - comment out
+                    self.set_line_type(cfg, CONFIG_LINE_CMD_COMMENT)
+                    file_changed = True
+
+                elif cfg.ltype == CONFIG_LINE_CMD_COMMENT and remove:
+                    # Remove && comment - leave as it is
+                    # Cannot quit yet, has to comment out other values
+                    pass
+
+                else:
+                    # CONFIG_LINE_CMD_COMMENT and not remove.
+                    # Just change the type to active value - switch from comment to command
+                    # Cannot quit yet, has to comment out other values
+                    do_change = True
+                    if value_idx is not None:
+                        if not values_set[value_idx]:
+                            values_set[value_idx] = True
+                        else:
+                            do_change = False
+
+                    if do_change:
+                        self.set_line_type(cfg, CONFIG_LINE_CMD)
+                        file_changed = True
+
+            elif cfg.ltype == CONFIG_LINE_CMD and not remove:
+                # Same command, but different value - comment this out
+                # If remove is True, only desired values were removed.
+                self.set_line_type(cfg, CONFIG_LINE_CMD_COMMENT)
+                file_changed = True
+
+        new_lines = []
+        if remove:
+            return file_changed, None, new_lines
+
+        # Add those commands not set in the cycle above
+        for idx, cval in enumerate(values):
+            if values_set[idx]:
+                continue
+
+            new_lines.append(self.new_line(cmd, cval))
+            file_changed = True
+
+        return file_changed, None if last_cmd_idx is None else last_cmd_idx + 1, new_lines
+
+    def _insert_lines(self, inserts):
+        """
+        Inserts new lines to the config_data, keeps the index in sync.
+        :param inserts: list of (position in the current config_data or None for the end, lines)
+        :return:
+        """
+        for pos, lines in inserts:
+            for cl in lines:
+                self.mark_dirty(cl)
+
+        if len(inserts) > 1:
+            # Lines appended to the end go after the lines inserted at the end position, as with sequential inserts
+            by_pos = collections.defaultdict(list)
+            appended = []
+            for pos, lines in inserts:
+                if pos is None:
+                    appended += lines
+                else:
+                    by_pos[pos] += lines
+            self.config_data += appended
+
+            # Inserting from the end keeps the positions valid, index is rebuilt lazily on the next access
+            for pos in sorted(by_pos.keys(), reverse=True):
+                self.config_data[pos:pos] = by_pos[pos]
+            self._index = None
+            return
+
+        pos, lines = inserts[0]
+        pos = len(self.config_data) if pos is None else pos
+        self.config_data[pos:pos] = lines
+
+        # Shift positions behind the insertion point, add the new lines
+        for positions in self._index.values():
+            for i in range(bisect.bisect_left(positions, pos), len(positions)):
+                positions[i] += len(lines)
+        for i, cl in enumerate(lines):
+            if cl.ltype in CONFIG_CMD_TYPES:
+                bisect.insort(self._index[cl.cmd], pos + i)
+        self._index_size = len(self.config_data)
+
+    def insert_line(self, pos, cfg):
+        """
+        Inserts one line at the position, None for the end of the file
+        :param pos:
+        :param cfg:
+        :return:
+        """
+        self._get_index()
+        self._insert_lines([(pos, [cfg])])
@@ -3,6 +3,7 @@
 
 from __future__ import print_function
 import collections
+import itertools
 import logging
 import os
 import platform
@@ -90,6 +91,24 @@ FAMILY_DEBIAN = 'debian'
 YUMS = ['redhat', 'fedora', 'centos', 'rhel', 'amzn', 'amazon']
 DEBS = ['debian', 'ubuntu', 'kali']
 
+# Package database files, stat() changes on each package install / removal
+PKG_DB_FILES = {
+    PKG_YUM: ['/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite'],
+    PKG_APT: ['/var/lib/dpkg/status'],
+}
+
+# rpm -qa output format, one tab separated record per line
+RPM_QUERYFORMAT = r'%{NAME}\t%{EPOCH}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\n'
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+
+# yum output parsing
+YUM_LIST_LINE = re.compile(r'^([a-zA-Z0-9.\-_+]+)\s+([a-zA-Z0-9.:\-_+~]+)\s+([@a-zA-Z0-9.\-_/]+)$')
+YUM_LIST_WRAPPED = re.compile(r'^[a-zA-Z0-9.\-_+]+\.[a-zA-Z0-9_]+(?:\s+[a-zA-Z0-9.:\-_+~]+)?$')
+YUM_UPDATE_SECTION = re.compile(r'^([a-zA-Z\s]+):$')
+YUM_UPDATE_LINE = re.compile(r'^([a-zA-Z0-9.\-_+]+)\s+([a-zA-Z0-9.\-_]+)\s+([a-zA-Z0-9.:\-_+~]+)'
+                             r'\s+([@a-zA-Z0-9.:\-_/]+)\s+([a-zA-Z0-9.\-_\s]+?)$')
+YUM_UPDATE_WRAPPED = re.compile(r'^[a-zA-Z0-9.\-_+]+$')
+
 
 class OSInfo(object):
     """OS information, name, version, like - similarity"""
@@ -193,6 +212,22 @@ class PackageInfo(object):
         return obj
 
 
+def get_package_db_fingerprint(packager):
+    """
+    Cheap fingerprint of the package database state.
+    Changes whenever a package is installed, updated or removed.
+    :param packager: 
+    :return: [path, mtime, size] or None if the package database cannot be inspected
+    """
+    for path in PKG_DB_FILES.get(packager, []):
+        try:
+            st = os.stat(path)
+            return [path, st.st_mtime, st.st_size]
+        except OSError:
+            continue
+    return None
+
+
 def get_os():
     """
     Returns basic information about the OS.
@@ -530,34 +565,179 @@ def os_like_constants():
     return {}
 
 
+def iter_lines(out):
+    """
+    Iterates over lines of the command output.
+    Accepts a string, a list of lines or any iterable producing lines (e.g., process output stream).
+    Strings are scanned lazily, without splitting the whole output first.
+    :param out: 
+    :return: generator of lines
+    """
+    if not isinstance(out, types.StringTypes):
+        for line in out:
+            yield line
+        return
+
+    start = 0
+    while True:
+        end = out.find('\n', start)
+        if end < 0:
+            yield out[start:]
+            return
+        yield out[start:end]
+        start = end + 1
+
+
+def split_package_arch(package):
+    """
+    Splits yum package identifier name.arch to (name, arch)
+    :param package: 
+    :return: (name, arch), arch is None if not present
+    """
+    name, sep, arch = package.rpartition('.')
+    if not sep or not name or not arch:
+        return package, None
+    return name, arch
+
+
+def iter_yum_packages(out):
+    """
+    List of all packages parsing, generator.
+    Handles wrapped lines - yum puts the version and the repository to the next line
+    when the package name is too long.
+    :param out: string / list of lines / line stream
+    :return: generator of PackageInfo
+    """
+    pending = None
+    for line in iter_lines(out):
+        line = line.strip()
+
+        match = None
+        if pending is not None:
+            match = YUM_LIST_LINE.match('%s %s' % (pending, line))
+            pending = None
+
+        if match is None:
+            match = YUM_LIST_LINE.match(line)
+
+        if match is None:
+            if YUM_LIST_WRAPPED.match(line):
+                pending = line
+            continue
+
+        package, arch = split_package_arch(match.group(1))
+        yield PackageInfo(name=package, version=match.group(2), arch=arch, repo=match.group(3))
+
+
 def get_yum_packages(out):
     """
     List of all packages parsing
     :param out: 
     :return: 
     """
-    ret = []
-    lines = out if isinstance(out, types.ListType) else out.split('\n')
-    for line in lines:
+    return list(iter_yum_packages(out))
+
+
+class YumTranscriptParser(object):
+    """
+    Incremental parser of the yum update transcript.
+    Follows the transaction table section by section as the output arrives,
+    the package table is between the 2nd and 3rd ===== line.
+    Once the 3rd ===== line is seen the transaction summary is complete and the yum question follows.
+    """
+    PROMPT = 'is this ok ['
+
+    def __init__(self):
+        self.eqline = 0
+        self.section = None
+        self.packages = []
+        self._pending = None
+        self._partial = ''
+
+    @property
+    def table_done(self):
+        """
+        True if the whole package table was parsed
+        :return: 
+        """
+        return self.eqline > 2
+
+    def feed(self, data):
+        """
+        Feeds the output chunk, not necessarily line aligned
+        :param data: 
+        :return: list of newly parsed packages
+        """
+        res = []
+        data = self._partial + data
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            pkg = self.feed_line(line)
+            if pkg is not None:
+                res.append(pkg)
+        return res
+
+    def is_prompt(self):
+        """
+        True if yum waits on the question - unterminated line with the prompt
+        :return: 
+        """
+        return self.PROMPT in self._partial.lower()
+
+    def feed_line(self, line):
+        """
+        Processes one complete output line
+        :param line: 
+        :return: PackageInfo if the line completed a package record, None otherwise
+        """
         line = line.strip()
-        match = re.match(r'^([a-zA-Z0-9.\-_]+)[\s\t]+([a-zA-Z0-9.:\-_]+)[\s\t]+([@a-zA-Z0-9.\-_]+)$', line)
+        if line.startswith('====='):
+            self.eqline += 1
+            return None
+
+        # Process lines only after 2nd ====== line - should be the package list.
+        if self.eqline != 2:
+            return None
+
+        match = None
+        if self._pending is not None:
+            match = YUM_UPDATE_LINE.match('%s %s' % (self._pending, line))
+            self._pending = None
+
         if match is None:
-            continue
+            lmatch = YUM_UPDATE_SECTION.match(line)
+            if lmatch is not None:
+                self.section = lmatch.group(1)
+                return None
+
+            match = YUM_UPDATE_LINE.match(line)
+
+        if match is None:
+            if YUM_UPDATE_WRAPPED.match(line):
+                self._pending = line
+            return None
 
-        package = match.group(1).strip()
-        version = match.group(2).strip()
-        repo = match.group(3).strip()
-        arch = None
+        pkg = PackageInfo(name=match.group(1), version=match.group(3), arch=match.group(2),
+                          repo=match.group(4), size=match.group(5), section=self.section)
+        self.packages.append(pkg)
+        return pkg
 
-        # Architecture extract
-        match_arch = re.match(r'^(.+?)\.([^.]+)$', package)
-        if match_arch:
-            package = match_arch.group(1).strip()
-            arch = match_arch.group(2).strip()
 
-        pkg = PackageInfo(name=package, version=version, arch=arch, repo=repo)
-        ret.append(pkg)
-    return ret
+def iter_yum_packages_update(out):
+    """
+    List of packages to update parsing, generator.
+    Processes the package table between the 2nd and 3rd ===== line.
+    :param out: string / list of lines / line stream
+    :return: generator of PackageInfo
+    """
+    parser = YumTranscriptParser()
+    for line in iter_lines(out):
+        pkg = parser.feed_line(line)
+        if parser.table_done:
+            return
+        if pkg is not None:
+            yield pkg
 
 
 def get_yum_packages_update(out):
@@ -566,40 +746,78 @@ def get_yum_packages_update(out):
     :param out: 
     :return: 
     """
-    ret = []
-    eqline = 0
-    cur_section = None
+    return list(iter_yum_packages_update(out))
 
-    lines = out if isinstance(out, types.ListType) else out.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line.startswith('====='):
-            eqline += 1
+
+def iter_rpm_packages(out):
+    """
+    Parses rpm -qa --queryformat RPM_QUERYFORMAT output, generator.
+    Version is in the yum format: [epoch:]version-release
+    :param out: string / list of lines / line stream
+    :return: generator of PackageInfo
+    """
+    for line in iter_lines(out):
+        parts = line.rstrip('\r\n').split('\t')
+        if len(parts) != 5:
             continue
 
-        # Process lines only after 2nd ====== line - should be the package list.
-        if eqline != 2:
+        name, epoch, version, release, arch = parts
+        if arch == '(none)':
+            arch = None
+        if epoch in ('(none)', '0', ''):
+            version = '%s-%s' % (version, release)
+        else:
+            version = '%s:%s-%s' % (epoch, version, release)
+        yield PackageInfo(name=name, version=version, arch=arch, repo=None)
+
+
+def get_rpm_packages(out):
+    """
+    Parses rpm -qa --queryformat RPM_QUERYFORMAT output
+    :param out: 
+    :return: 
+    """
+    return list(iter_rpm_packages(out))
+
+
+def iter_dpkg_status(out):
+    """
+    Parses dpkg status database (/var/lib/dpkg/status), generator.
+    Only installed packages are returned.
+    :param out: string / list of lines / line stream
+    :return: generator of PackageInfo
+    """
+    fields = {}
+    for line in itertools.chain(iter_lines(out), ['']):
+        line = line.rstrip('\r\n')
+
+        # Stanza end
+        if len(line.strip()) == 0:
+            if 'package' in fields and 'version' in fields and fields.get('status', '').endswith(' installed'):
+                yield PackageInfo(name=fields['package'], version=fields['version'],
+                                  arch=fields.get('architecture'), repo=None,
+                                  size=fields.get('installed-size'), section=fields.get('section'))
+            fields = {}
             continue
 
-        lmatch = re.match(r'^([a-zA-Z\s]+):$', line)
-        if lmatch is not None:
-            cur_section = lmatch.group(1)
+        # Continuation line of multi-line fields (e.g., Description, Conffiles)
+        if line[0] in ' \t':
             continue
 
-        match = re.match(r'^([a-zA-Z0-9.\-_]+)[\s\t]+([a-zA-Z0-9.\-_]+)[\s\t]+([a-zA-Z0-9.:\-_]+)'
-                         r'[\s\t]+([@a-zA-Z0-9.:\-_]+)[\s\t]+([a-zA-Z0-9.\-_\s]+?)$', line)
-        if match is None:
+        field, sep, value = line.partition(':')
+        if not sep:
             continue
+        fields[field.lower()] = value.strip()
 
-        package = match.group(1).strip()
-        version = match.group(3).strip()
-        repo = match.group(4).strip()
-        arch = match.group(2).strip()
-        size = match.group(5).strip()
-        pkg = PackageInfo(name=package, version=version, arch=arch, repo=repo, size=size, section=cur_section)
-        ret.append(pkg)
 
-    return ret
+def get_dpkg_packages(path=DPKG_STATUS_FILE):
+    """
+    Reads installed packages from the dpkg status database
+    :param path: 
+    :return: 
+    """
+    with open(path, 'r') as fh:
+        return list(iter_dpkg_status(fh))
 
 
 def check_package_restrictions(yum_output_packages, allowed_packages):
@@ -609,26 +827,7 @@ def check_package_restrictions(yum_output_packages, allowed_packages):
     :param check_packages:  
     :return: (conflicting packages, new packages)
     """
-
-    new_packages = []
-    conflicting_packages = []
-
-    for out_package in yum_output_packages:
-        allowed_list = [x for x in allowed_packages if x.name == out_package.name]
-
-        if len(allowed_list) == 0:
-            new_packages.append(out_package)
-            continue
-
-        # Sort packages based on the version, highest first.
-        if len(allowed_list) > 1:
-            allowed_list.sort(key=lambda x: x.version, reverse=True)
-
-        allowed = allowed_list[0]
-        if out_package.version > allowed.version:
-            conflicting_packages.append(out_package)
-
-    return conflicting_packages, new_packages
+    return PackageSet.coerce(allowed_packages).check_restrictions(yum_output_packages)
 
 
 def package_diff(a, b, only_in_b=False):
@@ -643,23 +842,145 @@ def package_diff(a, b, only_in_b=False):
     :param only_in_b: if True the element in a has to be in the b in the lower version.
     :return: 
     """
-    res = []
-    for pkg in a:
-        b_filtered = [x for x in b if x.name == pkg.name and x.arch == pkg.arch]
+    b_set = PackageSet.coerce(b)
+    return [pkg for pkg in a if b_set.is_outdated(pkg, only_present=only_in_b)]
 
-        # New package, not in b
-        if len(b_filtered) == 0:
-            if not only_in_b:
-                res.append(pkg)
-            continue
 
-        # Sort packages based on the version, highest first.
-        if len(b_filtered) > 1:
-            b_filtered.sort(key=lambda x: x.version, reverse=True)
+class PackageSet(object):
+    """
+    Set of packages indexed by (name, arch).
+    Keeps only the highest version of the package for each key so lookups,
+    diffs and restriction checks are linear in the number of packages.
+    """
+    def __init__(self, packages=None):
+        self._pkgs = collections.OrderedDict()
+        self._names = {}
+        if packages is not None:
+            self.update(packages)
 
-        # b contains smaller version of the package, add to the result
-        if b_filtered[0].version < pkg.version:
-            res.append(pkg)
+    @classmethod
+    def coerce(cls, packages):
+        """
+        Returns the argument if it is already a PackageSet, builds a new one otherwise
+        :param packages: 
+        :return: PackageSet
+        """
+        if isinstance(packages, PackageSet):
+            return packages
+        return cls(packages)
+
+    @staticmethod
+    def key(pkg):
+        """
+        Index key of the package
+        :param pkg: 
+        :return: (name, arch)
+        """
+        return pkg.name, pkg.arch
+
+    def add(self, pkg):
+        """
+        Adds package to the set. If there is the same package with higher version, the set is not changed.
+        :param pkg: 
+        :return: True if the package was added / replaced the older one
+        """
+        key = self.key(pkg)
+        cur = self._pkgs.get(key)
+        if cur is not None and cur.version >= pkg.version:
+            return False
+
+        self._pkgs[key] = pkg
+        cur_name = self._names.get(pkg.name)
+        if cur_name is None or cur_name.version < pkg.version:
+            self._names[pkg.name] = pkg
+        return True
+
+    def update(self, packages):
+        """
+        Adds all packages to the set
+        :param packages: 
+        :return: 
+        """
+        for pkg in packages:
+            self.add(pkg)
+        return self
+
+    def get(self, name, arch=None):
+        """
+        Returns the package with the highest version for (name, arch).
+        If arch is None the highest version among all architectures is returned.
+        :param name: 
+        :param arch: 
+        :return: PackageInfo or None
+        """
+        if arch is None:
+            return self._names.get(name)
+        return self._pkgs.get((name, arch))
+
+    def is_outdated(self, pkg, only_present=False):
+        """
+        Returns True if the set does not contain the package in the same or higher version.
+        :param pkg: 
+        :param only_present: if True the package has to be present in the set in the lower version.
+        :return: 
+        """
+        cur = self._pkgs.get(self.key(pkg))
+        if cur is None:
+            return not only_present
+        return cur.version < pkg.version
+
+    def diff(self, other, only_in_other=False):
+        """
+        Package diff self - other.
+        Package is removed if the same package (or higher version) is in other.
+        :param other: 
+        :param only_in_other: if True the package has to be in the other in the lower version.
+        :return: PackageSet
+        """
+        other = PackageSet.coerce(other)
+        return PackageSet([x for x in self if other.is_outdated(x, only_present=only_in_other)])
+
+    def intersect(self, other):
+        """
+        Packages from self having the same (name, arch) in other
+        :param other: 
+        :return: PackageSet
+        """
+        other = PackageSet.coerce(other)
+        return PackageSet([x for x in self if self.key(x) in other._pkgs])
+
+    def check_restrictions(self, packages):
+        """
+        Checks the packages (e.g., yum output packages) vs. this set as allowed packages.
+        Packages are matched by name, the highest allowed version is taken.
+        :param packages: 
+        :return: (conflicting packages, new packages)
+        """
+        new_packages = []
+        conflicting_packages = []
+
+        for pkg in packages:
+            allowed = self._names.get(pkg.name)
+            if allowed is None:
+                new_packages.append(pkg)
+            elif pkg.version > allowed.version:
+                conflicting_packages.append(pkg)
+
+        return conflicting_packages, new_packages
 
-    return res
+    def to_list(self):
+        return list(self._pkgs.values())
 
+    def __iter__(self):
+        return iter(self._pkgs.values())
+
+    def __len__(self):
+        return len(self._pkgs)
+
+    def __contains__(self, item):
+        if isinstance(item, tuple):
+            return item in self._pkgs
+        return self.key(item) in self._pkgs
+
+    def __repr__(self):
+        return 'PackageSet(%r)' % self.to_list()
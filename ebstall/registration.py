@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
 import logging
 from config import Config
 from core import Core
 from errors import *
 import requests
 import util
+import ec2meta
 import re
 import errors
 import consts
 import OpenSSL
 import json
 import base64
+import os
+import time
 from audit import AuditManager
 from datetime import datetime
 from ebclient.eb_configuration import *
@@ -56,10 +60,16 @@ class InfoLoader(object):
         self.ami_local_ip = None
         self.ami_public_hostname = None
         self.ec2_metadata_executable = None
+        self.ec2_metadata_url = ec2meta.IMDS_URL
         self.public_ip = None
         self.audit = audit
         self.sysconfig = sysconfig
 
+        # Detected public IP is cached there for public_ip_cache_ttl seconds, shared by successive runs
+        self.public_ip_cache_path = consts.PUBLIC_IP_CACHE
+        self.public_ip_cache_ttl = 120
+        self.public_ip_deadline = 30
+
     def env_check(self):
         for candidate in consts.EC2META_FILES:
             if util.exe_exists(candidate):
@@ -73,29 +83,74 @@ class InfoLoader(object):
     def _load_ip_eb(self, attempts=3):
         return util.determine_public_ip_eb(attempts=attempts, audit=self.audit)
 
-    def load(self):
-        self.env_check()
+    def load_public_ip(self):
+        """
+        Public IP address from the fresh cache, otherwise EB and ipify are queried concurrently,
+        the first valid answer wins.
+        :return: IP address or None if detection was not successful.
+        """
+        ip = self.load_public_ip_cache()
+        if ip is not None:
+            return ip
 
-        # removed options:
-        # -o local ip
-        # -c product codes
-        cmd = [self.ec2_metadata_executable] + ('-a -i -t -z -v -p -o'.split(' '))
-        ret, out, err = self.sysconfig.cli_cmd_sync(cmd)
+        ip = util.determine_public_ip_hedged([self._load_ip_eb, self._load_ipfy],
+                                             deadline=self.public_ip_deadline, audit=self.audit)
+        if ip is not None:
+            self.store_public_ip_cache(ip)
+        return ip
 
-        lines = [x.strip() for x in out]
-        self.ami_results = {}
-        for line in lines:
-            if len(line) == 0:
-                continue
+    def load_public_ip_cache(self):
+        """
+        Loads public IP from the cache if not older than the TTL
+        :return: IP address or None
+        """
+        if self.public_ip_cache_path is None or not os.path.exists(self.public_ip_cache_path):
+            return None
 
-            match = re.match(r'^\s*([a-zA-Z0-9-\s]+?)\s*:(.+)\s*$', line, re.I)
-            if match is None:
+        try:
+            with open(self.public_ip_cache_path, 'r') as fh:
+                cache = json.load(fh)
+
+            age = time.time() - cache.get('fetched', 0)
+            if age < 0 or age >= self.public_ip_cache_ttl or not util.is_ip_address(cache.get('ip')):
+                return None
+
+            if self.audit is not None:
+                self.audit.audit_evt('public-ip-cached', ip=cache['ip'], age=age)
+            return cache['ip']
+
+        except Exception as e:
+            logger.debug('Could not load public IP cache: %s' % e)
+            return None
+
+    def store_public_ip_cache(self, ip):
+        """
+        Stores the public IP to the cache
+        :param ip:
+        :return:
+        """
+        if self.public_ip_cache_path is None:
+            return
+
+        try:
+            util.make_or_verify_dir(os.path.dirname(self.public_ip_cache_path), mode=0o755)
+            util.write_if_changed(self.public_ip_cache_path, json.dumps({'ip': ip, 'fetched': time.time()}),
+                                  chmod=0o644, backup=False)
+
+        except Exception as e:
+            logger.debug('Could not store public IP cache: %s' % e)
+
+    def load(self):
+        results = self.load_ec2_metadata()
+        if results is None:
+            results = self.load_ec2_metadata_script()
+
+        self.ami_results = {}
+        for c_key, c_val in results.items():
+            if c_val is None:
                 continue
 
-            c_key = match.group(1).strip()
-            c_val = match.group(2).strip()
             self.ami_results[c_key] = c_val
-
             if c_key == self.AMI_KEY_ID:
                 self.ami_id = c_val
             elif c_key == self.AMI_KEY_INSTANCE_ID:
@@ -114,9 +169,45 @@ class InfoLoader(object):
                 self.ami_public_hostname = c_val
 
         # load public IP
-        self.public_ip = self._load_ip_eb()
-        if self.public_ip is None:
-            self.public_ip = self._load_ipfy()
+        self.public_ip = self.load_public_ip()
+
+    def load_ec2_metadata(self):
+        """
+        Loads instance metadata from the metadata service directly, once per process
+        :return: dict key -> value or None if the metadata service is not available
+        """
+        results = ec2meta.get_instance_metadata(base_url=self.ec2_metadata_url)
+        if self.audit is not None:
+            self.audit.audit_evt('ec2-metadata', native=True, loaded=results is not None)
+        return results
+
+    def load_ec2_metadata_script(self):
+        """
+        Loads instance metadata with the ec2-metadata script, fallback for the metadata service client.
+        :return: dict key -> value
+        """
+        self.env_check()
+
+        # removed options:
+        # -o local ip
+        # -c product codes
+        cmd = [self.ec2_metadata_executable] + ('-a -i -t -z -v -p -o'.split(' '))
+        ret, out, err = self.sysconfig.cli_cmd_sync(cmd)
+
+        results = collections.OrderedDict()
+        for line in [x.strip() for x in out]:
+            if len(line) == 0:
+                continue
+
+            match = re.match(r'^\s*([a-zA-Z0-9-\s]+?)\s*:(.+)\s*$', line, re.I)
+            if match is None:
+                continue
+
+            results[match.group(1).strip()] = match.group(2).strip()
+
+        if self.audit is not None:
+            self.audit.audit_evt('ec2-metadata', native=False, loaded=len(results) > 0)
+        return results
 
 
 class EBRegAuth(object):
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Import time profiler for the CLI startup.
+Uses only the standard library so it can be installed before anything heavy is imported.
+"""
+
+from __future__ import print_function
+import collections
+import sys
+import threading
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:  # pragma: no cover
+    import builtins
+
+
+__author__ = 'dusanklinec'
+
+
+class ImportProfiler(object):
+    """
+    Wraps the builtin __import__ and measures the time spent loading each new module.
+    Cumulative time includes modules imported by the module, self time does not.
+    Only the thread that installed the profiler is measured.
+    """
+    def __init__(self):
+        self.records = collections.OrderedDict()
+        self.time_start = None
+        self._orig_import = None
+        self._thread = None
+        self._stack = []
+
+    def install(self):
+        if self._orig_import is not None:
+            return
+        self._orig_import = builtins.__import__
+        self._thread = threading.current_thread()
+        self.time_start = time.time()
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._orig_import is None:
+            return
+        builtins.__import__ = self._orig_import
+        self._orig_import = None
+
+    def _import(self, name, *args, **kwargs):
+        if threading.current_thread() is not self._thread:
+            return self._orig_import(name, *args, **kwargs)
+
+        modules_before = len(sys.modules)
+        self._stack.append(0.0)
+        time_start = time.time()
+        try:
+            return self._orig_import(name, *args, **kwargs)
+        finally:
+            cumulative = time.time() - time_start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += cumulative
+
+            # Already loaded modules are just a dictionary lookup, not reported
+            if len(sys.modules) > modules_before:
+                module = self._resolve(name, *args)
+                if module not in self.records:
+                    self.records[module] = (cumulative, cumulative - children)
+
+    @staticmethod
+    def _resolve(name, globals_=None, *args):
+        """
+        Full module name, implicit relative imports are resolved against the importing package
+        :param name:
+        :param globals_:
+        :return:
+        """
+        if name in sys.modules or not globals_:
+            return name
+
+        package = globals_.get('__package__') or globals_.get('__name__', '').rpartition('.')[0]
+        if package and '%s.%s' % (package, name) in sys.modules:
+            return '%s.%s' % (package, name)
+        return name
+
+    def total(self):
+        """
+        Time since the profiler was installed
+        :return:
+        """
+        return time.time() - self.time_start if self.time_start is not None else 0.0
+
+    def report(self, limit=40, out=None):
+        """
+        Prints modules sorted by the cumulative import time
+        :param limit: number of modules reported
+        :param out: output stream, stderr by default
+        :return:
+        """
+        out = out if out is not None else sys.stderr
+        records = sorted(self.records.items(), key=lambda x: x[1][0], reverse=True)
+
+        print('Startup import profile, %d modules, total %.3f s' % (len(records), self.total()), file=out)
+        print('%12s %12s  %s' % ('cumulative', 'self', 'module'), file=out)
+        for name, (cumulative, self_time) in records[:limit]:
+            print('%10.1f ms %10.1f ms  %s' % (1000.0 * cumulative, 1000.0 * self_time, name), file=out)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro benchmarks of the performance sensitive parts.
+Not collected by the test runner, run manually:
+
+    python -m ebstall.tests.bench [name ...]
+"""
+
+from __future__ import print_function
+
+import subprocess
+import sys
+import timeit
+import pkg_resources
+
+import ebstall.osutil as osutil
+from ebstall.deployers.openvpn import OpenVpnConfig
+from ebstall.iptables import IptablesModel
+
+
+__author__ = 'dusanklinec'
+
+
+BENCHMARKS = []
+
+
+def benchmark(number=10):
+    """
+    Registers benchmark function
+    :param number: number of executions
+    :return: 
+    """
+    def wrapper(fnc):
+        BENCHMARKS.append((fnc.__name__, fnc, number))
+        return fnc
+    return wrapper
+
+
+def get_res(name):
+    """
+    Loads test data resource
+    :param name: 
+    :return: 
+    """
+    return pkg_resources.resource_string('ebstall.tests', '/'.join(('data', name)))
+
+
+def yum_list_installed_output(packages=5000):
+    """
+    yum list installed output, long package names are wrapped to the next line as yum does
+    :param packages: 
+    :return: 
+    """
+    names = ['kernel', 'glibc', 'openssl-libs', 'python27-botocore', 'java-1.8.0-openjdk-headless-debuginfo',
+             'perl-Data-Dumper', 'libselinux-utils', 'cloud-init', 'ntp', 'mysql57-server']
+    archs = ['x86_64', 'noarch', 'i686']
+    repos = ['@amzn-main', '@amzn-updates', '@epel']
+
+    lines = ['Loaded plugins: priorities, update-motd, upgrade-helper', 'Installed Packages']
+    for i in range(packages):
+        name = '%s-%d.%s' % (names[i % len(names)], i, archs[i % len(archs)])
+        version = '%d.%d.%d-%d.amzn1' % (i % 7, i % 13, i % 101, i % 31)
+        if len(name) >= 40:
+            lines += [name, '%-40s%-31s%s' % ('', version, repos[i % len(repos)])]
+        else:
+            lines.append('%-40s%-31s%s' % (name, version, repos[i % len(repos)]))
+    return '\n'.join(lines) + '\n'
+
+
+@benchmark(number=20)
+def yum_list_installed():
+    output = yum_list_installed_output()
+    return lambda: osutil.get_yum_packages(output)
+
+
+@benchmark(number=20)
+def yum_list_installed_stream():
+    lines = yum_list_installed_output().splitlines(True)
+    return lambda: sum(1 for _ in osutil.iter_yum_packages(iter(lines)))
+
+
+@benchmark(number=20)
+def rpm_queryformat():
+    output = get_res('rpm_qa_queryformat') * 250
+    return lambda: osutil.get_rpm_packages(output)
+
+
+@benchmark(number=20)
+def dpkg_status():
+    output = (get_res('dpkg_status') + '\n') * 700
+    return lambda: sum(1 for _ in osutil.iter_dpkg_status(output))
+
+
+def openvpn_large_config(routes=2000):
+    """
+    Server config with many push / route lines and inline certificates
+    :param routes: 
+    :return: 
+    """
+    pem = '\n'.join(['-----BEGIN CERTIFICATE-----'] + ['A' * 64] * 30 + ['-----END CERTIFICATE-----'])
+    lines = ['port 1194', 'proto udp', 'dev tun', '# Routes']
+    for i in range(routes):
+        lines.append('push "route 10.%d.%d.0 255.255.255.0"' % (i // 256, i % 256))
+        lines.append('route 10.%d.%d.0 255.255.255.0' % (i // 256, i % 256))
+        if i % 10 == 0:
+            lines.append(';push "dhcp-option DNS 10.%d.%d.1"  # disabled' % (i // 256, i % 256))
+    for tag in ['ca', 'cert', 'key']:
+        lines += ['<%s>' % tag, pem, '</%s>' % tag]
+    lines += ['keepalive 10 120', 'persist-tun']
+    return '\n'.join(lines)
+
+
+def openvpn_server_values():
+    return [('port', '443'), ('proto', 'tcp'), ('server', '10.8.0.0 255.255.255.0'), ('dh', 'dh2048.pem'),
+            ('ca', 'ca.crt'), ('cert', 'server.crt'), ('key', 'server.key'), ('status', 'openvpn-status.log 10'),
+            ('client-to-client', None), ('persist-tun', None), ('keepalive', '2 20'), ('topology', 'subnet'),
+            ('cipher', 'AES-256-CBC'), ('auth', 'SHA256'), ('user', 'nobody'), ('group', 'nobody'),
+            ('push', ['"redirect-gateway def1 bypass-dhcp"', '"sndbuf 393216"', '"rcvbuf 393216"'])]
+
+
+@benchmark(number=10)
+def openvpn_load():
+    config = openvpn_large_config()
+    return lambda: OpenVpnConfig(static_config=config).load()
+
+
+@benchmark(number=10)
+def openvpn_set_sequential():
+    config = openvpn_large_config()
+
+    def run():
+        parser = OpenVpnConfig(static_config=config)
+        parser.load()
+        for cmd, values in openvpn_server_values():
+            parser.set_config_value(cmd, values)
+        parser.set_config_value('comp-lzo', remove=True)
+    return run
+
+
+@benchmark(number=10)
+def openvpn_set_many():
+    config = openvpn_large_config()
+
+    def run():
+        parser = OpenVpnConfig(static_config=config)
+        parser.load()
+        parser.set_many(openvpn_server_values(), remove=['comp-lzo'])
+    return run
+
+
+def iptables_large_ruleset(rules=3000):
+    """
+    iptables-save output with many port rules
+    :param rules: 
+    :return: 
+    """
+    lines = get_res('iptables_save').split('\n')
+    extra = ['-A INPUT -s 10.%d.%d.0/24 -p tcp -m tcp --dport %d -j ACCEPT' % (i // 256, i % 256, 10000 + i)
+             for i in range(rules)]
+    idx = lines.index('-A INPUT -i lo -j ACCEPT')
+    return lines[:idx] + extra + lines[idx:]
+
+
+@benchmark(number=10)
+def iptables_parse():
+    lines = iptables_large_ruleset()
+    return lambda: IptablesModel.parse(lines)
+
+
+@benchmark(number=10)
+def iptables_find():
+    model = IptablesModel.parse(iptables_large_ruleset())
+
+    def run():
+        for port in range(9900, 10100):
+            model.find(table='filter', chain='INPUT', target='ACCEPT', proto='tcp', dport=port)
+    return run
+
+
+@benchmark(number=5)
+def cli_cold_start():
+    """
+    Fresh interpreter importing the CLI entry points, the lazy imports are asserted by ColdStartTest
+    """
+    cmd = [sys.executable, '-c', 'import ebstall.clirouter, ebstall.cli, ebstall.clivpn']
+    return lambda: subprocess.check_call(cmd)
+
+
+def main(names=None):
+    for name, fnc, number in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        stmt = fnc()
+        total = timeit.timeit(stmt, number=number)
+        print('%-40s %10.3f ms' % (name, 1000.0 * total / number))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+__author__ = 'dusanklinec'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class LocalHTTPServer(object):
+    """
+    Local HTTP stand-in for the tests, bound to a free port and served from a daemon thread.
+    Use as a context manager or call start() / stop() from setUp / tearDown.
+    Keyword arguments are set on the server, the handler reads them via self.server.
+    """
+
+    def __init__(self, handler, **kwargs):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        for key, val in kwargs.items():
+            setattr(self.server, key, val)
+
+        self.port = self.server.server_address[1]
+        self.url = 'http://127.0.0.1:%d/' % self.port
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
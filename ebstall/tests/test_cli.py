@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+from ebstall.config import Config
+
+try:
+    import ebstall.cli as cli
+except ImportError:  # letsencrypt deployer dependencies not installed
+    cli = None
+
+
+__author__ = 'dusanklinec'
+
+
+@unittest.skipIf(cli is None, 'installer dependencies not installed')
+class OnbootFingerprintTest(unittest.TestCase):
+    """Onboot fast path"""
+
+    def _config(self, private=False):
+        config = Config()
+        config.domains = ['hs1.umph.io']
+        config.last_ipv4 = '52.1.2.3'
+        config.last_ipv4_private = '172.31.1.2'
+        config.is_private_network = private
+        return config
+
+    def _matches(self, config, local_ip='172.31.1.2', public_ip='52.1.2.3', dns=None):
+        installer = mock.Mock(spec=cli.Installer)
+        installer.audit = mock.Mock()
+        installer.onboot_public_ip.return_value = public_ip
+        with mock.patch('ebstall.util.get_primary_ipv4', return_value=local_ip), \
+                mock.patch('ebstall.util.resolve_ipv4', return_value=dns if dns is not None else ['52.1.2.3']):
+            return cli.Installer.onboot_fingerprint_matches(installer, config)
+
+    def test_unchanged(self):
+        self.assertTrue(self._matches(self._config()))
+        self.assertTrue(self._matches(self._config(private=True), public_ip=None, dns=['172.31.1.2']))
+
+    def test_changed(self):
+        self.assertFalse(self._matches(self._config(), local_ip='172.31.9.9'))
+        self.assertFalse(self._matches(self._config(), public_ip='52.9.9.9'))
+        self.assertFalse(self._matches(self._config(), public_ip=None))
+        self.assertFalse(self._matches(self._config(), dns=[]))
+
+        config = self._config()
+        config.domains = []
+        self.assertFalse(self._matches(config))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import time
+import unittest
+
+import mock
+from six.moves import BaseHTTPServer
+
+import ebstall.ec2meta as ec2meta
+from ebstall.registration import InfoLoader
+from ebstall.tests.httpserver import LocalHTTPServer
+
+
+__author__ = 'dusanklinec'
+
+
+METADATA = {
+    'ami-id': 'ami-12345678',
+    'instance-id': 'i-0123456789abcdef0',
+    'instance-type': 't2.medium',
+    'placement/availability-zone': 'eu-west-1a',
+    'public-hostname': 'ec2-52-1-2-3.eu-west-1.compute.amazonaws.com',
+    'local-ipv4': '172.31.1.2',
+}
+
+
+class MetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for the instance metadata service"""
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        self.server.token_requests += 1
+        if not self.server.v2:
+            return self._reply(405)
+        return self._reply(200, b'token-abc')
+
+    def do_GET(self):
+        if self.server.v2 and self.headers.get('X-aws-ec2-metadata-token') != 'token-abc':
+            return self._reply(401)
+
+        time.sleep(self.server.delay)
+        path = self.path[len('/latest/meta-data/'):]
+        if path not in METADATA:
+            return self._reply(404)
+        return self._reply(200, METADATA[path].encode('utf-8'))
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class Ec2MetadataTest(unittest.TestCase):
+    """Instance metadata client"""
+
+    def setUp(self):
+        ec2meta.reset_cache()
+        self.httpd = LocalHTTPServer(MetadataHandler, v2=True, delay=0.0, token_requests=0).start()
+        self.server = self.httpd.server
+        self.url = 'http://127.0.0.1:%d' % self.httpd.port
+
+    def tearDown(self):
+        self.httpd.stop()
+        ec2meta.reset_cache()
+
+    def test_fetch(self):
+        self.server.delay = 0.2
+        time_start = time.time()
+        res = ec2meta.get_instance_metadata(base_url=self.url)
+        self.assertLess(time.time() - time_start, 1.0)
+
+        self.assertEqual(list(res.keys()), list(ec2meta.METADATA_KEYS.keys()))
+        self.assertEqual(res['placement'], 'eu-west-1a')
+        self.assertEqual(res['local-ipv4'], '172.31.1.2')
+        self.assertIsNone(res['public-ipv4'])
+        self.assertEqual(self.server.token_requests, 1)
+
+    def test_v1(self):
+        self.server.v2 = False
+        res = ec2meta.get_instance_metadata(base_url=self.url)
+        self.assertEqual(res['instance-id'], 'i-0123456789abcdef0')
+
+    def test_cache(self):
+        res = ec2meta.get_instance_metadata(base_url=self.url)
+        res['instance-id'] = 'modified'
+
+        res = ec2meta.get_instance_metadata(base_url=self.url)
+        self.assertEqual(res['instance-id'], 'i-0123456789abcdef0')
+        self.assertEqual(self.server.token_requests, 1)
+
+        ec2meta.get_instance_metadata(base_url=self.url, refresh=True)
+        self.assertEqual(self.server.token_requests, 2)
+
+    def test_info_loader(self):
+        info = InfoLoader()
+        info.ec2_metadata_url = self.url
+        info.load_public_ip = mock.Mock(return_value='52.1.2.3')
+        info.load()
+
+        self.assertEqual(info.ami_instance_type, 't2.medium')
+        self.assertEqual(info.ami_placement, 'eu-west-1a')
+        self.assertIsNone(info.ami_public_ip)
+        self.assertNotIn('public-ipv4', info.ami_results)
+        self.assertEqual(info.public_ip, '52.1.2.3')
+
+    def test_script_fallback(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        closed_url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+
+        syscfg = mock.Mock()
+        syscfg.cli_cmd_sync.return_value = (0, ['ami-id: ami-87654321\n', 'public-ipv4: 52.1.2.3\n'], [])
+
+        info = InfoLoader(sysconfig=syscfg)
+        info.ec2_metadata_url = closed_url
+        info.env_check = mock.Mock()
+        info.ec2_metadata_executable = '/opt/aws/bin/ec2-metadata'
+        info.load_public_ip = mock.Mock(return_value=None)
+        info.load()
+
+        self.assertEqual(info.ami_id, 'ami-87654321')
+        self.assertEqual(info.ami_public_ip, '52.1.2.3')
+        self.assertIsNone(ec2meta.get_instance_metadata(base_url=closed_url))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+from six.moves import BaseHTTPServer
+
+import ebstall.httpclient as httpclient
+from ebstall.tests.httpserver import LocalHTTPServer
+
+
+__author__ = 'dusanklinec'
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive responder, first server.failures requests get 503"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.hits += 1
+        status = 503 if self.server.hits <= self.server.failures else 200
+        body = b'ok'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class SessionTest(unittest.TestCase):
+    """Pooled session"""
+
+    def setUp(self):
+        self.httpd = LocalHTTPServer(KeepAliveHandler, hits=0, failures=0).start()
+        self.server = self.httpd.server
+        self.url = self.httpd.url
+
+    def tearDown(self):
+        self.httpd.stop()
+
+    def test_keep_alive(self):
+        session = httpclient.new_session()
+        for _ in range(10):
+            self.assertEqual(session.get(self.url).text, 'ok')
+
+        stats = httpclient.get_stats(session)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(list(stats['hosts'].keys()), ['http://127.0.0.1:%d' % self.httpd.port])
+
+    def test_retry(self):
+        self.server.failures = 2
+        session = httpclient.new_session(backoff=0)
+        self.assertEqual(session.get(self.url).status_code, 200)
+        self.assertEqual(self.server.hits, 3)
+
+        # Retries exhausted, last response returned
+        self.server.hits, self.server.failures = 0, 5
+        self.assertEqual(session.get(self.url).status_code, 503)
+        self.assertEqual(self.server.hits, 3)
+
+    def test_shared(self):
+        httpclient.reset_session()
+        self.assertEqual(httpclient.get_stats()['connections'], 0)
+        self.assertIs(httpclient.get_session(), httpclient.get_session())
+
+        httpclient.get(self.url)
+        httpclient.get(self.url)
+        self.assertEqual(httpclient.get_stats()['connections'], 1)
+        httpclient.reset_session()
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
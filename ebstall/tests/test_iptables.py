@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import pkg_resources
+
+from ebstall.iptables import IptablesModel, parse_rule, restore_input
+
+
+__author__ = 'dusanklinec'
+
+
+class IptablesModelTest(unittest.TestCase):
+    """iptables-save model"""
+
+    def setUp(self):
+        self.output = pkg_resources.resource_string(__name__, 'data/iptables_save')
+        self.model = IptablesModel.parse(self.output)
+
+    def test_parse(self):
+        self.assertEqual(list(self.model.tables.keys()), ['nat', 'filter'])
+        filt = self.model.tables['filter']
+        self.assertEqual(list(filt.chains.keys()), ['INPUT', 'FORWARD', 'OUTPUT'])
+        self.assertEqual(filt.chains['OUTPUT'].policy, 'ACCEPT')
+        self.assertEqual(filt.chains['OUTPUT'].counters, '[2451:318207]')
+        self.assertEqual(len(filt.chains['INPUT'].rules), 8)
+
+        rule = filt.chains['INPUT'].rules[6]
+        self.assertEqual(rule.src, '192.168.1.0/24')
+        self.assertEqual(rule.proto, 'tcp')
+        self.assertEqual(rule.dport, '3306')
+        self.assertEqual(rule.target, 'DROP')
+
+    def test_parse_rule(self):
+        rule = parse_rule('-A INPUT ! -s 10.0.0.0/8 --protocol TCP --destination-port 443 '
+                          '-m comment --comment "web server" -j ACCEPT', table='filter')
+        self.assertIsNone(rule.src)
+        self.assertEqual(rule.proto, 'tcp')
+        self.assertEqual(rule.dport, '443')
+        self.assertEqual(rule.get('--comment'), 'web server')
+        self.assertIn(('-s', '10.0.0.0/8', True), rule.options)
+
+    def test_find(self):
+        res = self.model.find(table='filter', chain='INPUT', target='ACCEPT', proto='tcp', dport=8442)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].raw, '-A INPUT -p tcp -m state --state NEW -m tcp --dport 8442 -j ACCEPT')
+
+        self.assertEqual(len(self.model.find(table='filter', target='ACCEPT', proto='udp', dport=1194)), 1)
+        self.assertEqual(len(self.model.find(table='filter', target='ACCEPT', proto='tcp', dport=1194)), 0)
+        self.assertEqual(len(self.model.find(table='filter', target='ACCEPT', dport=3306)), 0)
+
+        res = self.model.find(table='nat', chain='POSTROUTING', target='MASQUERADE', src='10.8.0.0/24')
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].out_iface, 'eth0')
+        self.assertEqual(len(self.model.find(target='REJECT')), 2)
+
+    def test_add_rule(self):
+        rule = '-A INPUT -m state --state NEW -m tcp -p tcp --dport 8442 -j ACCEPT'
+        self.assertTrue(self.model.has_rule(parse_rule(rule, table='filter')))
+        self.assertFalse(self.model.has_rule(parse_rule(rule, table='nat')))
+
+        new_rule = self.model.add_rule('filter', '-A INPUT -m udp -p udp --dport 53 -j ACCEPT')
+        self.assertEqual(self.model.find(proto='udp', dport=53), [new_rule])
+
+    def test_diff_dumps(self):
+        model2 = IptablesModel.parse(self.model.dumps())
+        self.assertEqual(self.model.diff(model2), ([], []))
+        self.assertEqual(model2.dumps(), self.model.dumps())
+
+        added = model2.add_rule('filter', '-A INPUT -p tcp -m tcp --dport 443 -j ACCEPT')
+        removed = self.model.tables['nat'].chains['POSTROUTING'].rules[0]
+        del model2.tables['nat'].chains['POSTROUTING'].rules[0]
+        model2 = IptablesModel.parse(model2.dumps())
+
+        added_rules, removed_rules = self.model.diff(model2)
+        self.assertEqual([x.raw for x in added_rules], [added.raw])
+        self.assertEqual([x.raw for x in removed_rules], [removed.raw])
+
+        self.assertEqual(restore_input(added_rules),
+                         '*filter\n-A INPUT -p tcp -m tcp --dport 443 -j ACCEPT\nCOMMIT\n')
+        self.assertEqual(restore_input([]), '')
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
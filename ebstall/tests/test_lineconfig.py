@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from ebstall.lineconfig import LineConfig
+from ebstall.sysctlparser import SysctlConfig
+from ebstall.deployers.php import IniParser
+
+
+__author__ = 'dusanklinec'
+
+
+sysctl1 = """net.ipv4.ip_forward = 1
+# Controls the maximum size of a message, in bytes
+kernel.msgmax = 65536   # hello-comment test
+#kernel.msgmax = 65536
+kernel.shmmax = 68719476736"""
+
+www1 = """; Start a new pool named 'www'.
+[www]
+
+; Unix user/group of processes
+user = apache
+; RPM: Keep a group allowed to write in log dir.
+group = apache
+;listen.owner = nobody
+php_value[session.save_path]    = /var/lib/php/session
+userlist = x"""
+
+
+class LineConfigTest(unittest.TestCase):
+    """Indexed line config engine"""
+
+    def test_abstract(self):
+        class Incomplete(LineConfig):
+            def load_config_file_lines(self):
+                return []
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_lookup(self):
+        parser = SysctlConfig(static_config=sysctl1)
+        parser.load()
+        self.assertEqual(parser.get_value('kernel.msgmax'), '65536')
+        self.assertEqual(len(parser.get_lines('kernel.msgmax')), 2)
+        self.assertIsNone(parser.get_value('vm.swappiness'))
+
+    def test_dirty(self):
+        parser = SysctlConfig(static_config=sysctl1)
+        parser.load()
+        self.assertFalse(parser.set_config_value('net.ipv4.ip_forward', '1'))
+        self.assertFalse(parser.config_modified)
+        self.assertEqual(parser.get_dirty_lines(), [])
+
+        self.assertTrue(parser.set_many([('kernel.msgmax', '1024'), ('vm.swappiness', '10')]))
+        self.assertTrue(parser.config_modified)
+        dirty = parser.get_dirty_lines()
+        self.assertEqual(len(dirty), 3)
+        self.assertEqual([x.raw for x in dirty], [';kernel.msgmax = 65536 # hello-comment test',
+                                                  'kernel.msgmax = 1024', 'vm.swappiness = 10'])
+
+        # new kernel.msgmax placed after the last occurrence
+        self.assertEqual(parser.config_data[4].raw, 'kernel.msgmax = 1024')
+        self.assertEqual(parser.get_value('kernel.msgmax'), '1024')
+
+        parser.reset_dirty()
+        self.assertFalse(parser.config_modified)
+        self.assertEqual(parser.get_dirty_lines(), [])
+
+
+class IniParserTest(unittest.TestCase):
+    """php ini parser on the line config engine"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get(self):
+        ini = IniParser(file_data=www1)
+        self.assertEqual(ini.get_value('user'), 'apache')
+        self.assertEqual(ini.get_value('php_value[session.save_path]'), '/var/lib/php/session')
+        self.assertIsNone(ini.get_value('listen.owner'))
+        self.assertIsNone(ini.get_value('session.save_path'))
+
+    def test_set(self):
+        ini = IniParser(file_data=www1)
+        ini.set_value('user', 'nginx')
+        ini.set_value('group', 'apache')
+        ini.set_value('listen.owner', 'nginx')
+        ini.set_value('cgi.fix_pathinfo', 1)
+
+        data = ini.data
+        self.assertEqual(data[4], 'user = nginx')
+        self.assertEqual(data[6], 'group = apache')
+        self.assertEqual(data[7], ';listen.owner = nobody')
+        self.assertEqual(data[8], 'listen.owner = nginx')
+        self.assertEqual(data[9], 'php_value[session.save_path]    = /var/lib/php/session')
+        self.assertEqual(data[-1], 'cgi.fix_pathinfo = 1')
+        self.assertEqual(len(ini.get_dirty_lines()), 3)
+
+    def test_flush(self):
+        fname = os.path.join(self.tmpdir, 'www.conf')
+        with open(fname, 'w') as fh:
+            fh.write(www1)
+
+        ini = IniParser(file_name=fname)
+        ini.set_value('user', 'apache')
+        self.assertFalse(ini.dirty)
+        os.utime(fname, (1000, 1000))
+        ini.flush()
+        self.assertEqual(os.path.getmtime(fname), 1000)
+
+        ini.set_value('user', 'nginx')
+        ini.set_value('group', 'nginx', remove=True)
+        self.assertTrue(ini.dirty)
+        ini.flush()
+        self.assertFalse(ini.dirty)
+
+        ini2 = IniParser(file_name=fname)
+        self.assertEqual(ini2.get_value('user'), 'nginx')
+        self.assertIsNone(ini2.get_value('group'))
+        self.assertEqual(ini2.get_value('userlist'), 'x')
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nginxparser_eb
+
+import ebstall.util as util
+
+try:
+    import ebstall.deployers.nginx as nginx
+except ImportError:  # letsencrypt deployer dependencies not installed
+    nginx = None
+
+
+__author__ = 'dusanklinec'
+
+
+nginx1 = """user nginx;
+worker_processes auto;
+
+http {
+    index   index.html index.htm;
+    include /etc/nginx/conf.d/*.conf;
+
+    server {
+        listen       80 default_server;
+        listen       [::]:80 default_server;
+        root         /usr/share/nginx/html;
+    }
+
+    server {
+        listen       8080;
+        root         /var/www/other;
+    }
+
+    server {
+        listen       443 default_server;
+        root         /usr/share/nginx/html;
+    }
+}
+"""
+
+
+@unittest.skipIf(nginx is None, 'nginx deployer dependencies not installed')
+class NginxParseCacheTest(unittest.TestCase):
+    """Nginx config parse cache & model edits"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg_path = os.path.join(self.tmpdir, 'nginx.conf')
+        with open(self.cfg_path, 'w') as fh:
+            fh.write(nginx1)
+
+        self.cache = nginx.NginxParseCache()
+        self.cache_patch = mock.patch.object(nginx, '_PARSE_CACHE', self.cache)
+        self.cache_patch.start()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _nginx(self):
+        ngx = nginx.Nginx()
+        ngx.get_config_file_path = lambda: self.cfg_path
+        return ngx
+
+    def test_parse_once(self):
+        parser_cls = nginxparser_eb.NginxParser
+        with mock.patch.object(nginxparser_eb, 'NginxParser', side_effect=parser_cls) as parser:
+            ngx = self._nginx()
+            ngx._load_nginx_config()
+
+            # parse of the file + verification parse of the dump (same text)
+            self.assertEqual(parser.call_count, 1)
+            self.assertEqual(len(self.cache.verified), 1)
+
+            ngx2 = self._nginx()
+            ngx2._load_nginx_config()
+            ngx2._rebuild_cfg_model()
+            self.assertEqual(parser.call_count, 1)
+
+        # Cached parse is not shared with the previous model
+        ngx2.config_root.raw[0][1] = 'root'
+        self.assertEqual(ngx.config_root.raw[0][1], 'nginx')
+
+    def test_disable_default_server(self):
+        ngx = self._nginx()
+        ngx._load_nginx_config()
+        root = ngx.config_root
+        ngx._disable_default_server()
+
+        # Model updated in place
+        self.assertIs(ngx.config_root, root)
+        servers = nginxparser_eb.find_in_model(ngx.config_root, ['http', 'server'])
+        self.assertEqual(len(servers), 1)
+
+        with open(self.cfg_path) as fh:
+            data = fh.read()
+        self.assertNotIn('default_server', data)
+        self.assertIn('8080', data)
+
+        # Model matches the raw config
+        ngx._rebuild_cfg_model()
+        servers = nginxparser_eb.find_in_model(ngx.config_root, ['http', 'server'])
+        self.assertEqual(len(servers), 1)
+
+    def _configured_nginx(self, sysconfig):
+        ngx = self._nginx()
+        ngx.sysconfig = sysconfig
+        ngx._load_nginx_config()
+        ngx.http_include = os.path.join(self.tmpdir, 'conf.d')
+        ngx.html_root = os.path.join(self.tmpdir, 'html')
+        util.make_or_verify_dir(ngx.http_include)
+        return ngx
+
+    def test_restart_if_changed(self):
+        sysconfig = mock.MagicMock()
+        sysconfig.switch_svc.return_value = 0
+        sysconfig.svc_is_running.return_value = True
+
+        ngx = self._configured_nginx(sysconfig)
+        self.assertTrue(ngx.configure_server())
+        self.assertTrue(os.path.exists(os.path.join(ngx.http_include, 'default.conf')))
+        self.assertEqual(ngx.restart_if_changed(), 0)
+        self.assertEqual(sysconfig.switch_svc.call_count, 1)
+
+        # Same configuration again, running server is not restarted
+        ngx = self._configured_nginx(sysconfig)
+        self.assertFalse(ngx.configure_server())
+        self.assertEqual(ngx.restart_if_changed(), 0)
+        self.assertEqual(sysconfig.switch_svc.call_count, 1)
+
+        # Changed configuration triggers the restart
+        ngx.internal_addresses = ['10.8.0.0/24']
+        self.assertTrue(ngx.configure_server())
+        self.assertEqual(ngx.restart_if_changed(), 0)
+        self.assertEqual(sysconfig.switch_svc.call_count, 2)
+
+        # Server not running is started even without a change
+        sysconfig.svc_is_running.return_value = False
+        self.assertFalse(ngx.configure_server())
+        self.assertEqual(ngx.restart_if_changed(), 0)
+        self.assertEqual(sysconfig.switch_svc.call_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
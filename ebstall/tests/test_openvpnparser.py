@@ -240,6 +240,45 @@ class OpenVpnParserTest(unittest.TestCase):
         self.assertEqual(data[0].ltype, 2)
         self.assertEqual(data[1].ltype, 3)
 
+    def test_set_many(self):
+        values = [('key', 'client.key'), ('push', ['beta', 'omega']), ('persist-tun', None), ('proto', 'tcp'),
+                  ('cipher', 'AES-256-CBC'), ('auth', 'SHA256')]
+        remove = ['client-to-client', 'resolv-retry']
+
+        for cfg in [test1, test5, test7, '\n'.join([test1, test5, test7])]:
+            parser = OpenVpnConfig(static_config=cfg)
+            parser.load()
+            for cmd, vals in values:
+                parser.set_config_value(cmd, vals)
+            for cmd in remove:
+                parser.set_config_value(cmd, remove=True)
+
+            parser2 = OpenVpnConfig(static_config=cfg)
+            parser2.load()
+            self.assertTrue(parser2.set_many(values, remove=remove))
+            self.assertTrue(parser2.config_modified)
+            self.assertEqual(parser2.dump(), parser.dump())
+            self.assertFalse(parser2.set_many(values, remove=remove))
+
+    def test_index(self):
+        parser = OpenVpnConfig(static_config=test7)
+        parser.load()
+        parser.set_config_value('remote', ['a 1194', 'b 1194'])
+        parser.set_config_value('persist-tun', remove=True)
+        parser.set_config_value('ca', 'ca.crt')
+
+        # Incrementally maintained index equals the fresh one
+        index = dict((k, list(v)) for k, v in parser._index.items() if len(v) > 0)
+        parser._build_index()
+        self.assertEqual(index, dict(parser._index))
+        for cmd, positions in index.items():
+            self.assertTrue(all(parser.config_data[x].cmd == cmd for x in positions))
+
+        # ca directive inserted after the inline <ca> block, which is commented out
+        self.assertEqual(parser.config_data[index['ca'][0]].ltype, 2)
+        self.assertEqual(parser.config_data[index['ca'][1]].raw, 'ca ca.crt')
+
+
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover
 
@@ -48,6 +48,154 @@ class YumParserTest(unittest.TestCase):
         vim_pkg = [x for x in pkgs if x.name == 'vim-common'][0]
         self.assertEqual(str(vim_pkg.version), '2:8.0.0503-1.45.amzn1')
 
+    def test_yum_update_stream(self):
+        output = self._get_res("yum_update_list")
+        pkgs = list(osutil.iter_yum_packages_update(iter(output.splitlines(True))))
+        self.assertEqual(len(pkgs), 41)
+        self.assertEqual(len([x for x in pkgs if x.section == 'Installing for dependencies']), 2)
+
+    def test_yum_transcript_parser(self):
+        output = self._get_res("yum_update_list")
+        prompt_at = output.index('Is this ok')
+
+        parser = osutil.YumTranscriptParser()
+        for idx in range(0, prompt_at + 20, 7):
+            parser.feed(output[idx:min(idx + 7, prompt_at + 20)])
+            if parser.table_done:
+                break
+
+        # Table finished on the 3rd ===== line, before the question
+        self.assertTrue(parser.table_done)
+        self.assertTrue(output.index('Transaction Summary') < idx < prompt_at)
+        self.assertEqual(len(parser.packages), 41)
+        self.assertFalse(parser.is_prompt())
+
+        parser.feed(output[idx + 7:prompt_at + 20])
+        self.assertTrue(parser.is_prompt())
+
+    def test_yum_update_wrapped(self):
+        output = '\n'.join(['=' * 20, ' Package  Arch  Version  Repository  Size', '=' * 20, 'Updating:',
+                             ' java-1.8.0-openjdk-headless-debuginfo-with-a-very-long-name',
+                             '        x86_64  1:1.8.0.131-2.b11.30.amzn1  amzn-updates  32 M',
+                             ' yum  noarch  3.4.3-150.68.amzn1  amzn-main  1.7 M', '', '=' * 20])
+        pkgs = osutil.get_yum_packages_update(output)
+        self.assertEqual(len(pkgs), 2)
+        self.assertEqual(pkgs[0].name, 'java-1.8.0-openjdk-headless-debuginfo-with-a-very-long-name')
+        self.assertEqual(pkgs[0].arch, 'x86_64')
+        self.assertEqual(str(pkgs[0].version), '1:1.8.0.131-2.b11.30.amzn1')
+        self.assertEqual(pkgs[0].size, '32 M')
+
+    def test_yum_list_installed(self):
+        output = '\n'.join([
+            'Loaded plugins: priorities, update-motd, upgrade-helper',
+            'Installed Packages',
+            'bash.x86_64                             4.2.46-28.37.amzn1             @amzn-main',
+            'java-1.8.0-openjdk-headless-debuginfo.x86_64',
+            '                                        1:1.8.0.131-2.b11.30.amzn1     @amzn-updates',
+            'python27-botocore.noarch                1.5.75-1.63.amzn1              @amzn-updates',
+            'glibc.i686                              2.17-157.169.amzn1             @amzn-main',
+            ''])
+        pkgs = osutil.get_yum_packages(output)
+        self.assertEqual([x.name for x in pkgs],
+                         ['bash', 'java-1.8.0-openjdk-headless-debuginfo', 'python27-botocore', 'glibc'])
+
+        wrapped = pkgs[1]
+        self.assertEqual(wrapped.arch, 'x86_64')
+        self.assertEqual(str(wrapped.version), '1:1.8.0.131-2.b11.30.amzn1')
+        self.assertEqual(wrapped.repo, '@amzn-updates')
+
+        self.assertEqual(pkgs[2].arch, 'noarch')
+        self.assertEqual(str(pkgs[3].version), '2.17-157.169.amzn1')
+
+        stream_pkgs = list(osutil.iter_yum_packages(iter(output.splitlines(True))))
+        self.assertEqual([str(x) for x in stream_pkgs], [str(x) for x in pkgs])
+
+
+class InventoryParserTest(unittest.TestCase):
+    """Native package inventory parsers"""
+
+    def _get_res(self, name):
+        return pkg_resources.resource_string(__name__, '/'.join(('data', name)))
+
+    def test_rpm_queryformat(self):
+        pkgs = osutil.get_rpm_packages(self._get_res('rpm_qa_queryformat'))
+        self.assertEqual(len(pkgs), 22)
+
+        kernels = [x for x in pkgs if x.name == 'kernel']
+        self.assertEqual(sorted(str(x.version) for x in kernels), ['4.4.51-40.60.amzn1', '4.9.20-10.30.amzn1'])
+
+        vim = [x for x in pkgs if x.name == 'vim-common'][0]
+        self.assertEqual(str(vim.version), '2:8.0.0503-1.45.amzn1')
+        self.assertEqual(vim.arch, 'x86_64')
+
+        self.assertEqual(len([x for x in pkgs if x.name == 'libstdc++']), 2)
+        self.assertEqual([x for x in pkgs if x.name == 'gpg-pubkey'][0].arch, None)
+
+    def test_rpm_yum_compatible(self):
+        yum_out = '\n'.join(['Installed Packages',
+                             'vim-common.x86_64          2:8.0.0503-1.45.amzn1          @amzn-main',
+                             'curl.x86_64                7.51.0-4.73.amzn1              @amzn-main'])
+        yum_pkgs = osutil.PackageSet(osutil.get_yum_packages(yum_out))
+        rpm_pkgs = osutil.PackageSet(osutil.get_rpm_packages(self._get_res('rpm_qa_queryformat')))
+        self.assertEqual(len(yum_pkgs.diff(rpm_pkgs)), 0)
+        self.assertEqual(len(rpm_pkgs.intersect(yum_pkgs)), 2)
+
+    def test_dpkg_status(self):
+        pkgs = list(osutil.iter_dpkg_status(self._get_res('dpkg_status')))
+        self.assertEqual([x.name for x in pkgs],
+                         ['adduser', 'apt', 'libc6', 'libc6', 'openssl', 'python-apt-common', 'vim-tiny'])
+
+        self.assertEqual(sorted(x.arch for x in pkgs if x.name == 'libc6'), ['amd64', 'i386'])
+
+        vim = pkgs[-1]
+        self.assertEqual(str(vim.version), '2:7.4.1689-3ubuntu1.2')
+        self.assertEqual(vim.arch, 'amd64')
+        self.assertEqual(vim.section, 'editors')
+        self.assertEqual(vim.size, '1030')
+
+
+class PackageSetTest(unittest.TestCase):
+    """Package set operations"""
+
+    def _pkg(self, name, version, arch='x86_64'):
+        return osutil.PackageInfo(name=name, version=version, arch=arch, repo=None)
+
+    def test_highest_version(self):
+        pset = osutil.PackageSet([self._pkg('curl', '7.47.1-9'), self._pkg('curl', '7.51.0-4'),
+                                  self._pkg('curl', '7.50.0-1'), self._pkg('curl', '7.1', 'i686')])
+        self.assertEqual(len(pset), 2)
+        self.assertEqual(str(pset.get('curl', 'x86_64').version), '7.51.0-4')
+        self.assertEqual(str(pset.get('curl', 'i686').version), '7.1')
+        self.assertEqual(str(pset.get('curl').version), '7.51.0-4')
+        self.assertTrue(('curl', 'i686') in pset)
+        self.assertFalse(self._pkg('curl', '1', 'noarch') in pset)
+
+    def test_diff(self):
+        installed = [self._pkg('curl', '7.47.1'), self._pkg('vim', '2:8.0.0503'), self._pkg('rpm', '4.11.3')]
+        policy = [self._pkg('curl', '7.51.0'), self._pkg('vim', '2:8.0.0134'), self._pkg('kernel', '4.9.20'),
+                  self._pkg('rpm', '4.11.3', 'noarch')]
+
+        res = osutil.PackageSet(policy).diff(installed)
+        self.assertEqual(sorted(x.name for x in res), ['curl', 'kernel', 'rpm'])
+
+        res = osutil.PackageSet(policy).diff(installed, only_in_other=True)
+        self.assertEqual([x.name for x in res], ['curl'])
+
+        res = osutil.package_diff(policy, installed, only_in_b=True)
+        self.assertEqual([x.name for x in res], ['curl'])
+
+    def test_intersect(self):
+        a = osutil.PackageSet([self._pkg('curl', '7.47.1'), self._pkg('vim', '8')])
+        b = [self._pkg('curl', '7.51.0'), self._pkg('vim', '8', 'noarch')]
+        self.assertEqual([x.name for x in a.intersect(b)], ['curl'])
+
+    def test_restrictions(self):
+        allowed = osutil.PackageSet([self._pkg('curl', '7.51.0'), self._pkg('curl', '7.40.0', 'i686')])
+        output = [self._pkg('curl', '7.51.0'), self._pkg('curl', '7.52.0'), self._pkg('kernel', '4.9')]
+        conflicts, new_pkgs = allowed.check_restrictions(output)
+        self.assertEqual([str(x.version) for x in conflicts], ['7.52.0'])
+        self.assertEqual([x.name for x in new_pkgs], ['kernel'])
+
 
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover
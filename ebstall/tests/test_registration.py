@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+from six.moves import BaseHTTPServer
+
+import ebstall.util as util
+from ebstall.registration import InfoLoader
+from ebstall.tests.httpserver import LocalHTTPServer
+
+
+__author__ = 'dusanklinec'
+
+
+class IpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for the ipify (GET) and EB clientip (POST) interfaces"""
+
+    def _reply(self, js):
+        self.server.hits += 1
+        time.sleep(self.server.delay)
+        body = json.dumps(js).encode('utf-8')
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply({'ip': self.server.ip})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply({'response': {'ipv4': self.server.ip, 'ipv6': None}})
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+
+class IpServer(LocalHTTPServer):
+    def __init__(self, ip, delay=0.0, status=200):
+        super(IpServer, self).__init__(IpHandler, ip=ip, delay=delay, status=status, hits=0)
+
+
+class PublicIpTest(unittest.TestCase):
+    """Hedged public IP detection & the cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _loader(self, eb, ipify):
+        info = InfoLoader()
+        info.public_ip_cache_path = os.path.join(self.tmpdir, 'public-ip.json')
+        info._load_ip_eb = lambda: util.determine_public_ip_eb(attempts=1, url=eb.url, timeout=5)
+        info._load_ipfy = lambda: util.determine_public_ip(attempts=1, url=ipify.url, timeout=5)
+        return info
+
+    def test_first_answer(self):
+        with IpServer('1.2.3.4', delay=1.0) as eb, IpServer('5.6.7.8') as ipify:
+            time_start = time.time()
+            self.assertEqual(self._loader(eb, ipify).load_public_ip(), '5.6.7.8')
+            self.assertLess(time.time() - time_start, 0.5)
+
+    def test_failed_source(self):
+        with IpServer('1.2.3.4', status=500) as eb, IpServer('5.6.7.8', delay=0.1) as ipify:
+            self.assertEqual(self._loader(eb, ipify).load_public_ip(), '5.6.7.8')
+
+        os.remove(os.path.join(self.tmpdir, 'public-ip.json'))
+        with IpServer('1.2.3.4') as eb, IpServer('not-an-ip') as ipify:
+            self.assertEqual(util.determine_public_ip(attempts=1, url=ipify.url), 'not-an-ip')
+            self.assertEqual(self._loader(eb, ipify).load_public_ip(), '1.2.3.4')
+
+    def test_quorum(self):
+        with IpServer('1.2.3.4') as a, IpServer('5.6.7.8', delay=0.2) as b, IpServer('5.6.7.8', delay=0.3) as c:
+            sources = [lambda x=x: util.determine_public_ip(attempts=1, url=x.url) for x in (a, b, c)]
+            self.assertEqual(util.determine_public_ip_hedged(sources, quorum=2), '5.6.7.8')
+            self.assertEqual(util.determine_public_ip_hedged(sources[:2], quorum=2), '1.2.3.4')
+
+    def test_cache(self):
+        with IpServer('1.2.3.4') as eb, IpServer('1.2.3.4') as ipify:
+            self.assertEqual(self._loader(eb, ipify).load_public_ip(), '1.2.3.4')
+            eb.server.ip = ipify.server.ip = '5.6.7.8'
+            hits = eb.server.hits + ipify.server.hits
+
+            # Fresh cache is used by the next run
+            self.assertEqual(self._loader(eb, ipify).load_public_ip(), '1.2.3.4')
+            self.assertEqual(eb.server.hits + ipify.server.hits, hits)
+
+            # Expired
+            with mock.patch('time.time', return_value=time.time() + 600):
+                self.assertEqual(self._loader(eb, ipify).load_public_ip(), '5.6.7.8')
+
+    def test_all_failed(self):
+        with IpServer('1.2.3.4', status=500) as eb, IpServer('5.6.7.8', status=500) as ipify:
+            info = self._loader(eb, ipify)
+            self.assertIsNone(info.load_public_ip())
+            self.assertFalse(os.path.exists(info.public_ip_cache_path))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from six import StringIO
+
+import ebstall
+from ebstall.startupprofile import ImportProfiler
+
+
+__author__ = 'dusanklinec'
+
+
+# Lists modules loaded by the CLI entry points in a fresh interpreter
+COLD_START = '''
+import json
+import sys
+try:
+    import ebstall.cli
+    import ebstall.clivpn
+except ImportError as e:
+    print(json.dumps({'error': str(e)}))
+    sys.exit(0)
+print(json.dumps({'modules': sorted(x for x, mod in sys.modules.items() if mod is not None)}))
+'''
+
+# Loaded only by the commands using them
+LAZY_MODULES = ('yaql', 'cryptography', 'requests')
+
+
+class ImportProfilerTest(unittest.TestCase):
+    """Startup import profiler"""
+
+    def setUp(self):
+        for name in ('colorsys', 'wave', 'chunk'):
+            sys.modules.pop(name, None)
+        self.profiler = ImportProfiler()
+
+    def tearDown(self):
+        self.profiler.uninstall()
+
+    def test_records(self):
+        self.profiler.install()
+        import colorsys
+        import wave
+        import sys as sys_again
+        self.profiler.uninstall()
+
+        records = self.profiler.records
+        self.assertIn('colorsys', records)
+        self.assertIn('wave', records)
+        self.assertIn('chunk', records)
+        self.assertNotIn('sys', records)
+
+        # wave imports chunk, its cumulative time includes chunk
+        cumulative, self_time = records['wave']
+        self.assertGreaterEqual(cumulative, records['chunk'][0])
+        self.assertLessEqual(self_time, cumulative)
+
+        out = StringIO()
+        self.profiler.report(out=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Startup import profile, %d modules' % len(records)))
+        self.assertEqual(len(lines), 2 + len(records))
+
+    def test_uninstall(self):
+        try:
+            import __builtin__ as builtins
+        except ImportError:
+            import builtins
+
+        orig_import = builtins.__import__
+        self.profiler.install()
+        self.assertIsNot(builtins.__import__, orig_import)
+        self.profiler.uninstall()
+        self.assertIs(builtins.__import__, orig_import)
+
+
+class ColdStartTest(unittest.TestCase):
+    """Heavy dependencies are not imported on the CLI start"""
+
+    def test_lazy_imports(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(ebstall.__file__)))
+        out = subprocess.check_output([sys.executable, '-c', COLD_START], cwd=root)
+        res = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        if 'error' in res:
+            self.skipTest('CLI dependencies not available: %s' % res['error'])
+
+        loaded = [x for x in res['modules']
+                  if x.startswith('ebstall.deployers.') or x.split('.')[0] in LAZY_MODULES]
+        self.assertEqual(loaded, [])
+        self.assertIn('ebstall.cli', res['modules'])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import pkg_resources
+
+import ebstall.osutil as osutil
+from ebstall.ebsysconfig import SysConfig
+
+
+__author__ = 'dusanklinec'
+
+
+class InventoryCacheTest(unittest.TestCase):
+    """Installed packages inventory cache"""
+
+    def __init__(self, *args, **kwargs):
+        super(InventoryCacheTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fingerprint = ['/var/lib/rpm/Packages', 1000.0, 4096]
+        self.packages = [osutil.PackageInfo(name='curl', version='7.51.0-4.73.amzn1', arch='x86_64', repo='@amzn'),
+                         osutil.PackageInfo(name='vim', version='2:8.0.0503', arch='x86_64', repo='@amzn')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _syscfg(self):
+        syscfg = SysConfig()
+        syscfg._list_installed_packages = mock.Mock(return_value=list(self.packages))
+        return syscfg
+
+    def test_cache_rpmdb(self):
+        syscfg = self._syscfg()
+        with mock.patch.object(osutil, 'get_package_db_fingerprint', lambda x: self.fingerprint):
+            self.assertEqual(len(syscfg.get_installed_packages()), 2)
+            self.assertEqual(len(syscfg.get_installed_packages()), 2)
+            self.assertEqual(syscfg._list_installed_packages.call_count, 1)
+
+            self.fingerprint = ['/var/lib/rpm/Packages', 1001.0, 8192]
+            syscfg.get_installed_packages()
+            self.assertEqual(syscfg._list_installed_packages.call_count, 2)
+
+    def test_no_rpmdb(self):
+        syscfg = self._syscfg()
+        with mock.patch.object(osutil, 'get_package_db_fingerprint', lambda x: None):
+            syscfg.get_installed_packages()
+            syscfg.get_installed_packages()
+            self.assertEqual(syscfg._list_installed_packages.call_count, 2)
+
+    def test_snapshot(self):
+        snapshot = os.path.join(self.tmpdir, 'cache', 'inventory.json')
+        with mock.patch.object(osutil, 'get_package_db_fingerprint', lambda x: self.fingerprint):
+            syscfg = self._syscfg()
+            syscfg.inventory_snapshot = snapshot
+            syscfg.get_installed_packages()
+            self.assertTrue(os.path.exists(snapshot))
+
+            # New process - warm snapshot
+            syscfg = self._syscfg()
+            syscfg.inventory_snapshot = snapshot
+            pkgs = syscfg.get_installed_packages()
+            self.assertEqual(syscfg._list_installed_packages.call_count, 0)
+            self.assertEqual([str(x) for x in pkgs], [str(x) for x in self.packages])
+
+            # Stale snapshot
+            self.fingerprint = ['/var/lib/rpm/Packages', 1001.0, 8192]
+            syscfg = self._syscfg()
+            syscfg.inventory_snapshot = snapshot
+            syscfg.get_installed_packages()
+            self.assertEqual(syscfg._list_installed_packages.call_count, 1)
+
+            # Snapshot was refreshed
+            syscfg = self._syscfg()
+            syscfg.inventory_snapshot = snapshot
+            syscfg.get_installed_packages()
+            self.assertEqual(syscfg._list_installed_packages.call_count, 0)
+
+            # Package removed - smaller snapshot replaces the bigger one
+            self.fingerprint = ['/var/lib/rpm/Packages', 1002.0, 4096]
+            self.packages = self.packages[:1]
+            syscfg = self._syscfg()
+            syscfg.inventory_snapshot = snapshot
+            syscfg.get_installed_packages()
+
+            with open(snapshot) as fh:
+                js = json.load(fh)
+            self.assertEqual(js['fingerprint'], self.fingerprint)
+            self.assertEqual(len(js['packages']), 1)
+
+
+class InventoryBackendTest(unittest.TestCase):
+    """Installed packages inventory backends"""
+
+    def test_backend_fallback(self):
+        syscfg = SysConfig()
+        syscfg.get_packager = lambda: osutil.PKG_YUM
+        syscfg._inventory_rpm = mock.Mock(side_effect=OSError('rpm missing'))
+        syscfg._inventory_yum = mock.Mock(return_value=[])
+
+        self.assertEqual(syscfg._list_installed_packages(), [])
+        self.assertEqual(syscfg._inventory_rpm.call_count, 1)
+        self.assertEqual(syscfg._inventory_yum.call_count, 1)
+
+    def test_backend_forced(self):
+        syscfg = SysConfig()
+        syscfg.get_packager = lambda: osutil.PKG_APT
+        syscfg.inventory_backend = 'yum'
+        self.assertEqual(syscfg._get_inventory_backends(), ['yum'])
+
+        syscfg.inventory_backend = None
+        self.assertEqual(syscfg._get_inventory_backends(), ['dpkg'])
+
+
+class UpdatePlanTest(unittest.TestCase):
+    """Resolving yum update commands"""
+
+    def _syscfg(self, installed):
+        syscfg = SysConfig()
+        syscfg.get_installed_packages = mock.Mock(return_value=installed)
+        return syscfg
+
+    def test_general(self):
+        syscfg = self._syscfg([])
+        cmds, packages = syscfg.plan_update_packages(packages_var=['openssl*'], security=True)
+        self.assertIsNone(packages)
+        self.assertEqual(len(cmds), 1)
+        self.assertTrue(cmds[0].startswith('sudo yum update --security'))
+        self.assertIn('openssl*', cmds[0])
+        self.assertEqual(syscfg.get_installed_packages.call_count, 0)
+
+    def test_restricted_chunks(self):
+        # Only installed packages in lower version are updated
+        installed = [osutil.PackageInfo(name='pkg%d' % i, version='0.9-1', arch='x86_64', repo='@base')
+                     for i in range(1, 450)]
+        installed.append(osutil.PackageInfo(name='pkg0', version='2.0-1', arch='x86_64', repo='@base'))
+        packages = [osutil.PackageInfo(name='pkg%d' % i, version='1.0-1', arch='x86_64', repo='base')
+                    for i in range(451)]
+
+        syscfg = self._syscfg(installed)
+        cmds, allowed = syscfg.plan_update_packages(packages=packages)
+        self.assertEqual(len(allowed), 451)
+        self.assertEqual(len(cmds), 3)
+        self.assertNotIn('pkg450-', cmds[2])
+        self.assertTrue(all(x.startswith('sudo yum update-to') for x in cmds))
+        self.assertNotIn('pkg0-1.0-1.x86_64', cmds[0])
+        self.assertIn('pkg449-1.0-1.x86_64', cmds[2])
+
+
+class YumAnswerTest(unittest.TestCase):
+    """Answering the yum question from the transcript"""
+
+    def _run(self, allowed_version, expected_res=0):
+        output = pkg_resources.resource_string(__name__, 'data/yum_update_list')
+        installed = [osutil.PackageInfo(name='curl', version='7.47.1-9.68.amzn1', arch='x86_64', repo='@amzn')]
+        allowed = [osutil.PackageInfo(name='curl', version=allowed_version, arch='x86_64', repo='amzn-updates')]
+        answers = []
+
+        def cli_cmd_sync(cmd, on_out=None, on_err=None, *args, **kwargs):
+            feeder = mock.Mock()
+            feeder.feed.side_effect = lambda x: answers.append((x, len(lines)))
+            p = mock.Mock()
+            p.commands = [mock.Mock(returncode=None)]
+            lines = []
+            for line in output.splitlines(True):
+                lines.append(line)
+                on_out(line, feeder, p)
+            return 0, lines, []
+
+        syscfg = SysConfig()
+        syscfg.get_installed_packages = mock.Mock(return_value=installed)
+        syscfg.cli_cmd_sync = cli_cmd_sync
+        self.assertEqual(syscfg.update_packages(packages=allowed), expected_res)
+        return answers
+
+    def test_accept(self):
+        answers = self._run('7.51.0-4.73.amzn1')
+        self.assertEqual(len(answers), 1)
+        self.assertEqual(answers[0][0], 'y\n')
+
+        # Answered right after the transaction table, before the question line
+        self.assertEqual(answers[0][1], 141)
+
+    def test_conflict(self):
+        answers = self._run('7.50.0-1.amzn1', expected_res=1)
+        self.assertEqual(answers, [('n\n', 141)])
+
+
+class ServiceQueueTest(unittest.TestCase):
+    """Deferred service actions"""
+
+    def _syscfg(self):
+        syscfg = SysConfig()
+        syscfg.get_start_system = mock.Mock(return_value=osutil.START_SYSTEMD)
+        syscfg.exec_shell = mock.Mock(return_value=0)
+        return syscfg
+
+    def _cmds(self, syscfg):
+        return [x[0][0] for x in syscfg.exec_shell.call_args_list]
+
+    def test_immediate(self):
+        syscfg = self._syscfg()
+        self.assertEqual(syscfg.switch_svc('nginx', restart=True), 0)
+        self.assertEqual(self._cmds(syscfg), ["sudo systemctl restart 'nginx.service'"])
+
+    def test_merge(self):
+        syscfg = self._syscfg()
+        with syscfg.deferred_svc():
+            syscfg.switch_svc('dnsmasq', restart=True)
+            syscfg.switch_svc('nginx', reload=True)
+            syscfg.switch_svc('php-fpm', start=True)
+            syscfg.switch_svc('nginx', reload=True)
+            syscfg.switch_svc('php-fpm', start=True)
+            syscfg.switch_svc('dnsmasq', reload=True)
+            syscfg.switch_svc('jboss', start=True)
+            syscfg.switch_svc('jboss', reload=True)
+            self.assertEqual(self._cmds(syscfg), [])
+
+        self.assertEqual(self._cmds(syscfg), ["sudo systemctl restart 'dnsmasq.service'",
+                                              "sudo systemctl reload 'nginx.service'",
+                                              "sudo systemctl start 'php-fpm.service'",
+                                              "sudo systemctl restart 'jboss.service'"])
+        self.assertEqual(len(syscfg.svc_queue), 0)
+
+    def test_barriers(self):
+        syscfg = self._syscfg()
+        with syscfg.deferred_svc():
+            syscfg.switch_svc('nginx', restart=True)
+            syscfg.switch_svc('dnsmasq', restart=True)
+            syscfg.switch_svc('php-fpm', start=True)
+
+            # Stop drops the queued action
+            syscfg.switch_svc('php-fpm', stop=True)
+            self.assertEqual(self._cmds(syscfg), ["sudo systemctl stop 'php-fpm.service'"])
+
+            # Only the given service is flushed
+            self.assertEqual(syscfg.flush_svc('dnsmasq'), 0)
+            self.assertEqual(self._cmds(syscfg)[1:], ["sudo systemctl restart 'dnsmasq.service'"])
+
+            # Status query needs the real state
+            syscfg.get_systemd_svc_states = mock.Mock(return_value={'nginx.service': ('loaded', 'active', 'running')})
+            self.assertTrue(syscfg.svc_is_running('nginx'))
+            self.assertEqual(self._cmds(syscfg)[2:], ["sudo systemctl restart 'nginx.service'"])
+
+        self.assertEqual(len(self._cmds(syscfg)), 3)
+
+    def test_flush_error(self):
+        syscfg = self._syscfg()
+        syscfg.exec_shell = mock.Mock(side_effect=[0, 3, 0])
+        with syscfg.deferred_svc():
+            for svc in ['nginx', 'dnsmasq', 'php-fpm']:
+                syscfg.switch_svc(svc, restart=True)
+            self.assertEqual(syscfg.flush_svc(), 3)
+        self.assertEqual(syscfg.exec_shell.call_count, 3)
+
+
+class ServiceStateTest(unittest.TestCase):
+    """Batched systemd unit state queries"""
+
+    SHOW_OUT = 'LoadState=loaded\nActiveState=active\nSubState=running\n\n' \
+               'LoadState=not-found\nActiveState=inactive\nSubState=dead\n\n' \
+               'LoadState=loaded\nActiveState=failed\nSubState=failed\n'
+
+    def _syscfg(self):
+        syscfg = SysConfig()
+        syscfg.get_start_system = mock.Mock(return_value=osutil.START_SYSTEMD)
+        syscfg.exec_shell = mock.Mock(return_value=0)
+        syscfg.cli_cmd_sync = mock.Mock(return_value=(0, self.SHOW_OUT, ''))
+        return syscfg
+
+    def test_lines(self):
+        syscfg = self._syscfg()
+        syscfg.cli_cmd_sync.return_value = (0, [x + '\n' for x in self.SHOW_OUT.split('\n')], [])
+        res = syscfg.svc_status_many(['firewalld', 'ufw', 'iptables'])
+        self.assertEqual(res, [(True, True), (False, False), (True, False)])
+
+    def test_batch(self):
+        syscfg = self._syscfg()
+        res = syscfg.svc_status_many(['firewalld', 'ufw', 'iptables'])
+        self.assertEqual(res, [(True, True), (False, False), (True, False)])
+
+        self.assertEqual(syscfg.cli_cmd_sync.call_count, 1)
+        cmd = syscfg.cli_cmd_sync.call_args[0][0]
+        self.assertIn('-p LoadState,ActiveState,SubState', cmd)
+        self.assertIn('firewalld.service ufw.service iptables.service', cmd)
+
+        states = syscfg.get_systemd_svc_states(['firewalld.service', 'iptables.service'])
+        self.assertEqual(states['iptables.service'], ('loaded', 'failed', 'failed'))
+
+        # Served from the cache
+        self.assertTrue(syscfg.svc_is_running('firewalld'))
+        self.assertFalse(syscfg.svc_is_installed('ufw'))
+        self.assertEqual(syscfg.cli_cmd_sync.call_count, 1)
+
+    def test_invalidate(self):
+        syscfg = self._syscfg()
+        syscfg.svc_status_many(['firewalld', 'ufw', 'iptables'])
+
+        syscfg.switch_svc('iptables', restart=True)
+        syscfg.enable_svc('firewalld')
+        syscfg.cli_cmd_sync.return_value = (0, 'LoadState=loaded\nActiveState=active\nSubState=running\n', '')
+        self.assertTrue(syscfg.svc_is_running('iptables'))
+        self.assertEqual(syscfg.cli_cmd_sync.call_count, 2)
+
+        # TTL expired
+        syscfg.svc_state_ttl = -1
+        syscfg.svc_status('ufw')
+        self.assertEqual(syscfg.cli_cmd_sync.call_count, 3)
+
+    def test_error(self):
+        syscfg = self._syscfg()
+        syscfg.cli_cmd_sync.return_value = (1, '', 'error')
+        self.assertEqual(syscfg.svc_status('nginx'), (False, False))
+        syscfg.svc_status('nginx')
+        self.assertEqual(syscfg.cli_cmd_sync.call_count, 2)
+
+
+class FirewallBatchTest(unittest.TestCase):
+    """Firewall transactions"""
+
+    def _syscfg(self, fw_name):
+        syscfg = SysConfig()
+        syscfg._resolve_firewalls = mock.Mock(return_value=fw_name)
+        syscfg._try_get_default_dev = mock.Mock(return_value='eth0')
+        syscfg.exec_shell = mock.Mock(return_value=0)
+        syscfg.exec_shell_subprocess = mock.Mock(return_value=0)
+        return syscfg
+
+    def _iptables_save(self):
+        output = pkg_resources.resource_string(__name__, 'data/iptables_save')
+        return [x.strip() for x in output.split('\n')]
+
+    def test_iptables(self):
+        syscfg = self._syscfg('iptables')
+        syscfg._iptables_get_rules = mock.Mock(return_value=self._iptables_save())
+
+        with syscfg.firewall_batch():
+            self.assertEqual(syscfg.allow_port(8442), 0)
+            self.assertEqual(syscfg.allow_port(8443), 0)
+            syscfg.allow_port(8443)
+            syscfg.allow_port(1194, tcp=False)
+            syscfg.allow_port(53, tcp=False)
+            syscfg.masquerade('10.8.0.0', 24)
+            syscfg.masquerade('10.9.0.0', 24)
+            self.assertEqual(syscfg.exec_shell_subprocess.call_count, 0)
+
+        self.assertEqual(syscfg._iptables_get_rules.call_count, 1)
+        self.assertEqual(syscfg.exec_shell_subprocess.call_count, 1)
+        cmd = syscfg.exec_shell_subprocess.call_args[0][0]
+        restore = syscfg.exec_shell_subprocess.call_args[1]['stdin_string']
+        self.assertEqual(cmd, 'sudo iptables-restore --noflush')
+        self.assertEqual(restore.strip().split('\n'), [
+            '*filter',
+            '-A INPUT -m state --state NEW -m tcp -p tcp --dport 8443 -j ACCEPT',
+            '-A INPUT -m udp -p udp --dport 53 -j ACCEPT',
+            'COMMIT',
+            '*nat',
+            '-A POSTROUTING -s 10.9.0.0/24 -o eth0 -j MASQUERADE',
+            'COMMIT'])
+
+        # Saved once
+        self.assertEqual(syscfg.exec_shell.call_count, 1)
+        self.assertIn('iptables-save', syscfg.exec_shell.call_args[0][0])
+
+    def test_iptables_noop(self):
+        syscfg = self._syscfg('iptables')
+        syscfg._iptables_get_rules = mock.Mock(return_value=self._iptables_save())
+        self.assertEqual(syscfg.allow_port(22), 0)
+        self.assertEqual(syscfg.masquerade('10.8.0.0', 24), 0)
+        self.assertEqual(syscfg.exec_shell_subprocess.call_count, 0)
+        self.assertEqual(syscfg.exec_shell.call_count, 0)
+
+    def test_firewalld(self):
+        syscfg = self._syscfg('firewalld')
+        with syscfg.firewall_batch():
+            syscfg.allow_port(8442)
+            syscfg.allow_port(1194, tcp=False)
+            syscfg.masquerade('10.8.0.0', 24)
+
+        cmds = [x[0][0] for x in syscfg.exec_shell.call_args_list]
+        self.assertEqual(cmds, ['sudo firewall-cmd --permanent --zone=public --add-port=8442/tcp --add-port=1194/udp',
+                                'sudo firewall-cmd --permanent --zone=external --add-masquerade'])
+
+    def test_ufw(self):
+        syscfg = self._syscfg('ufw')
+        syscfg._ufw_accept_forward = mock.Mock()
+        syscfg._ufw_masquerade_before_rules = mock.Mock()
+        with syscfg.firewall_batch():
+            for port in range(8000, 8020):
+                syscfg.allow_port(port)
+            syscfg.allow_port(1194, tcp=False)
+            syscfg.masquerade('10.8.0.0', 24)
+
+        cmds = [x[0][0] for x in syscfg.exec_shell.call_args_list]
+        self.assertEqual(cmds, ['sudo ufw allow %s/tcp' % ','.join([str(x) for x in range(8000, 8015)]),
+                                'sudo ufw allow %s/tcp' % ','.join([str(x) for x in range(8015, 8020)]),
+                                'sudo ufw allow 1194/udp',
+                                'sudo ufw disable', 'sudo ufw enable'])
+        syscfg._ufw_masquerade_before_rules.assert_called_once_with('10.8.0.0', 24, 'eth0')
+
+    def test_rollback(self):
+        syscfg = self._syscfg('firewalld')
+        try:
+            with syscfg.firewall_batch():
+                syscfg.allow_port(8442)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(syscfg.exec_shell.call_count, 0)
+        self.assertIsNone(syscfg._fw_batch)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
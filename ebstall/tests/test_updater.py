@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import ebstall.osutil as osutil
+import ebstall.updater as updater_module
+from ebstall.audit import AuditManager
+from ebstall.ebsysconfig import SysConfig
+from ebstall.updater import Updater, UpdatePlan
+
+
+__author__ = 'dusanklinec'
+
+
+SPECS = {
+    'updates': [
+        {
+            'desc': 'test',
+            'rule': ["$.ebstall_version >= '1.2'", "$.source_image_code = null"],
+            'then': [{'rule': "$.ebstall_version < '2.0'"}]
+        }
+    ]
+}
+
+
+ROOT = {'ebstall_version': '1.3.11', 'source_image_code': None}
+
+
+def new_updater(syscfg=None, audit=None, root=None):
+    """
+    Updater with the parser initialized
+    :param syscfg: SysConfig mock
+    :param audit: disabled audit by default
+    :param root: static rule data, lazy rule data from syscfg if None
+    :return: 
+    """
+    updater = Updater(sysconfig=syscfg if syscfg is not None else mock.Mock(),
+                      audit=audit if audit is not None else AuditManager(disabled=True),
+                      ebstall_version='1.3.11')
+    updater.init_parser()
+    if root is not None:
+        updater.root = dict(root)
+    else:
+        updater.gen_rule_data()
+    return updater
+
+
+class UpdaterTest(unittest.TestCase):
+    """Updater rule evaluation"""
+
+    def test_expr_cache(self):
+        updater = new_updater(root=ROOT)
+        rule = SPECS['updates'][0]['rule']
+        self.assertTrue(updater.eval_rule(rule))
+        self.assertEqual(updater.expr_cache.misses, 2)
+
+        self.assertTrue(updater.eval_rule(rule))
+        self.assertEqual(updater.expr_cache.misses, 2)
+        self.assertEqual(updater.expr_cache.hits, 2)
+
+
+class RuleDataTest(unittest.TestCase):
+    """Lazy rule data providers"""
+
+    def setUp(self):
+        self.syscfg = mock.Mock()
+        self.syscfg.get_os.return_value = osutil.OSInfo(name='amzn', version='2017.03', family='redhat')
+        self.syscfg.get_installed_packages.return_value = [
+            osutil.PackageInfo(name='curl', version='7.51.0-4.73.amzn1', arch='x86_64', repo='@amzn'),
+            osutil.PackageInfo(name='kernel', version='4.9.20-10.30.amzn1', arch='x86_64', repo='@amzn')]
+
+    def test_lazy(self):
+        updater = new_updater(syscfg=self.syscfg)
+        self.assertTrue(updater.eval_rule(["$.ebstall_version >= v '1.2'", "$.source_image_code = null"]))
+        self.assertEqual(self.syscfg.get_os.call_count, 0)
+        self.assertEqual(self.syscfg.get_installed_packages.call_count, 0)
+        self.assertFalse(updater.root.is_loaded('pkgs'))
+
+    def test_providers(self):
+        updater = new_updater(syscfg=self.syscfg)
+        self.assertTrue(updater.eval_rule("$.os.family = 'redhat'"))
+        self.assertTrue(updater.eval_rule("$.pkgs.get('curl') != null"))
+        self.assertTrue(updater.eval_rule("$.pkgs.get('vim') = null"))
+        self.assertTrue(updater.eval_rule("$.pkgs_map.containsKey('kernel-4.9.20-10.30.amzn1.x86_64')"))
+        self.assertEqual(updater.eval_single("len($.pkgs_lst.where($.name = 'kernel'))"), 1)
+        self.assertEqual(updater.eval_single("$['pkgs_lst'].select($.name)"), ['curl', 'kernel'])
+
+        self.assertEqual(self.syscfg.get_os.call_count, 1)
+        self.assertEqual(self.syscfg.get_installed_packages.call_count, 1)
+
+
+class UpdateSpecsCacheTest(unittest.TestCase):
+    """Update specs cache & conditional fetch"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.syscfg = mock.Mock()
+        self.syscfg.get_inventory_fingerprint.return_value = ['/var/lib/rpm/Packages', 1000.0, 4096]
+        self.syscfg.get_installed_packages.return_value = []
+        self.updater = new_updater(syscfg=self.syscfg)
+        self.updater.specs_cache_path = os.path.join(self.tmpdir, 'update-specs.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _response(self, status_code=200, js=None, headers=None):
+        res = mock.Mock()
+        res.status_code = status_code
+        res.headers = headers or {}
+        res.json.return_value = js
+        return res
+
+    def test_conditional_get(self):
+        updater = self.updater
+        res = self._response(js=SPECS, headers={'ETag': '"abc"', 'Last-Modified': 'Mon, 22 May 2017 10:00:00 GMT'})
+        with mock.patch.object(updater_module.httpclient, 'get', return_value=res) as get:
+            self.assertEqual(updater.fetch_update_specs(), SPECS)
+            self.assertEqual(get.call_args[1]['headers'], {})
+
+        # Fresh cache - no request at all
+        with mock.patch.object(updater_module.httpclient, 'get') as get:
+            self.assertEqual(updater.fetch_update_specs(), SPECS)
+            self.assertEqual(get.call_count, 0)
+
+        # Expired cache - revalidation
+        updater.specs_max_age = 0
+        with mock.patch.object(updater_module.httpclient, 'get', return_value=self._response(304)) as get:
+            self.assertEqual(updater.fetch_update_specs(), SPECS)
+            self.assertEqual(get.call_args[1]['headers']['If-None-Match'], '"abc"')
+            self.assertEqual(get.call_args[1]['headers']['If-Modified-Since'], 'Mon, 22 May 2017 10:00:00 GMT')
+
+    def test_short_circuit(self):
+        updater = self.updater
+        updater.plan_update = mock.Mock(return_value=UpdatePlan())
+        updater.execute_plan = mock.Mock(return_value=[0])
+        with mock.patch.object(updater_module.httpclient, 'get', return_value=self._response(js=SPECS)):
+            self.assertEqual(updater.update(), [0])
+            self.assertEqual(updater.update(), [])
+            self.assertEqual(updater.execute_plan.call_count, 1)
+
+            # Package installed in the meantime
+            updater.syscfg.get_inventory_fingerprint.return_value = ['/var/lib/rpm/Packages', 1001.0, 4096]
+            self.assertEqual(updater.update(), [0])
+            self.assertEqual(updater.execute_plan.call_count, 2)
+
+    def test_cache_shrinks(self):
+        self.updater.store_specs_cache({'specs': {'updates': [{'desc': 'x' * 100}] * 10}, 'etag': '"abc"'})
+        self.updater.store_specs_cache({'specs': {'updates': []}})
+        self.assertEqual(self.updater.load_specs_cache(), {'specs': {'updates': []}})
+
+    def test_plan_only(self):
+        specs = {'updates': [{'desc': 'all', 'rule': "$.source_image_code = null", 'action': 'update-system'}]}
+        with mock.patch.object(updater_module.httpclient, 'get', return_value=self._response(js=specs)):
+            self.assertEqual(len(self.updater.update(plan_only=True)), 1)
+        self.assertEqual(self.syscfg.update_packages.call_count, 0)
+
+    def test_failed_retried(self):
+        specs = {'updates': [{'desc': 'all', 'action': 'update-system'}]}
+        updater = self.updater
+        updater.syscfg.update_packages.return_value = 1
+        with mock.patch.object(updater_module.httpclient, 'get', return_value=self._response(js=specs)):
+            self.assertEqual(updater.update(), [1])
+
+            # Failed run is not recorded, the update runs again
+            updater.syscfg.update_packages.return_value = 0
+            self.assertEqual(updater.update(), [0])
+            self.assertEqual(updater.update(), [])
+            self.assertEqual(updater.syscfg.update_packages.call_count, 2)
+
+
+PLAN_SPECS = {
+    'updates': [
+        {
+            'desc': 'security',
+            'rule': "$.ebstall_version >= '1.2'",
+            'action': 'update-system',
+            'pkg-security': True,
+            'packages-var': ['openssl*'],
+            'then': [
+                {'action': 'update-system', 'pkg-security': True, 'packages-var': ['openssl*', 'nginx']},
+                {'rule': "$.ebstall_version >= '2.0'", 'action': 'update-system', 'packages-var': ['kernel']},
+            ]
+        },
+        {
+            'desc': 'pinned',
+            'action': 'update-system',
+            'packages': [{'name': 'openvpn', 'version': '2.4.1-1.el7', 'arch': 'x86_64', 'repo': 'epel'},
+                         {'name': 'nginx', 'version': '1.10.2-1.el7', 'arch': 'x86_64', 'repo': 'epel'}]
+        },
+        {
+            'desc': 'pinned newer',
+            'action': 'update-system',
+            'packages': [{'name': 'openvpn', 'version': '2.4.3-1.el7', 'arch': 'x86_64', 'repo': 'epel'}]
+        },
+        {'desc': 'reboot', 'action': 'reboot'},
+    ]
+}
+
+
+class UpdatePlanTest(unittest.TestCase):
+    """Merging rule actions to the yum transactions"""
+
+    def setUp(self):
+        self.syscfg = mock.Mock()
+        self.syscfg.update_packages.return_value = 0
+
+    def test_merge(self):
+        updater = new_updater(syscfg=self.syscfg, root=ROOT)
+        plan = updater.plan_update(PLAN_SPECS['updates'])
+        self.assertEqual(len(plan), 2)
+        self.assertEqual(plan.unknown, ['reboot'])
+        self.assertEqual(updater.syscfg.update_packages.call_count, 0)
+
+        general, pinned = plan.get_transactions()
+        self.assertIsNone(general['packages'])
+        self.assertTrue(general['security'])
+        self.assertEqual(general['packages_var'], ['openssl*', 'nginx'])
+
+        self.assertEqual(len(pinned['packages']), 2)
+        self.assertEqual(str(pinned['packages'].get('openvpn').version), '2.4.3-1.el7')
+        self.assertIsNone(pinned['packages_var'])
+
+    def test_execute(self):
+        updater = new_updater(syscfg=self.syscfg, root=ROOT)
+        plan = updater.plan_update(PLAN_SPECS['updates'])
+        self.assertEqual(updater.execute_plan(plan), [0, 0])
+        self.assertEqual(updater.syscfg.update_packages.call_count, 2)
+        self.assertEqual(updater.syscfg.update_packages.call_args_list[0][1]['packages_var'], ['openssl*', 'nginx'])
+
+    def test_unrestricted_absorbs(self):
+        syscfg = SysConfig()
+        for order in ((['openssl*'], None), (None, ['openssl*'])):
+            plan = UpdatePlan()
+            for packages_var in order:
+                plan.add_update_system(dict(packages=None, packages_var=packages_var, security=True))
+
+            txs = plan.get_transactions()
+            self.assertEqual(len(txs), 1)
+            self.assertIsNone(txs[0]['packages_var'])
+
+            cmds, packages = syscfg.plan_update_packages(**txs[0])
+            self.assertEqual(cmds[0].split(), ['sudo', 'yum', 'update', '--security'])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
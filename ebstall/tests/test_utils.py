@@ -1,12 +1,310 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import mock
+import os
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import time
 import ebstall.util as util
 import unittest
 
 __author__ = 'dusanklinec'
 
 
-if __name__ == "__main__":
-    unittest.main()  # pragma: no cover
+class WriteIfChangedTest(unittest.TestCase):
+    """Atomic conditional file writes"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_new_file(self):
+        self.assertTrue(util.write_if_changed(self.path, 'a = 1\n'))
+        with open(self.path) as fh:
+            self.assertEqual(fh.read(), 'a = 1\n')
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+    def test_unchanged(self):
+        with open(self.path, 'w') as fh:
+            fh.write('a = 1\n')
+        os.utime(self.path, (1000, 1000))
+
+        self.assertFalse(util.write_if_changed(self.path, u'a = 1\n', backup_suffix='.backup'))
+        self.assertEqual(os.stat(self.path).st_mtime, 1000)
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+    def test_changed(self):
+        with open(self.path, 'w') as fh:
+            fh.write('a = 1\n')
+        os.chmod(self.path, 0o640)
+        inode = os.stat(self.path).st_ino
+
+        self.assertTrue(util.write_if_changed(self.path, 'a = 2\n', backup_suffix='.backup'))
+        with open(self.path) as fh:
+            self.assertEqual(fh.read(), 'a = 2\n')
+
+        # Replaced by rename, mode kept, old content backed up
+        st = os.stat(self.path)
+        self.assertNotEqual(st.st_ino, inode)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o640)
+
+        files = sorted(os.listdir(self.tmpdir))
+        self.assertEqual(len(files), 2)
+        backup = [x for x in files if x != 'test.conf'][0]
+        self.assertIn('.backup', backup)
+        with open(os.path.join(self.tmpdir, backup)) as fh:
+            self.assertEqual(fh.read(), 'a = 1\n')
+
+    def test_no_backup(self):
+        with open(self.path, 'w') as fh:
+            fh.write('a = 1\n')
+        self.assertTrue(util.write_if_changed(self.path, 'a = 2\n', chmod=0o600, backup=False))
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+
+class SafeOpenTest(unittest.TestCase):
+    """Opening files with restricted permissions"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_overwrite(self):
+        path = os.path.join(self.tmpdir, 'cache.json')
+        with util.safe_open(path, mode='w', chmod=0o600) as fh:
+            fh.write('{"a": [1, 2, 3, 4, 5, 6]}')
+
+        with self.assertRaises(OSError):
+            util.safe_open(path, mode='w', chmod=0o600)
+
+        with util.safe_open(path, mode='w', chmod=0o600, exclusive=False) as fh:
+            fh.write('{"a": [1]}')
+        with open(path) as fh:
+            self.assertEqual(fh.read(), '{"a": [1]}')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+    """Concurrent tasks with predicate & deadline"""
+
+    def test_all(self):
+        def fail():
+            raise ValueError('fail')
+
+        tasks = [lambda: 1, fail, lambda: 3]
+        res, finished = util.run_concurrently(tasks, max_workers=2)
+        self.assertEqual(res, [1, None, 3])
+        self.assertEqual(finished, [True, True, True])
+
+    def test_predicate_deadline(self):
+        def slow():
+            time.sleep(5)
+            return 'slow'
+
+        time_start = time.time()
+        res, finished = util.run_concurrently([slow, lambda: 'fast'], predicate=lambda x: 'fast' in x)
+        self.assertEqual(res, [None, 'fast'])
+        self.assertEqual(finished, [False, True])
+
+        # Tasks not started before the deadline are dropped
+        res, finished = util.run_concurrently([slow, slow, lambda: 'late'], deadline=0.2, max_workers=2)
+        self.assertEqual(res, [None, None, None])
+        self.assertEqual(finished, [False, False, False])
+        self.assertLess(time.time() - time_start, 2)
+
+
+def free_ports(count):
+    socks = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        socks.append(sock)
+    ports = [x.getsockname()[1] for x in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+class PortsRoutableTest(unittest.TestCase):
+    """Concurrent port reachability checks"""
+
+    def test_concurrent(self):
+        def check(port, tcp, **kwargs):
+            time.sleep(0.3)
+            return port % 2 == 0
+
+        ports = [util.Port(port=9000 + x, tcp=x % 3 != 0) for x in range(10)]
+        with mock.patch('ebstall.util.test_port_routable', side_effect=check):
+            time_start = time.time()
+            res = util.test_ports_routable(ports=ports, with_server=False, deadline=5)
+            self.assertLess(time.time() - time_start, 1.5)
+
+        self.assertEqual(list(res.keys()), ports)
+        self.assertEqual([res[x] for x in ports], [x.port % 2 == 0 for x in ports])
 
+    def test_deadline(self):
+        def check(port, tcp, **kwargs):
+            time.sleep(2.0 if port == 9001 else 0)
+            return True
 
+        audit = mock.MagicMock()
+        ports = [util.Port(port=9000), util.Port(port=9001, tcp=False)]
+        with mock.patch('ebstall.util.test_port_routable', side_effect=check):
+            time_start = time.time()
+            res = util.test_ports_routable(ports=ports, with_server=False, deadline=0.3, audit=audit)
+            self.assertLess(time.time() - time_start, 1.0)
+
+        self.assertTrue(res[ports[0]])
+        self.assertIsNone(res[ports[1]])
+        audit.audit_evt.assert_called_once_with('port-check-timeout', port=9001, host='127.0.0.1', tcp=False,
+                                                deadline=0.3)
+
+    def test_listening(self):
+        socks = []
+        try:
+            for _ in range(5):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind(('127.0.0.1', 0))
+                sock.listen(5)
+                socks.append(sock)
+
+            # Child mock created upfront, concurrent first access from the workers would race
+            audit = mock.MagicMock(audit_evt=mock.Mock())
+            ports = [util.Port(port=x.getsockname()[1], service='test') for x in socks]
+            res = util.test_ports_routable(ports=ports, with_server=False, timeout=1, attempts=1, audit=audit)
+            self.assertTrue(all(res[x] for x in ports))
+
+            evts = [x[0][0] for x in audit.audit_evt.call_args_list]
+            self.assertEqual(evts.count('port-listening'), 5)
+            self.assertEqual(evts.count('port-open'), 5)
+        finally:
+            for sock in socks:
+                sock.close()
+
+    def test_with_server(self):
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            busy.bind(('127.0.0.1', 0))
+            busy.listen(5)
+
+            nums = free_ports(3)
+            ports = [util.Port(port=x, tcp=True) for x in nums] + [util.Port(port=x, tcp=False) for x in nums]
+            ports.append(util.Port(port=busy.getsockname()[1]))
+
+            audit = mock.MagicMock(audit_evt=mock.Mock())
+            with mock.patch('ebstall.util.EchoUpMultiServer', wraps=util.EchoUpMultiServer) as server:
+                res = util.test_ports_routable(ports=ports, bind='127.0.0.1', timeout=1, attempts=1, audit=audit)
+                self.assertEqual(server.call_count, 1)
+
+            self.assertTrue(all(res[x] for x in ports))
+            evts = [x[0] for x in audit.audit_evt.call_args_list]
+            self.assertEqual([x[0] for x in evts].count('port-open-echo'), 6)
+            self.assertIn(('port-bind-error',), [x[:1] for x in evts])
+
+            # Every port reports whether a service listens there, served ones are free
+            listening = [x for x in audit.audit_evt.call_args_list if x[0][0] == 'port-listening']
+            self.assertEqual(len(listening), 7)
+            self.assertEqual(sorted(bool(x[1]['is_listening']) for x in listening), [False] * 6 + [True])
+        finally:
+            busy.close()
+
+
+class EchoUpMultiServerTest(unittest.TestCase):
+    """Multiplexed echo server on many ports"""
+
+    def test_many_ports(self):
+        nums = free_ports(30)
+        ports = [util.Port(port=x, tcp=True) for x in nums] + [util.Port(port=x, tcp=False) for x in nums]
+
+        time_start = time.time()
+        with util.EchoUpMultiServer(ports, bind='127.0.0.1').start() as server:
+            self.assertTrue(server.wait_ready(0))
+            self.assertEqual(len(server.bind_errors), 0)
+            for port in ports:
+                self.assertTrue(util.test_port_open(port=port.port, tcp=port.tcp, timeout=1, attempts=1), port)
+        self.assertLess(time.time() - time_start, 1.0)
+
+    def test_bind_error(self):
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            busy.bind(('127.0.0.1', 0))
+            busy.listen(1)
+            busy_port = util.Port(port=busy.getsockname()[1])
+            free_port = util.Port(port=free_ports(1)[0])
+
+            with util.EchoUpMultiServer([busy_port, free_port], bind='127.0.0.1').start() as server:
+                self.assertEqual(list(server.bind_errors.keys()), [busy_port])
+                self.assertTrue(util.test_port_open(port=free_port.port, timeout=1, attempts=1))
+        finally:
+            busy.close()
+
+    def test_port_open_with_server(self):
+        port = free_ports(1)[0]
+        time_start = time.time()
+        self.assertTrue(util.test_port_open_with_server(bind='127.0.0.1', port=port, timeout=1, attempts=1))
+        self.assertTrue(util.test_port_open_with_server(bind='127.0.0.1', port=port, timeout=1, attempts=1,
+                                                        tcp=False))
+        self.assertLess(time.time() - time_start, 1.0)
+
+
+class OnbootHelpersTest(unittest.TestCase):
+    """Local network fingerprint helpers & phase timing"""
+
+    def test_resolve(self):
+        self.assertIn('127.0.0.1', util.resolve_ipv4('localhost'))
+        self.assertEqual(util.resolve_ipv4('nonexistent.invalid'), [])
+
+    def test_primary_ipv4(self):
+        self.assertEqual(util.get_primary_ipv4(probe='127.0.0.1'), '127.0.0.1')
+
+    def test_phase_timer(self):
+        timer = util.PhaseTimer()
+        for _ in range(2):
+            with timer.phase('a'):
+                time.sleep(0.05)
+
+        with self.assertRaises(ValueError):
+            with timer.phase('b'):
+                raise ValueError()
+
+        js = timer.to_json()
+        self.assertEqual(list(js.keys()), ['a', 'b', 'total'])
+        self.assertGreaterEqual(js['a'], 0.1)
+        self.assertGreaterEqual(js['total'], js['a'])
+
+
+class LazyImportTest(unittest.TestCase):
+    """Module imported on the first use"""
+
+    def setUp(self):
+        sys.modules.pop('colorsys', None)
+
+    def test_module(self):
+        colorsys = util.LazyImport('colorsys')
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertIn('colorsys', sys.modules)
+
+    def test_attr(self):
+        rgb_to_hsv = util.LazyImport('colorsys', 'rgb_to_hsv')
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertEqual(rgb_to_hsv(0.0, 1.0, 0.0)[0], 1.0 / 3.0)
+        self.assertIs(rgb_to_hsv._lazy_load(), sys.modules['colorsys'].rgb_to_hsv)
+
+    def test_missing(self):
+        missing = util.LazyImport('ebstall.nonexistent_module')
+        with self.assertRaises(ImportError):
+            missing.attr
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
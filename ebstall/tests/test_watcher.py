@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from ebstall.watcher import Watcher, TimerService
+
+
+__author__ = 'dusanklinec'
+
+
+class WatcherTest(unittest.TestCase):
+    """Watchers on the shared timer service"""
+
+    def setUp(self):
+        self.service = TimerService()
+
+    def _watcher(self, timeout, fired):
+        evt = threading.Event()
+
+        def fnc():
+            fired.append(w)
+            evt.set()
+
+        w = Watcher(fnc, timeout, service=self.service)
+        w.evt = evt
+        return w
+
+    def test_timeout(self):
+        fired = []
+        w = self._watcher(0.1, fired)
+        w.start(paused=True)
+        time.sleep(0.2)
+        self.assertEqual(fired, [])
+
+        w.signal()
+        self.assertTrue(w.evt.wait(2.0))
+        self.assertTrue(w.timedout)
+        self.assertEqual(fired, [w])
+
+    def test_signal_postpones(self):
+        fired = []
+        w = self._watcher(0.2, fired)
+        w.start(paused=True)
+        start = time.time()
+        for _ in range(5):
+            w.signal()
+            time.sleep(0.1)
+
+        self.assertEqual(fired, [])
+        self.assertTrue(w.evt.wait(2.0))
+        self.assertTrue(time.time() - start >= 0.6)
+
+    def test_stop(self):
+        fired = []
+        w = self._watcher(0.1, fired)
+        w.start(paused=True)
+        w.signal()
+        w.stop()
+        time.sleep(0.3)
+        self.assertFalse(w.timedout)
+        self.assertEqual(self.service.pending(), 0)
+
+    def test_stop_join(self):
+        fired = []
+        w = self._watcher(3600, fired)
+        w.start(paused=True)
+        w.signal()
+        self.assertFalse(w.join(0.05))
+
+        start = time.time()
+        w.stop()
+        self.assertTrue(w.join(2.0))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.service.pending(), 0)
+        self.assertEqual(fired, [])
+
+    def test_many(self):
+        fired = []
+        watchers = [self._watcher(0.05 + 0.01 * (i % 10), fired) for i in range(50)]
+        for w in watchers:
+            w.start(paused=True)
+            w.signal()
+
+        watchers[0].stop()
+        for w in watchers[1:]:
+            self.assertTrue(w.evt.wait(2.0))
+
+        self.assertEqual(len(fired), 49)
+        self.assertFalse(watchers[0].timedout)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -4,8 +4,10 @@
 from __future__ import print_function
 
 import logging
+import os
 import yaql
 from yaql import yaqlization
+from yaql.language import utils as yaql_utils
 from yaql.language import specs
 from yaql.cli import cli_functions
 from yaql.language.factory import OperatorType
@@ -13,9 +15,9 @@ from yaql.language.factory import OperatorType
 from config import Config
 from core import Core
 from ebstall.ebsysconfig import SysConfig
-from ebstall.osutil import PackageInfo, OSInfo
+from ebstall.osutil import PackageInfo, PackageSet, OSInfo
 from errors import *
-import requests
+import httpclient
 import util
 import re
 import errors
@@ -37,6 +39,226 @@ __author__ = 'dusanklinec'
 logger = logging.getLogger(__name__)
 
 
+#
+# Rule data
+#
+
+
+_YAQLIZED = False
+
+
+def yaqlize_types():
+    """
+    Allows access to methods & attributes of the objects used in the rule data.
+    Done only once, yaqlization modifies the classes.
+    :return: 
+    """
+    global _YAQLIZED
+    if _YAQLIZED:
+        return
+
+    yaqlization.yaqlize(Config, blacklist=['set_config'])
+    yaqlization.yaqlize(OSInfo)
+    yaqlization.yaqlize(PackageInfo)
+    yaqlization.yaqlize(RuleData, yaqlize_methods=False)
+    _YAQLIZED = True
+
+
+class RuleData(object):
+    """
+    Root data object for the YAQL rule evaluation.
+    Values are either set directly or computed by the registered providers
+    on the first access and memoized.
+    """
+    def __init__(self):
+        self._values = collections.OrderedDict()
+        self._providers = collections.OrderedDict()
+
+    def set(self, name, value):
+        """
+        Sets the value directly
+        :param name: 
+        :param value: 
+        :return: 
+        """
+        self._values[name] = yaql_utils.convert_input_data(value)
+
+    def register(self, name, provider):
+        """
+        Registers lazy value provider, called on the first access
+        :param name: 
+        :param provider: callable returning the value
+        :return: 
+        """
+        self._values.pop(name, None)
+        self._providers[name] = provider
+
+    def is_loaded(self, name):
+        """
+        Returns True if the value was already set / computed
+        :param name: 
+        :return: 
+        """
+        return name in self._values
+
+    def keys(self):
+        return list(self._values.keys()) + [x for x in self._providers if x not in self._values]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+
+        try:
+            provider = self._providers[name]
+        except KeyError:
+            raise AttributeError(name)
+
+        logger.debug('Computing rule data: %s' % name)
+        self.set(name, provider())
+        return self._values[name]
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def to_json(self):
+        """
+        Converts to the JSON, forces all providers
+        :return: 
+        """
+        return collections.OrderedDict((x, self[x]) for x in self.keys())
+
+
+#
+# Update plan
+#
+
+
+class UpdatePlan(object):
+    """
+    Update actions collected from all passing rules.
+    Actions with the same yum switches are merged to one transaction so yum resolves
+    dependencies, downloads metadata and acquires the rpm lock only once per switch set.
+    """
+    def __init__(self):
+        self.transactions = collections.OrderedDict()
+        self.rules = []
+        self.unknown = []
+
+    @staticmethod
+    def to_list(val):
+        """
+        Normalizes optional scalar / list rule value to a list
+        :param val: 
+        :return: 
+        """
+        if val is None:
+            return []
+        if not isinstance(val, types.ListType):
+            return [val]
+        return list(val)
+
+    @staticmethod
+    def merge_unique(dst, src):
+        """
+        Appends items from src not yet in dst, keeps the order
+        :param dst: 
+        :param src: 
+        :return: 
+        """
+        for x in src:
+            if x not in dst:
+                dst.append(x)
+        return dst
+
+    def signature(self, params):
+        """
+        Transaction key - actions with the same key can run in one yum transaction.
+        General updates and package restricted updates are never merged together.
+        :param params: update_packages kwargs
+        :return: 
+        """
+        return (params.get('packages') is not None,
+                bool(params.get('security')),
+                bool(params.get('bugfix')),
+                bool(params.get('skip_broken')),
+                tuple(sorted(self.to_list(params.get('excludes')))),
+                tuple(sorted(self.to_list(params.get('enable_repos')))),
+                tuple(sorted(self.to_list(params.get('disable_repos')))))
+
+    def add_update_system(self, params, rule_id=None):
+        """
+        Adds update-system action to the plan, merges it with the compatible transaction
+        :param params: update_packages kwargs
+        :param rule_id: 
+        :return: 
+        """
+        key = self.signature(params)
+        tx = self.transactions.get(key)
+        if tx is None:
+            tx = dict(params)
+            tx['packages'] = None if params.get('packages') is None else PackageSet()
+            tx['packages_var'] = []
+            tx['rules'] = []
+            self.transactions[key] = tx
+
+        if params.get('packages') is not None:
+            tx['packages'].update(params['packages'])
+
+        # General update without packages_var updates everything, absorbs restrictions of the merged actions
+        packages_var = self.to_list(params.get('packages_var'))
+        if tx['packages'] is None and len(packages_var) == 0:
+            tx['packages_var'] = None
+        elif tx['packages_var'] is not None:
+            self.merge_unique(tx['packages_var'], packages_var)
+
+        tx['rules'].append(rule_id)
+        self.rules.append(rule_id)
+        return tx
+
+    def add_unknown(self, rule_id):
+        """
+        Records the action the planner does not know
+        :param rule_id: 
+        :return: 
+        """
+        self.unknown.append(rule_id)
+
+    def get_transactions(self):
+        """
+        Merged transactions, update_packages kwargs
+        :return: 
+        """
+        res = []
+        for tx in self.transactions.values():
+            params = dict(tx)
+            del params['rules']
+            if not params['packages_var']:
+                params['packages_var'] = None
+            res.append(params)
+        return res
+
+    def is_empty(self):
+        """
+        True if there is nothing to do
+        :return: 
+        """
+        return len(self.transactions) == 0
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __repr__(self):
+        return 'UpdatePlan(transactions=%s, rules=%s)' % (len(self.transactions), len(self.rules))
+
+
 #
 # Updater
 #
@@ -46,7 +268,7 @@ class Updater(object):
     """
     Updating the private space
     """
-    def __init__(self, config=None, audit=None, sysconfig=None, ebstall_version=None):
+    def __init__(self, config=None, audit=None, sysconfig=None, ebstall_version=None, expr_cache_size=512):
         self.engine = None
         self.root = None
         self.config = config
@@ -54,6 +276,13 @@ class Updater(object):
         self.syscfg = sysconfig
         self.ebstall_version = ebstall_version
 
+        # Parsed expressions cache, expression string -> yaql statement
+        self.expr_cache = util.LRUCache(max_size=expr_cache_size)
+
+        # If set, update specs are cached there, revalidated with conditional GET after specs_max_age seconds
+        self.specs_cache_path = None
+        self.specs_max_age = 60 * 60
+
     def init_parser(self):
         """
         Initializes yaql parser engine. Builds parsing rules.
@@ -71,6 +300,9 @@ class Updater(object):
 
         self.engine = factory.create(options=engine_options)
 
+        # Parsed statements are bound to the engine
+        self.expr_cache.clear()
+
     def new_context(self):
         """
         Prepares a new context for new evaluation. 
@@ -86,48 +318,60 @@ class Updater(object):
     def gen_rule_data(self):
         """
         Generates the root data object for the YAQL evaluation.
+        Expensive values (OS info, installed packages) are computed only if a rule dereferences them.
         :return: 
         """
-        self.root = collections.OrderedDict()
+        yaqlize_types()
+        self.root = RuleData()
 
         # Config & versions, abbrevs
-        self.root['config'] = self.config
-        self.root['ebstall_version'] = versions.Version(self.ebstall_version)
+        self.root.set('config', self.config)
+        self.root.set('ebstall_version', versions.Version(self.ebstall_version))
 
-        self.root['ebstall_version_initial'] = versions.Version(self.config.ebstall_version_initial) \
-            if self.config is not None else versions.Version('0')
+        self.root.set('ebstall_version_initial', versions.Version(self.config.ebstall_version_initial)
+                      if self.config is not None else versions.Version('0'))
 
-        self.root['ebstall_cfg_version'] = versions.Version(self.config.ebstall_version) \
-            if self.config is not None else versions.Version('0')
+        self.root.set('ebstall_cfg_version', versions.Version(self.config.ebstall_version)
+                      if self.config is not None else versions.Version('0'))
 
-        self.root['install_version'] = versions.Version(self.config.install_version) \
-            if self.config is not None else versions.Version('0')
+        self.root.set('install_version', versions.Version(self.config.install_version)
+                      if self.config is not None else versions.Version('0'))
 
-        self.root['jboss_version'] = versions.Version(self.config.jboss_version) \
-            if self.config is not None else versions.Version('0')
+        self.root.set('jboss_version', versions.Version(self.config.jboss_version)
+                      if self.config is not None else versions.Version('0'))
 
-        self.root['ejbca_version'] = versions.Version(self.config.ejbca_version) \
-            if self.config is not None else versions.Version('0')
+        self.root.set('ejbca_version', versions.Version(self.config.ejbca_version)
+                      if self.config is not None else versions.Version('0'))
 
-        self.root['source_image_code'] = self.config.source_image_code \
-            if self.config is not None else None
+        self.root.set('source_image_code', self.config.source_image_code
+                      if self.config is not None else None)
 
         # Current OS info
-        self.root['os'] = self.syscfg.get_os()
+        self.root.register('os', self.syscfg.get_os)
 
         # Installed packages
-        packages = self.syscfg.get_installed_packages()
-        self.root['pkgs'] = {x.name: x for x in packages}
-        self.root['pkgs_lst'] = packages
-        self.root['pkgs_map'] = {str(x): x for x in packages}
-
-        # Allowing access to methods & attributes
-        yaqlization.yaqlize(Config, blacklist=['set_config'])
-        yaqlization.yaqlize(OSInfo)
-        yaqlization.yaqlize(PackageInfo)
+        root = self.root
+        self.root.register('pkgs_lst', self.syscfg.get_installed_packages)
+        self.root.register('pkgs', lambda: {x.name: x for x in root.pkgs_lst})
+        self.root.register('pkgs_map', lambda: {str(x): x for x in root.pkgs_lst})
 
         return self.root
 
+    def parse_expr(self, expr):
+        """
+        Parses the expression, parsed statements are cached.
+        :param expr: 
+        :return: yaql statement
+        """
+        if self.engine is None:
+            self.init_parser()
+
+        statement = self.expr_cache.get(expr)
+        if statement is None:
+            statement = self.engine(expr)
+            self.expr_cache.put(expr, statement)
+        return statement
+
     def eval_single(self, expr, ctx=None):
         """
         Evaluates a single expression
@@ -135,14 +379,13 @@ class Updater(object):
         :param ctx: 
         :return: 
         """
-        if self.engine is None:
-            self.init_parser()
+        statement = self.parse_expr(expr)
 
         if ctx is None:
             ctx = self.new_context()
 
         logger.debug('Eval: %s' % expr)
-        res = self.engine(expr).evaluate(self.root, ctx)
+        res = statement.evaluate(self.root, ctx)
         return res
 
     def eval_expr(self, expr, ctx=None, lazy=False):
@@ -211,22 +454,51 @@ class Updater(object):
 
     def fetch_update_specs(self, attempts=3):
         """
-        Fetched update.json from the provisioning servers
+        Fetched update.json from the provisioning servers.
+        If the specs cache is enabled, fresh cached specs are returned without network request,
+        otherwise conditional GET is used to revalidate the cached specs.
         :return: 
         """
+        cache = self.load_specs_cache()
+        if cache is not None and time.time() - cache.get('fetched', 0) < self.specs_max_age:
+            logger.debug('Using cached update specs')
+            self.audit.audit_evt('prov-update-cached', url=cache.get('url'))
+            return cache['specs']
 
         logger.debug('Going to download update specs from the provisioning servers')
         for provserver in consts.PROVISIONING_SERVERS:
             url = 'https://%s/update/update.json' % provserver
 
+            headers = {}
+            if cache is not None and cache.get('url') == url:
+                if cache.get('etag') is not None:
+                    headers['If-None-Match'] = cache['etag']
+                if cache.get('last_modified') is not None:
+                    headers['If-Modified-Since'] = cache['last_modified']
+
             for attempt in range(attempts):
                 try:
                     self.audit.audit_evt('prov-update', url=url)
-                    res = requests.get(url=url, timeout=15)
+                    res = httpclient.get(url=url, headers=headers)
+
+                    if res.status_code == 304 and headers:
+                        self.audit.audit_evt('prov-update', url=url, not_modified=True)
+                        cache['fetched'] = time.time()
+                        self.store_specs_cache(cache)
+                        return cache['specs']
+
                     res.raise_for_status()
                     js = res.json()
 
                     self.audit.audit_evt('prov-update', url=url, response=js)
+                    if cache is None:
+                        cache = collections.OrderedDict()
+                    cache['url'] = url
+                    cache['etag'] = res.headers.get('ETag')
+                    cache['last_modified'] = res.headers.get('Last-Modified')
+                    cache['fetched'] = time.time()
+                    cache['specs'] = js
+                    self.store_specs_cache(cache)
                     return js
 
                 except Exception as e:
@@ -234,7 +506,98 @@ class Updater(object):
                     self.audit.audit_exception(e, process='prov-update')
                     time.sleep(1)
 
-            return 0
+        if cache is not None:
+            logger.info('Could not fetch update specs, using stale cached specs')
+            return cache['specs']
+
+        raise errors.RequestFailed('Could not fetch update specs')
+
+    def load_specs_cache(self):
+        """
+        Loads the update specs cache
+        :return: cache dict or None if disabled / not present
+        """
+        if self.specs_cache_path is None or not os.path.exists(self.specs_cache_path):
+            return None
+
+        try:
+            with open(self.specs_cache_path, 'r') as fh:
+                cache = json.load(fh, object_pairs_hook=collections.OrderedDict)
+            if 'specs' not in cache:
+                return None
+            return cache
+
+        except Exception as e:
+            logger.debug('Could not load update specs cache: %s' % e)
+            return None
+
+    def store_specs_cache(self, cache):
+        """
+        Stores the update specs cache
+        :param cache: 
+        :return: 
+        """
+        if self.specs_cache_path is None:
+            return
+
+        try:
+            util.make_or_verify_dir(os.path.dirname(self.specs_cache_path), mode=0o755)
+            util.write_if_changed(self.specs_cache_path, json.dumps(cache, indent=2), chmod=0o600, backup=False)
+
+        except Exception as e:
+            logger.debug('Could not store update specs cache: %s' % e)
+
+    def run_state(self, specs):
+        """
+        Returns the state the update result depends on - update specs, installer version & configuration,
+        installed packages. None if the state cannot be determined.
+        :param specs: 
+        :return: 
+        """
+        fingerprint = self.syscfg.get_inventory_fingerprint()
+        if fingerprint is None:
+            return None
+
+        config = self.config.to_string() if self.config is not None else ''
+        state = collections.OrderedDict()
+        state['specs'] = self.spec_hash(specs)
+        state['env'] = util.sha1('%s|%s' % (self.ebstall_version, config), as_hex=True)
+        state['inventory'] = fingerprint
+        return state
+
+    def is_last_run_state(self, state):
+        """
+        Returns True if the state matches the state after the last successful update run
+        :param state: 
+        :return: 
+        """
+        if state is None:
+            return False
+
+        cache = self.load_specs_cache()
+        return cache is not None and cache.get('last_run') == json.loads(json.dumps(state))
+
+    def store_last_run_state(self, state):
+        """
+        Stores the state after a successful update run
+        :param state: 
+        :return: 
+        """
+        cache = self.load_specs_cache()
+        if cache is None or state is None:
+            return
+
+        cache['last_run'] = state
+        self.store_specs_cache(cache)
+
+    def spec_hash(self, specs):
+        """
+        Hash of the update specs and the yaql version evaluating them, part of the run state.
+        :param specs: 
+        :return: 
+        """
+        data = json.dumps(specs, sort_keys=True)
+        return util.sha1('%s|%s' % (yaql.__version__, data), as_hex=True)
 
     def update_rule_id(self, rule):
         """
@@ -253,21 +616,28 @@ class Updater(object):
 
         return id
 
-    def update_action(self, rule):
+    def update_action(self, rule, plan=None):
         """
         Handles particular update action
         :param rule: 
+        :param plan: if given, the action is only recorded to the update plan
         :return: 
         """
         action = rule['action']
         if action == 'update-system':
-            self.update_action_update_system(rule)
+            if plan is not None:
+                plan.add_update_system(self.update_system_params(rule), rule_id=self.update_rule_id(rule))
+            else:
+                self.update_action_update_system(rule)
         else:
             logger.info('Unknown action for update rule: %s' % self.update_rule_id(rule))
+            if plan is not None:
+                plan.add_unknown(self.update_rule_id(rule))
 
-    def update_action_update_system(self, rule):
+    def update_system_params(self, rule):
         """
-        Update system with yum update
+        Maps update-system rule to the update_packages arguments
+        :param rule: 
         :return: 
         """
         packages = None
@@ -303,17 +673,25 @@ class Updater(object):
         if 'pkg-disable-repos' in rule:
             disable_repos = rule['pkg-disable-repos']
 
-        res = self.syscfg.update_packages(packages=packages, packages_var=packages_var,
-                                          security=security, bugfix=bugfix, excludes=excludes, skip_broken=skip_broken,
-                                          enable_repos=enable_repos, disable_repos=disable_repos)
+        return dict(packages=packages, packages_var=packages_var,
+                    security=security, bugfix=bugfix, excludes=excludes, skip_broken=skip_broken,
+                    enable_repos=enable_repos, disable_repos=disable_repos)
+
+    def update_action_update_system(self, rule):
+        """
+        Update system with yum update
+        :return: 
+        """
+        res = self.syscfg.update_packages(**self.update_system_params(rule))
 
         logger.info('Updating rule %s resulted in %s' % (self.update_rule_id(rule), res))
         return res
 
-    def update_rule_single(self, rule):
+    def update_rule_single(self, rule, plan=None):
         """
         Processes single update rule
         :param rule: 
+        :param plan: if given, actions are collected to the plan instead of being executed
         :return: 
         """
 
@@ -329,42 +707,105 @@ class Updater(object):
 
         # Process rule...
         if 'action' in rule:
-            self.update_action(rule)
+            self.update_action(rule, plan=plan)
 
         # Process then
         if 'then' in rule:
-            self.update_rule(rule['then'])
+            self.update_rule(rule['then'], plan=plan)
         return 0
 
-    def update_rule(self, rule):
+    def update_rule(self, rule, plan=None):
         """
         Processes update rule, recursively
         :param rule: 
+        :param plan: if given, actions are collected to the plan instead of being executed
         :return: 
         """
         if not isinstance(rule, types.ListType):
-            return self.update_rule_single(rule)
+            return self.update_rule_single(rule, plan=plan)
 
         res = []
         for crule in rule:
-            cur_res = self.update_rule_single(crule)
+            cur_res = self.update_rule_single(crule, plan=plan)
+            res.append(cur_res)
+        return res
+
+    def plan_update(self, updates):
+        """
+        Evaluates all update rules and collects their actions to the update plan.
+        Nothing is executed, rules are evaluated against the current system state.
+        :param updates: 
+        :return: UpdatePlan
+        """
+        plan = UpdatePlan()
+        self.update_rule(updates, plan=plan)
+        logger.debug('Update plan: %s' % plan)
+        return plan
+
+    def describe_plan(self, plan):
+        """
+        Resolves yum commands of the merged transactions, for the plan mode
+        :param plan: 
+        :return: list of (transaction params, commands)
+        """
+        res = []
+        for params in plan.get_transactions():
+            cmds, packages = self.syscfg.plan_update_packages(**params)
+            res.append((params, cmds))
+        return res
+
+    def execute_plan(self, plan):
+        """
+        Runs merged transactions of the update plan
+        :param plan: 
+        :return: list of update_packages results
+        """
+        res = []
+        for params in plan.get_transactions():
+            cur_res = self.syscfg.update_packages(**params)
+            logger.info('Update transaction resulted in %s' % cur_res)
             res.append(cur_res)
+
+        self.audit.audit_evt('update-plan', transactions=len(plan), rules=plan.rules, unknown=plan.unknown,
+                             results=res)
         return res
 
-    def update(self):
+    def update(self, plan_only=False):
         """
         Main update method.
         Downloads update specs from the provisoning server, processes it...
+        All passing rules are evaluated first, their actions are merged to minimal number of yum transactions
+        which are then executed.
+
+        :param plan_only: if True, the update plan is returned without executing it
         :return: 
         """
 
         specs = self.fetch_update_specs()
         updates = specs['updates']
 
-        self.init_parser()
+        # Nothing changed since the last successful run - skip rule evaluation entirely
+        if not plan_only and self.is_last_run_state(self.run_state(specs)):
+            logger.debug('Update specs and installed packages did not change, skipping update')
+            self.audit.audit_evt('update-skipped')
+            return []
+
+        if self.engine is None:
+            self.init_parser()
+
         self.gen_rule_data()
 
-        res = self.update_rule(updates)
+        plan = self.plan_update(updates)
+        if plan_only:
+            return plan
+
+        res = self.execute_plan(plan)
+
+        # Failed transactions are retried on the next run
+        if all(x == 0 for x in res):
+            self.store_last_run_state(self.run_state(specs))
+        else:
+            logger.info('Update failed: %s, not recording the run state' % res)
         return res
 
 
@@ -14,39 +14,38 @@ from builtins import input
 from builtins import bytes
 
 import binascii
+import collections
+import contextlib
 import errno
+import functools
 import grp
 import hashlib
 import math
 import hmac
+import importlib
 import logging
 import os
 import pwd
 import random
 import re
+import select
 import shutil
 import socket
 import stat
 import string
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import types
 import psutil
-import requests
 import datetime
 import decimal
 from audit import AuditManager
 
-import OpenSSL
 import socketserver
-from Crypto.PublicKey import RSA
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.x509.base import load_pem_x509_certificate
 from sarge import run, Capture, Feeder
-from jbossply.jbossparser import JbossParser
 from ebstall import versions as ebversions
 
 import errors
@@ -61,7 +60,7 @@ class Port(object):
     def __init__(self, port=None, tcp=True, service=None, *args, **kwargs):
         self.port = port
         self.tcp = tcp
-        self.service = None
+        self.service = service
 
     def __repr__(self):
         return '%s(port=%r, tcp=%r, service=%r)' % (self.__class__, self.port, self.tcp, self.service)
@@ -324,6 +323,72 @@ def safe_create_with_backup(path, mode='w', chmod=0o644, backup_dir=None, backup
     return safe_open(path, mode, chmod), backup_path
 
 
+def write_if_changed(path, content, chmod=None, backup=True, backup_dir=None, backup_suffix=None):
+    """
+    Writes the content to the file only if it differs from the current file content.
+    The file is replaced atomically - content is written to a temporary file in the same directory,
+    synced to the disk and renamed over the original file. Backup is created only if the content differs.
+
+    :param path:
+    :param content: new file content
+    :param chmod: file mode, if None the mode of the existing file is kept (0o644 for a new file)
+    :param backup: if True, the original file is backed up before it is replaced
+    :param backup_dir:
+    :param backup_suffix: if defined, suffix is appended to the backup file (e.g., .backup)
+    :return: True if the file was written
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    old_stat = None
+    if os.path.exists(path):
+        old_stat = os.stat(path)
+        with open(path, 'rb') as fh:
+            old_content = fh.read()
+        if sha1(old_content) == sha1(content):
+            return False
+
+    if chmod is None:
+        chmod = old_stat.st_mode & 0o777 if old_stat is not None else 0o644
+
+    if backup and old_stat is not None:
+        file_backup(path, chmod=chmod, backup_dir=backup_dir, backup_suffix=backup_suffix)
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.chmod(tmp_path, chmod)
+        if old_stat is not None:
+            try:
+                os.chown(tmp_path, old_stat.st_uid, old_stat.st_gid)
+            except OSError:
+                pass
+
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # Persist the rename itself, best effort
+    try:
+        dir_fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+    return True
+
+
 def safe_open(path, mode="w", chmod=None, buffering=None, exclusive=True):
     """Safely open a file.
 
@@ -333,14 +398,17 @@ def safe_open(path, mode="w", chmod=None, buffering=None, exclusive=True):
         if ``None``.
     :param int buffering: Same as `bufsize` for `os.fdopen`, uses Python
         defaults if ``None``.
-    :param bool exclusive: if True, the file cannot exist before
+    :param bool exclusive: if True, the file cannot exist before.
+        If False, the existing file is opened, truncated for write modes.
     """
     # pylint: disable=star-args
     open_args = () if chmod is None else (chmod,)
     fdopen_args = () if buffering is None else (buffering,)
-    flags = os.O_CREAT | os.O_EXCL | os.O_RDWR
+    flags = os.O_CREAT | os.O_RDWR
     if exclusive:
         flags |= os.O_EXCL
+    if 'w' in mode:
+        flags |= os.O_TRUNC
 
     return os.fdopen(os.open(path, flags, *open_args),mode, *fdopen_args)
 
@@ -508,6 +576,8 @@ def gen_ss_cert(key, domains, not_before=None,
     extension is used, unless `force_san` is ``True``.
 
     """
+    import OpenSSL
+
     assert domains, "Must provide one or more hostnames for the cert."
     cert = OpenSSL.crypto.X509()
     cert.set_serial_number(int(binascii.hexlify(OpenSSL.rand.bytes(16)), 16))
@@ -539,20 +609,26 @@ def gen_ss_cert(key, domains, not_before=None,
     return cert
 
 
+# Crypto libraries are imported on use, most of the CLI commands do not need them
+
 def get_backend(backend=None):
+    from cryptography.hazmat.backends import default_backend
     return default_backend() if backend is None else backend
 
 
 def load_x509(data, backend=None):
+    from cryptography.x509.base import load_pem_x509_certificate
     backend = get_backend(backend)
     return load_pem_x509_certificate(data, backend)
 
 
 def load_pem_private_key(data, password=None, backend=None):
+    from cryptography.hazmat.primitives import serialization
     return serialization.load_pem_private_key(data, None, get_backend(backend))
 
 
 def load_pem_private_key_pycrypto(data, password=None):
+    from Crypto.PublicKey import RSA
     return RSA.importKey(data, passphrase=password)
 
 
@@ -1068,6 +1144,153 @@ class EchoUpUDPServer(EchoUpServer):
         self.server = socketserver.UDPServer(self.address, EchoUpUDPHandler, False)
 
 
+class EchoUpMultiServer(object):
+    """
+    Echo uppercase server on any number of TCP and UDP ports at once.
+    All sockets are served by one thread multiplexing them with poll (select where poll is not available).
+    Sockets are bound and listening when start() returns, ready event is set when the serving loop runs.
+    """
+    def __init__(self, ports, bind='0.0.0.0'):
+        """
+        :param ports: list of Port
+        :param bind: address to bind sockets to
+        """
+        self.ports = ports
+        self.bind = bind
+        self.bind_errors = collections.OrderedDict()
+        self.ready = threading.Event()
+        self.thread = None
+        self._listeners = {}
+        self._clients = {}
+        self._wakeup = None
+        self._running = False
+
+    def _listen(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM if port.tcp else socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.bind, port.port))
+            if port.tcp:
+                sock.listen(16)
+            sock.setblocking(0)
+            return sock
+        except:
+            silent_close(sock)
+            raise
+
+    def start(self, wait=True):
+        """
+        Binds all ports, starts the serving thread.
+        Ports failed to bind are stored in bind_errors, the rest is served.
+        :param wait: if True, waits until the serving loop runs
+        :return:
+        """
+        for port in self.ports:
+            try:
+                sock = self._listen(port)
+                self._listeners[sock.fileno()] = (sock, port)
+            except Exception as e:
+                logger.debug('Echo server could not bind %s: %s' % (port, e))
+                self.bind_errors[port] = e
+
+        self._wakeup = os.pipe()
+        self._running = True
+        self.thread = threading.Thread(target=self._serve, name='echo-multi')
+        self.thread.daemon = True
+        self.thread.start()
+        if wait:
+            self.ready.wait()
+        return self
+
+    def wait_ready(self, timeout=None):
+        """
+        Waits until the server is serving
+        :param timeout:
+        :return: True if ready
+        """
+        self.ready.wait(timeout)
+        return self.ready.is_set()
+
+    def _fds(self):
+        return [self._wakeup[0]] + list(self._listeners.keys()) + list(self._clients.keys())
+
+    def _serve(self):
+        poller = select.poll() if hasattr(select, 'poll') else None
+        registered = set()
+        self.ready.set()
+
+        while self._running:
+            fds = self._fds()
+            if poller is not None:
+                for fd in set(fds) - registered:
+                    poller.register(fd, select.POLLIN)
+                for fd in registered - set(fds):
+                    poller.unregister(fd)
+                registered = set(fds)
+                readable = [fd for fd, evt in poller.poll()]
+            else:
+                readable = select.select(fds, [], [])[0]
+
+            for fd in readable:
+                if fd == self._wakeup[0]:
+                    continue
+                try:
+                    self._handle(fd)
+                except Exception as e:
+                    logger.debug('Echo server error: %s' % e)
+
+        for fd in list(self._clients.keys()):
+            silent_close(self._clients.pop(fd))
+
+    def _handle(self, fd):
+        if fd in self._clients:
+            # One read, one uppercase reply, close - as EchoUpTCPHandler
+            client = self._clients.pop(fd)
+            try:
+                read_data = client.recv(1024).strip()
+                if read_data is not None and len(read_data) > 0:
+                    client.setblocking(1)
+                    client.settimeout(1.0)
+                    client.sendall(read_data.upper())
+            finally:
+                silent_close(client)
+            return
+
+        sock, port = self._listeners[fd]
+        if port.tcp:
+            client, _ = sock.accept()
+            client.setblocking(0)
+            self._clients[client.fileno()] = client
+        else:
+            data, address = sock.recvfrom(4096)
+            sock.sendto(data.strip().upper(), address)
+
+    def close(self):
+        """
+        Stops the serving thread, closes all sockets
+        :return:
+        """
+        if self._running:
+            self._running = False
+            os.write(self._wakeup[1], b'x')
+            self.thread.join()
+
+        for sock, port in self._listeners.values():
+            silent_close(sock)
+        self._listeners = {}
+
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def test_port_open_with_server(bind='0.0.0.0', host='127.0.0.1', port=80, timeout=15, attempts=3, tcp=True):
     """
     Test if the given port is open on the TCP.
@@ -1082,17 +1305,12 @@ def test_port_open_with_server(bind='0.0.0.0', host='127.0.0.1', port=80, timeou
     :return:
     """
 
-    server = None
-    if tcp:
-        server = EchoUpTCPServer((bind, port))
-    else:
-        server = EchoUpUDPServer((bind, port))
+    with EchoUpMultiServer([Port(port=port, tcp=tcp)], bind=bind).start() as server:
+        for err in server.bind_errors.values():
+            raise err
 
-    with server.start():
-        time.sleep(1.5)
         return test_port_open(host=host, port=port, timeout=timeout, attempts=attempts,
                               test_upper_read_write=True, tcp=tcp)
-    pass
 
 
 def test_port_routable(host='127.0.0.1', port=80, tcp=True, with_server=True, bind='0.0.0.0',
@@ -1153,12 +1371,147 @@ def test_port_routable(host='127.0.0.1', port=80, tcp=True, with_server=True, bi
     return succ2
 
 
+def run_concurrently(tasks, predicate=None, deadline=None, max_workers=None, name='task'):
+    """
+    Runs the callables concurrently in daemon worker threads.
+    Waits until all tasks finish, the predicate over the results holds or the deadline passes.
+    Tasks still running are left in the background, tasks not started yet are dropped.
+
+    :param tasks: list of callables without arguments
+    :param predicate: function(results) evaluated after each finished task, True stops the waiting
+    :param deadline: time limit in seconds, None for no limit
+    :param max_workers: maximum number of worker threads, None for a thread per task
+    :param name: worker thread name prefix
+    :return: (results, finished) lists in the tasks order; result is None if the task failed or did not finish
+    """
+    results = [None] * len(tasks)
+    finished = [False] * len(tasks)
+    if len(tasks) == 0:
+        return results, finished
+
+    pending = list(range(len(tasks)))
+    lock = threading.Lock()
+    done = threading.Condition(lock)
+
+    def worker():
+        while True:
+            with lock:
+                if len(pending) == 0:
+                    return
+                idx = pending.pop(0)
+
+            res = None
+            try:
+                res = tasks[idx]()
+            except Exception as e:
+                logger.debug('Task %s-%d failed: %s' % (name, idx, e))
+
+            with lock:
+                results[idx] = res
+                finished[idx] = True
+                done.notify_all()
+
+    time_start = time.time()
+    num_workers = len(tasks) if max_workers is None else min(max_workers, len(tasks))
+    for idx in range(num_workers):
+        thread = threading.Thread(target=worker, name='%s-%d' % (name, idx))
+        thread.daemon = True
+        thread.start()
+
+    with lock:
+        while not all(finished):
+            if predicate is not None and predicate(results):
+                break
+
+            if deadline is None:
+                done.wait(1.0)
+                continue
+
+            remaining = time_start + deadline - time.time()
+            if remaining <= 0:
+                break
+            done.wait(remaining)
+
+        # Snapshot under the lock, late workers must not modify the returned lists
+        del pending[:]
+        return list(results), list(finished)
+
+
+def test_ports_routable(host='127.0.0.1', ports=None, with_server=True, bind='0.0.0.0',
+                        timeout=7, attempts=3, deadline=None, max_workers=16, audit=None):
+    """
+    Tests routability of more ports concurrently, each port is checked in a worker thread.
+    With with_server, all ports are bound at once by one EchoUpMultiServer and bound ports are tested
+    through the echo. Ports failed to bind (e.g., a service is listening there) are checked
+    by test_port_routable() without the server, so the same audit events are emitted per port.
+
+    Worker threads are daemons, checks not finished before the deadline are left running
+    in the background and reported as undetermined.
+
+    :param host:
+    :param ports: list of Port
+    :param with_server: if true, the local server is bound to the socket to test the routability
+    :param bind: address to bind the local server to
+    :param timeout: per connection timeout
+    :param attempts:
+    :param deadline: time limit in seconds for all checks, None for no limit
+    :param max_workers: maximum number of concurrent checks
+    :param audit: Auditing module
+    :return: OrderedDict Port -> True if routable, false if not, None if cannot determine
+    """
+    if audit is None:
+        audit = AuditManager(disabled=True)
+
+    ports = defval(ports, [])
+    if len(ports) == 0:
+        return collections.OrderedDict()
+
+    time_start = time.time()
+    server = None
+    served = set()
+    if with_server:
+        server = EchoUpMultiServer(ports, bind=bind).start()
+        served = set(x for x in ports if x not in server.bind_errors)
+        for port, err in server.bind_errors.items():
+            audit.audit_evt('port-bind-error', port=port.port, tcp=port.tcp, bind=bind, error=str(err))
+
+    def check(port):
+        if port not in served:
+            return test_port_routable(host=host, port=port.port, tcp=port.tcp, with_server=False,
+                                      bind=bind, timeout=timeout, attempts=attempts, audit=audit)
+
+        # Bound by the shared server, nothing else listens there
+        audit.audit_evt('port-listening', port=port.port, host=host, tcp=port.tcp, with_server=True,
+                        bind=bind, is_listening=False)
+        res = test_port_open(host=host, port=port.port, timeout=timeout, attempts=attempts,
+                             test_upper_read_write=True, tcp=port.tcp)
+        audit.audit_evt('port-open-echo', port=port.port, host=host, tcp=port.tcp, attempts=attempts,
+                        timeout=timeout, is_open=res)
+        return res
+
+    try:
+        tasks = [functools.partial(check, x) for x in ports]
+        remaining = None if deadline is None else time_start + deadline - time.time()
+        res, finished = run_concurrently(tasks, deadline=remaining, max_workers=max_workers, name='port-check')
+    finally:
+        if server is not None:
+            server.close()
+
+    res_map = collections.OrderedDict(zip(ports, res))
+    unfinished = [x for x, fin in zip(ports, finished) if not fin]
+    for port in unfinished:
+        audit.audit_evt('port-check-timeout', port=port.port, host=host, tcp=port.tcp, deadline=deadline)
+    return res_map
+
+
 def jboss_to_json(output):
     """
     Converts jboss CLI output to JSON
     :param output:
     :return:
     """
+    from jbossply.jbossparser import JbossParser
+
     if isinstance(output, types.ListType):
         output = ''.join(output)
     parser = JbossParser()
@@ -1219,18 +1572,19 @@ def collision_generator(src, prefix_len=20, nonce_init=1):
         nonce += 1
 
 
-def determine_public_ip(attempts=3, audit=None):
+def determine_public_ip(attempts=3, audit=None, url='https://api.ipify.org?format=json', timeout=15):
     """
     Tries to determine public IP address by querying IPfy interface.
     :return: IP address or None if detection was not successful.
     """
-    url = 'https://api.ipify.org?format=json'
+    import httpclient  # requests is imported only when the network is used
+
     for attempt in range(attempts):
         try:
             if audit is not None:
                 audit.audit_evt('ipify-load')
 
-            res = requests.get(url=url, timeout=15)
+            res = httpclient.get(url=url, timeout=timeout)
             res.raise_for_status()
             js = res.json()
 
@@ -1247,12 +1601,14 @@ def determine_public_ip(attempts=3, audit=None):
     return None
 
 
-def determine_public_ip_eb(attempts=3, audit=None, host='hut6.enigmabridge.com'):
+def determine_public_ip_eb(attempts=3, audit=None, host='hut6.enigmabridge.com', url=None, timeout=15):
     """
     Tries to determine public IP address by querying EB interface.
     :return: IP address or None if detection was not successful.
     """
-    url = 'https://%s:8445/api/v1/apikey' % host
+    import httpclient
+
+    url = defval(url, 'https://%s:8445/api/v1/apikey' % host)
     headers = {'X-Auth-Token': 'public'}
 
     for attempt in range(attempts):
@@ -1266,7 +1622,7 @@ def determine_public_ip_eb(attempts=3, audit=None, host='hut6.enigmabridge.com')
             if audit is not None:
                 audit.audit_evt('eb-ip-load')
 
-            res = requests.post(url=url, json=body, headers=headers, timeout=15)
+            res = httpclient.post(url=url, json=body, headers=headers, timeout=timeout)
             res.raise_for_status()
             js = res.json()
 
@@ -1291,6 +1647,122 @@ def determine_public_ip_eb(attempts=3, audit=None, host='hut6.enigmabridge.com')
     return None
 
 
+def is_ip_address(ip):
+    """
+    Returns True if the string is a valid IPv4 or IPv6 address
+    :param ip:
+    :return:
+    """
+    if ip is None or not isinstance(ip, basestring):
+        return False
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, str(ip))
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+def get_primary_ipv4(probe='198.51.100.1'):
+    """
+    Address of the interface with the default route.
+    Connecting UDP socket only asks the kernel for the route, no packet is sent.
+    :param probe: any address routed via the default route
+    :return: IPv4 address or None
+    """
+    sock = None
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((probe, 53))
+        return sock.getsockname()[0]
+    except Exception as e:
+        logger.debug('Could not determine primary interface address: %s' % e)
+        return None
+    finally:
+        silent_close(sock)
+
+
+def resolve_ipv4(hostname):
+    """
+    IPv4 addresses of the hostname from the system resolver
+    :param hostname:
+    :return: list of addresses, empty if not resolvable
+    """
+    try:
+        return socket.gethostbyname_ex(hostname)[2]
+    except Exception as e:
+        logger.debug('Could not resolve %s: %s' % (hostname, e))
+        return []
+
+
+class PhaseTimer(object):
+    """
+    Measures duration of named phases of an operation
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.time_start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times the block as the phase, repeated phases are summed
+        :param name:
+        :return:
+        """
+        time_start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - time_start
+
+    def total(self):
+        return time.time() - self.time_start
+
+    def to_json(self):
+        js = collections.OrderedDict((x, round(y, 4)) for x, y in self.phases.items())
+        js['total'] = round(self.total(), 4)
+        return js
+
+
+def determine_public_ip_hedged(sources, quorum=1, deadline=None, audit=None):
+    """
+    Queries all public IP sources concurrently.
+    Returns the first valid IP address reported by quorum sources. If the quorum is not reached when all
+    sources finish or the deadline passes, the first valid answer in the sources order is returned.
+
+    :param sources: list of functions returning IP address or None
+    :param quorum: number of sources that have to agree on the address
+    :param deadline: time limit in seconds, None for no limit
+    :param audit: Auditing module
+    :return: IP address or None if detection was not successful.
+    """
+    def query(source):
+        ip = source()
+        return ip if is_ip_address(ip) else None
+
+    def agreed(answers):
+        valid = [x for x in answers if x is not None]
+        return [x for x in valid if valid.count(x) >= quorum]
+
+    time_start = time.time()
+    tasks = [functools.partial(query, x) for x in sources]
+    answers, _ = run_concurrently(tasks, predicate=lambda x: len(agreed(x)) > 0, deadline=deadline,
+                                  name='public-ip')
+
+    # No quorum, first valid answer in the sources order
+    candidates = agreed(answers)
+    if len(candidates) == 0:
+        candidates = [x for x in answers if x is not None]
+    result = candidates[0] if len(candidates) > 0 else None
+
+    if audit is not None:
+        audit.audit_evt('public-ip-hedged', ip=result, answers=list(answers), quorum=quorum,
+                        time=time.time() - time_start)
+    return result
+
+
 def get_repoquery_available_versions(out):
     """
     Processes yum list package output
@@ -1364,11 +1836,16 @@ def download_file(url, filename, attempts=3):
     :param filename:
     :return:
     """
+    import httpclient
+
     for attempt in range(attempts):
         try:
-            r = requests.get(url, stream=True, timeout=15)
-            with open(filename, 'wb') as f:
-                shutil.copyfileobj(r.raw, f)
+            r = httpclient.get(url, stream=True)
+            try:
+                with open(filename, 'wb') as f:
+                    shutil.copyfileobj(r.raw, f)
+            finally:
+                r.close()
 
             return filename
 
@@ -1441,3 +1918,90 @@ def add_ending_slash(x):
         return x
     return '%s/' % x
 
+
+
+class LRUCache(object):
+    """
+    Simple least recently used cache with bounded size
+    """
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns cached value, marks it as recently used
+        :param key: 
+        :param default: 
+        :return: 
+        """
+        try:
+            val = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data[key] = val
+        self.hits += 1
+        return val
+
+    def put(self, key, val):
+        """
+        Stores the value, evicts the least recently used one if the cache is full
+        :param key: 
+        :param val: 
+        :return: 
+        """
+        self._data.pop(key, None)
+        self._data[key] = val
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self):
+        return list(self._data.items())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LazyImport(object):
+    """
+    Module or module attribute imported on the first use.
+    Attribute access and calls are forwarded to the imported object.
+    """
+    def __init__(self, module, attr=None):
+        self.__dict__['_lazy_module'] = module
+        self.__dict__['_lazy_attr'] = attr
+        self.__dict__['_lazy_obj'] = None
+
+    def _lazy_load(self):
+        obj = self.__dict__['_lazy_obj']
+        if obj is None:
+            obj = importlib.import_module(self.__dict__['_lazy_module'])
+            if self.__dict__['_lazy_attr'] is not None:
+                obj = getattr(obj, self.__dict__['_lazy_attr'])
+            self.__dict__['_lazy_obj'] = obj
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self.__dict__['_lazy_module']
+        if self.__dict__['_lazy_attr'] is not None:
+            name += '.' + self.__dict__['_lazy_attr']
+        return 'LazyImport(%s)' % name
@@ -3,6 +3,8 @@
 
 from __future__ import print_function
 
+import heapq
+import itertools
 import logging
 import threading
 import time
@@ -14,63 +16,227 @@ __author__ = 'dusanklinec'
 logger = logging.getLogger(__name__)
 
 
+class TimerService(object):
+    """
+    Single thread serving deadlines of all watchers.
+    Deadlines are kept in the heap, the thread sleeps on the condition until the nearest deadline
+    or until a new earlier deadline is scheduled. With no deadline scheduled the thread waits without timeout.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._purge = False
+
+    def schedule(self, watcher, deadline):
+        """
+        Schedules the watcher check at the deadline
+        :param watcher: 
+        :param deadline: 
+        :return: 
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), watcher))
+            watcher._scheduled = deadline
+            watcher._done.clear()
+            self._ensure_thread()
+
+            # Wake the thread only if the new deadline is the nearest one
+            if self._heap[0][2] is watcher:
+                self._cond.notify()
+
+    def wakeup(self):
+        """
+        Wakes the service thread up so it drops cancelled entries
+        :return: 
+        """
+        with self._cond:
+            self._purge = True
+            self._cond.notify()
+
+    def pending(self):
+        """
+        Number of scheduled heap entries
+        :return: 
+        """
+        with self._cond:
+            return len(self._heap)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._main, name='watcher-timer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _main(self):
+        """
+        Thread main
+        :return: 
+        """
+        while True:
+            with self._cond:
+                if self._purge:
+                    self._drop_stopped()
+                fire = self._collect()
+                if len(fire) == 0:
+                    if len(self._heap) == 0:
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(max(0.0, self._heap[0][0] - time.time()))
+                    continue
+
+            for watcher in fire:
+                watcher._fire()
+
+    def _drop_stopped(self):
+        """
+        Removes entries of stopped watchers and stale entries from the whole heap. Called with the lock held.
+        :return: 
+        """
+        self._purge = False
+        heap = []
+        for entry in self._heap:
+            deadline, _, watcher = entry
+            if watcher._stopped:
+                watcher._done.set()
+            elif watcher._scheduled == deadline:
+                heap.append(entry)
+
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def _collect(self):
+        """
+        Pops expired entries, reschedules postponed watchers. Called with the lock held.
+        :return: list of watchers to fire
+        """
+        fire = []
+        cur_time = time.time()
+        while len(self._heap) > 0:
+            deadline, _, watcher = self._heap[0]
+            if watcher._stopped or watcher._scheduled != deadline:
+                heapq.heappop(self._heap)
+                if watcher._stopped:
+                    watcher._done.set()
+                continue
+
+            if deadline > cur_time:
+                break
+
+            heapq.heappop(self._heap)
+            watcher._scheduled = None
+
+            # Signalled in the meantime - postpone, lazily
+            new_deadline = watcher._deadline()
+            if new_deadline is not None and new_deadline > cur_time:
+                heapq.heappush(self._heap, (new_deadline, next(self._seq), watcher))
+                watcher._scheduled = new_deadline
+                continue
+
+            watcher._stopped = True
+            fire.append(watcher)
+        return fire
+
+
+_SERVICE = None
+_SERVICE_LOCK = threading.Lock()
+
+
+def get_timer_service():
+    """
+    Process-wide timer service
+    :return: TimerService
+    """
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = TimerService()
+        return _SERVICE
+
+
 class Watcher(object):
     """
-    Watcher object handles scenario with executing some piece of code after some timeout    
+    Watcher object handles scenario with executing some piece of code after some timeout
+    Thin handle on the shared timer service, no thread per watcher.
     """
-    def __init__(self, fnc, timeout):
+    def __init__(self, fnc, timeout, service=None):
         self.fnc = fnc
         self.timeout = timeout
-        self._thread = None
+        self._service = service
         self._paused = True
-        self._lock = threading.Lock()
-        self._stop_evt = threading.Event()
+        self._stopped = False
+        self._scheduled = None
         self._last_evt = 0
+        self._thread = None
+        self._done = threading.Event()
+        self._done.set()
         self.timedout = False
 
+    @property
+    def service(self):
+        if self._service is None:
+            self._service = get_timer_service()
+        return self._service
+
     def start(self, paused=False):
         """
         Starts the watcher
         :return: 
         """
-        self._thread = threading.Thread(target=self._main)
         self._paused = paused
-        self._thread.start()
+        self._stopped = False
+        if not paused:
+            self.service.schedule(self, self._deadline())
 
     def signal(self):
         """
         Signalize event happened - postpone timeouting
         :return: 
         """
-        self._paused = False
-        with self._lock:
-            self._last_evt = time.time()
+        self._last_evt = time.time()
+        if self._paused and not self._stopped:
+            self._paused = False
+            self.service.schedule(self, self._deadline())
 
     def stop(self):
         """
-        Stops the watcher
+        Stops the watcher, the service drops its scheduled entry right away
         :return: 
         """
         self._paused = True
-        self._stop_evt.set()
+        self._stopped = True
+        if self._scheduled is not None:
+            self.service.wakeup()
 
-    def _main(self):
+    def join(self, timeout=None):
         """
-        Thread main 
-        :return: 
+        Waits until the watcher is off the service - dropped after stop() or the fired callback finished
+        :param timeout: 
+        :return: True if finished
         """
-        while not self._stop_evt.isSet():
-            time.sleep(0.05)
+        return self._done.wait(timeout)
 
-            if self._paused:
-                continue
+    def _deadline(self):
+        if self._paused or self._stopped:
+            return None
+        return self._last_evt + self.timeout
 
-            with self._lock:
-                cur_time = time.time()
-                if self._last_evt + self.timeout >= cur_time:
-                    continue
+    def _fire(self):
+        """
+        Runs the callback in its own thread so a slow callback does not hold other watchers
+        :return: 
+        """
+        self.timedout = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
-            self.timedout = True
+    def _run(self):
+        try:
             self.fnc()
-            return
-
+        except Exception as e:
+            logger.error('Exception in watcher callback: %s' % e)
+        finally:
+            self._done.set()